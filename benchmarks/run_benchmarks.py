@@ -0,0 +1,295 @@
+"""
+Benchmarks of the ingest, read and dashboard hot paths.
+
+Runs without the engine: the results are synthetic `compartments_full.nc` outputs with
+the real dimensions (T, M, G, V, epi_states), at MITMA scale by default, stored in a
+temporary database and output folder. Each case is timed over a few repeats, and run
+once more under tracemalloc for its peak memory. The results are written as JSON, and
+can be compared with those of another version:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+Cases that can't run here, e.g. because the reference data or the region geometry
+isn't in models/mitma, are recorded as skipped with the reason.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.join(REPO_DIR, 'src'))
+
+import db.db as db
+
+EPI_STATES = ['S', 'E', 'A', 'I', 'PH', 'PD', 'HR', 'HD', 'R', 'D', 'CH']
+# The number of municipalities in the MITMA mobility data
+MITMA_REGIONS = 2850
+# The input files of a MITMA run in models/mitma, as named in INPUT_FILES of epi_sim_server
+INPUT_FILENAMES = ['kappa0_from_mitma.csv', 'R_mobility_matrix.csv', 'metapopulation_data.csv', 'initial_conditions.nc']
+# Cases that got slower by less than this many seconds aren't flagged, however fast they are
+REGRESSION_FLOOR_S = 0.001
+
+
+def synthetic_output(T, M, seed=0):
+    """The bytes of a synthetic engine output, `compartments_full.nc`, of T days and M regions."""
+    rng = np.random.default_rng(seed)
+    ds = xr.Dataset(
+        {'data': (('T', 'M', 'G', 'V', 'epi_states'), rng.random((T, M, 3, 2, len(EPI_STATES))) * 1000)},
+        coords={
+            'T': pd.date_range('2020-02-09', periods=T).strftime('%Y-%m-%d').values,
+            'M': [f"{i:05d}" for i in range(1, M + 1)],
+            'G': ['Y', 'M', 'O'],
+            'V': ['NV', 'V'],
+            'epi_states': EPI_STATES,
+        },
+    )
+    return bytes(ds.to_netcdf(engine='h5netcdf'))
+
+
+class CallbackRecorder:
+    """Stands in for the Dash app, keeping the bodies of the callbacks registered on it by name."""
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def callback(self, *args, **kwargs):
+        def register(func):
+            self.callbacks[func.__name__] = func
+            return func
+        return register
+
+    def clientside_callback(self, *args, **kwargs):
+        pass
+
+
+def measure(func, setup=None, repeat=5):
+    """Times `func` over `repeat` runs, calling `setup` untimed before each, then runs it once under tracemalloc."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'repeat': repeat,
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+        'mean_s': statistics.mean(times),
+        'max_s': max(times),
+        'peak_bytes': peak,
+    }
+
+
+def benchmark_cases(output, simulation_id):
+    """The cases to run, as (name, func, setup) triples, on the result stored under `simulation_id`."""
+    import simulation_results_dashboard as dashboard
+
+    recorder = CallbackRecorder()
+    dashboard.register_callbacks(recorder)
+    callbacks = recorder.callbacks
+    pathname = f"/dash/results/{simulation_id}"
+
+    def cold():
+        db.dataset_cache.clear()
+        dashboard._simulation_metadata.cache_clear()
+
+    def metadata():
+        # as the browser gets it back from the dcc.Store
+        return json.loads(json.dumps(dashboard.simulation_metadata(simulation_id)))
+
+    def store():
+        # replaces the copy of the previous run
+        db.store_simulation_result('bench-store', output, 'bench-store')
+
+    def warm():
+        db.read_simulation(simulation_id)
+        metadata()
+
+    regions = db.read_simulation(simulation_id).M.values[:3].tolist()
+    cases = [
+        ('store_simulation_result', store, None),
+        ('read_simulation/cold', lambda: db.read_simulation(simulation_id), cold),
+        ('read_simulation/warm', lambda: db.read_simulation(simulation_id), warm),
+        ('read_simulation/load_all', lambda: db.read_simulation(simulation_id).data.values, cold),
+        ('simulation_metadata/cold', metadata, cold),
+        ('dash/update_dropdowns', lambda: callbacks['update_dropdowns'](metadata()), warm),
+        ('dash/update_graph/totals', lambda: callbacks['update_graph'](['I', 'R'], None, None, None, None, 1000, pathname, metadata()), warm),
+        ('dash/update_graph/regions', lambda: callbacks['update_graph'](['I', 'R'], regions, None, None, None, 1000, pathname, metadata()), warm),
+        ('dash/update_graph/regions_ages_vaccination', lambda: callbacks['update_graph'](['I'], regions, [10, 50], ['Y'], ['V'], 1000, pathname, metadata()), warm),
+        ('dash/update_graph/cold', lambda: callbacks['update_graph'](['I', 'R'], None, None, None, None, 1000, pathname, metadata()), cold),
+        ('dash/update_static_graphs', lambda: callbacks['update_static_graphs'](metadata(), pathname), warm),
+        ('map/regional_values', lambda: dashboard.regional_values(dashboard.read_view(simulation_id, kept_dims={'M'}), 'I', -1), warm),
+        ('map/regional_series', lambda: dashboard.regional_series(dashboard.read_view(simulation_id, kept_dims={'M'}), 'I'), warm),
+        ('map/region_geojson', lambda: dashboard.region_geojson(dashboard.MAP_GEOMETRY_ZOOM), dashboard.region_geojson.cache_clear),
+    ]
+
+    # submitting a run hashes its input files while copying them into the blob store
+    input_paths = [os.path.join(REPO_DIR, 'models', 'mitma', filename) for filename in INPUT_FILENAMES]
+    spool_dir = os.path.join(db.SIM_OUTPUT_DIR, 'bench-spool')
+
+    def spool_inputs():
+        for file_path in input_paths:
+            with open(file_path, 'rb') as f:
+                db.spool_file(f, spool_dir)
+
+    def store_inputs():
+        for file_path in input_paths:
+            with open(file_path, 'rb') as f:
+                db.store_blob(f)
+
+    def clear_blobs():
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        # the blobs are read-only, but their folders aren't
+        shutil.rmtree(db.BLOB_DIR, ignore_errors=True)
+
+    cases += [
+        ('inputs/spool_file', spool_inputs, clear_blobs),
+        ('inputs/store_blob/new', store_inputs, clear_blobs),
+        # identical inputs are only hashed, and found stored already
+        ('inputs/store_blob/existing', store_inputs, store_inputs),
+    ]
+    return cases
+
+
+def run(args):
+    tmp_dir = tempfile.mkdtemp(prefix='episim-bench-')
+    db.SIM_OUTPUT_DIR = os.path.join(tmp_dir, 'sim_output')
+    db.BLOB_DIR = os.path.join(tmp_dir, 'blobs')
+    db.DATABASE_PATH = os.path.join(tmp_dir, 'bench.db')
+    os.makedirs(db.SIM_OUTPUT_DIR)
+    # the dashboard reads the reference data and region geometry relative to the repo
+    os.chdir(REPO_DIR)
+
+    try:
+        db.create_database()
+        print(f"Generating a synthetic output of {args.days} days and {args.regions} regions")
+        output = synthetic_output(args.days, args.regions)
+        simulation_id = 'bench'
+        db.store_simulation_result(simulation_id, output, 'bench')
+
+        results = {}
+        for name, func, setup in benchmark_cases(output, simulation_id):
+            if args.filter and args.filter not in name:
+                continue
+            if isinstance(func, Exception):
+                results[name] = {'skipped': f"{type(func).__name__}: {func}"}
+            else:
+                try:
+                    results[name] = measure(func, setup, args.repeat)
+                except Exception as e:
+                    results[name] = {'skipped': f"{type(e).__name__}: {e}"}
+            result = results[name]
+            if 'skipped' in result:
+                print(f"  {name:<48} skipped ({result['skipped']})")
+            else:
+                print(f"  {name:<48} {result['median_s'] * 1000:10.1f} ms {result['peak_bytes'] / 1024 ** 2:10.1f} MiB")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'xarray': xr.__version__,
+        },
+        'parameters': {
+            'days': args.days,
+            'regions': args.regions,
+            'output_bytes': len(output),
+            'repeat': args.repeat,
+        },
+        # in KiB on Linux, in bytes on macOS
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, threshold):
+    """Prints how each case changed since `baseline`. Returns the names of the cases that got slower than `threshold` times."""
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'the baseline'} (median time, peak memory):")
+    for name, result in report['results'].items():
+        before = baseline['results'].get(name)
+        if 'skipped' in result or before is None or 'skipped' in before:
+            continue
+        time_ratio = result['median_s'] / before['median_s'] if before['median_s'] else float('inf')
+        memory_ratio = result['peak_bytes'] / before['peak_bytes'] if before['peak_bytes'] else float('inf')
+        flag = ''
+        if time_ratio > threshold and result['median_s'] - before['median_s'] > REGRESSION_FLOOR_S:
+            regressions.append(name)
+            flag = '  <- slower'
+        print(f"  {name:<48} {time_ratio:8.2f}x {memory_ratio:8.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=120, help="days (T) of the synthetic output")
+    parser.add_argument('--regions', type=int, default=MITMA_REGIONS, help="regions (M) of the synthetic output")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs of each case")
+    parser.add_argument('--filter', help="only run the cases whose name contains this")
+    parser.add_argument('--output', default='benchmark_results.json', help="where to write the results")
+    parser.add_argument('--compare', help="the results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="exit with an error if a case got slower than this many times the compared run")
+    args = parser.parse_args()
+    # the benchmarks run from the repo folder
+    args.output = os.path.abspath(args.output)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != report['parameters']:
+            print("Warning: the compared run used different parameters")
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,94 +1,929 @@
 import os
+import shutil
+import numpy as np
 import pandas as pd
 import xarray as xr
+import h5py
+import h5netcdf
 from io import BytesIO
 import gzip
+import lzma
 import sqlite3
-import tarfile
 import json
 import hashlib
+import uuid
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'epi_sim_db.db')
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'init_db.sql')
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('EPISIM_SQLITE_BUSY_TIMEOUT_MS', 30000))
 SIM_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'sim_output')
+BLOB_DIR = os.path.join(os.path.dirname(__file__), 'blobs')
+DATASET_CACHE_BYTES = int(os.environ.get('EPISIM_DATASET_CACHE_BYTES', 2 * 1024 ** 3))
+# Lazily opened and memory-mapped datasets take hardly any memory but an open file each,
+# so the number of cached datasets is bounded too
+DATASET_CACHE_ENTRIES = int(os.environ.get('EPISIM_DATASET_CACHE_ENTRIES', 128))
+
+# Results are stored as NetCDF4 files with per-chunk compression, so that a reader only
+# decompresses the chunks it touches. Chunks span a block of days and regions and all
+# of the (small) age, vaccination and compartment dimensions.
+RESULT_CHUNKS = {'T': 32, 'M': 128}
+RESULT_COMPRESSION_LEVEL = 4
+
+# Whole-file compressed results, by extension: results stored by older versions are
+# gzipped, cold results are recompressed with a higher-ratio codec (see retention.py).
+# They are decompressed once into a spool directory when read.
+RESULT_CODECS = {
+    '.gz': lambda file_path: gzip.open(file_path, 'rb'),
+    '.xz': lambda file_path: lzma.open(file_path, 'rb'),
+    '.zst': lambda file_path: _open_zstd(file_path),
+}
+
+# Reads of a result are recorded at most this often (in seconds), for retention by last access
+ACCESS_RECORD_INTERVAL = 60
+
+# Rollups of the compartment data that are precomputed when a result is stored,
+# by name and the dimensions they are summed over
+ROLLUPS = {
+    'total': ('M', 'G', 'V'),
+    'by_region': ('G', 'V'),
+    'by_age': ('M', 'V'),
+    'by_vaccination': ('M', 'G'),
+}
+
+# Listeners of what reading and storing results costs, called with (kind, name, value):
+# 'seconds' spent in a stage, 'bytes' moved, or a 'count' of events. See instrumentation.py
+_instrumentation_listeners = []
+
+def add_instrumentation_listener(listener):
+    _instrumentation_listeners.append(listener)
+
+def _record(kind, name, value):
+    for listener in _instrumentation_listeners:
+        listener(kind, name, value)
+
+@contextmanager
+def _stage(name):
+    if not _instrumentation_listeners:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record('seconds', name, time.perf_counter() - start)
+
+
+class DatasetCache:
+    """
+    Process-wide LRU cache of opened simulation datasets.
+
+    Entries are keyed by simulation id and tagged with a signature of the file on
+    disk (mtime and size), so a result that is rewritten is decoded again instead
+    of being served stale. The total size of the cached datasets is kept under
+    `max_bytes`, and their number under `max_entries`, by evicting the least
+    recently used entries.
+    """
+
+    def __init__(self, max_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (signature, value, nbytes)
+        self._lock = threading.Lock()
+        self._load_locks = {}  # key -> (lock, callers loading or waiting to load it)
+
+    def get(self, key, signature):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != signature:
+                self._discard(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        _record('count', 'dataset_cache.hit' if entry is not None else 'dataset_cache.miss', 1)
+        return entry[1] if entry is not None else None
+
+    def put(self, key, signature, value, nbytes):
+        with self._lock:
+            self._discard(key)
+            if nbytes > self.max_bytes:
+                # Larger than the whole budget: hand it out but don't keep it
+                return
+            self._entries[key] = (signature, value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes or (self.max_entries is not None and len(self._entries) > self.max_entries):
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def get_or_load(self, key, signature, loader, sizeof):
+        value = self.get(key, signature)
+        if value is not None:
+            return value
+
+        # Concurrent callbacks for the same simulation wait for a single decode
+        with self._lock:
+            load_lock, callers = self._load_locks.get(key) or (threading.Lock(), 0)
+            self._load_locks[key] = (load_lock, callers + 1)
+        try:
+            with load_lock:
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None and entry[0] == signature:
+                        self._entries.move_to_end(key)
+                        return entry[1]
+                value = loader()
+                if value is not None:
+                    self.put(key, signature, value, sizeof(value))
+                return value
+        finally:
+            # the lock of a key goes away with its last caller, so there is one per load in flight
+            with self._lock:
+                callers = self._load_locks[key][1] - 1
+                if callers:
+                    self._load_locks[key] = (load_lock, callers)
+                else:
+                    del self._load_locks[key]
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+
+dataset_cache = DatasetCache(DATASET_CACHE_BYTES, DATASET_CACHE_ENTRIES)
+
+STORAGE_PATHS = ('DATABASE_PATH', 'SIM_OUTPUT_DIR', 'BLOB_DIR')
+
+def storage_paths():
+    """Where this process keeps the database and stored files, for the processes it starts to use the same."""
+    return {name: globals()[name] for name in STORAGE_PATHS}
+
+def use_storage_paths(paths):
+    globals().update({name: paths[name] for name in STORAGE_PATHS})
+
+_local = threading.local()
+
+def get_connection():
+    """
+    Returns this thread's connection to the database, opened on first use and reused after.
+    Connections run in autocommit mode; group statements with `transaction()`.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.key == (os.getpid(), DATABASE_PATH):
+        return conn
+    if conn is not None:
+        conn.close()
+
+    conn = sqlite3.connect(DATABASE_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    # WAL lets readers carry on while a worker writes; NORMAL sync is durable enough under WAL
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    _local.conn = conn
+    _local.key = (os.getpid(), DATABASE_PATH)
+    _local.depth = 0
+    return conn
+
+@contextmanager
+def transaction():
+    """
+    Runs the statements of the block in a single write transaction on this thread's connection,
+    committed at the end of the block or rolled back on error. Nested blocks join the outer one.
+    """
+    conn = get_connection()
+    if _local.depth > 0:
+        _local.depth += 1
+        try:
+            yield conn.cursor()
+        finally:
+            _local.depth -= 1
+        return
+
+    # IMMEDIATE takes the write lock up front, so the transaction can't fail halfway on a lock upgrade
+    conn.execute('BEGIN IMMEDIATE')
+    _local.depth = 1
+    try:
+        yield conn.cursor()
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        _local.depth = 0
+
+# Upgrades of existing databases, by the schema version (PRAGMA user_version) they bring
+# the database to. Fresh databases get the full schema from init_db.sql.
+MIGRATIONS = {
+    1: [
+        'CREATE INDEX IF NOT EXISTS simulation_results_params_hash ON simulation_results(params_hash)',
+        'CREATE INDEX IF NOT EXISTS simulation_jobs_status ON simulation_jobs(status, created_at)',
+    ],
+    2: [
+        'CREATE TABLE IF NOT EXISTS simulation_result_access (id TEXT PRIMARY KEY, last_accessed_at TIMESTAMP NOT NULL)',
+    ],
+}
+SCHEMA_VERSION = max(MIGRATIONS)
 
 def create_database():
+    """Creates the database, or brings an existing one up to the current schema."""
     os.makedirs(SIM_OUTPUT_DIR, exist_ok=True)
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    with open('src/db/init_db.sql', 'r') as sql_file:
+    conn = get_connection()
+
+    with open(SCHEMA_PATH, 'r') as sql_file:
         sql_script = sql_file.read()
-        cursor.executescript(sql_script)
-    
-    conn.commit()
-    conn.close()
+    conn.executescript(sql_script)
 
-def store_simulation_result(id, output_data, params_hash):
-    file_path = os.path.join(SIM_OUTPUT_DIR, f"{id}.nc.gz")
-    
-    with open(file_path, 'wb') as f:
-        f.write(gzip.compress(output_data))
-    
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO simulation_results (id, file_path, params_hash) VALUES (?, ?, ?)',
-                   (id, file_path, params_hash))
-    conn.commit()
-    conn.close()
-
-def store_simulation_params(params_files, params_hash):
-    # Create an in-memory tar file
-    tar_buffer = BytesIO()
-    with tarfile.open(fileobj=tar_buffer, mode='w:gz') as tar:
-        for filename, file_obj in params_files.items():
-            tarinfo = tarfile.TarInfo(name=filename)
-            file_obj.seek(0, os.SEEK_END)
-            tarinfo.size = file_obj.tell()
-            file_obj.seek(0)
-            tar.addfile(tarinfo, file_obj)
-    
-    # Get the tar data from the in-memory buffer
-    params_data = tar_buffer.getvalue()
-
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO simulation_params (id, params) VALUES (?, ?)',
-                   (params_hash, params_data))
-    conn.commit()
-    conn.close()
-
-def get_simulation_result(id):
-    file_path = os.path.join(SIM_OUTPUT_DIR, f"{id}.nc.gz")
-    
-    if os.path.exists(file_path):
-        with open(file_path, 'rb') as f:
-            compressed_data = f.read()
-        return gzip.decompress(compressed_data)
-    
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    with transaction() as cursor:
+        for target_version in sorted(v for v in MIGRATIONS if v > version):
+            for statement in MIGRATIONS[target_version]:
+                cursor.execute(statement)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+def result_file_path(id):
+    """
+    Returns the path of the stored result of a simulation, or None if there is none.
+    Results stored before chunked storage was introduced, and cold results, are whole-file
+    compressed NetCDF files (see `RESULT_CODECS`).
+    """
+    for extension in ('.nc', *(f".nc{codec}" for codec in RESULT_CODECS)):
+        file_path = os.path.join(SIM_OUTPUT_DIR, f"{id}{extension}")
+        if os.path.exists(file_path):
+            return file_path
     return None
 
+def _open_zstd(file_path):
+    if zstandard is None:
+        raise ImportError("Reading zstd compressed results needs the zstandard package")
+    return zstandard.open(file_path, 'rb')
+
+def _chunked_encoding(variable, complevel=RESULT_COMPRESSION_LEVEL):
+    chunksizes = tuple(
+        max(1, min(RESULT_CHUNKS.get(dim, size), size))
+        for dim, size in zip(variable.dims, variable.shape)
+    )
+    encoding = {k: v for k, v in variable.encoding.items() if k in ('dtype', '_FillValue')}
+    # shuffled bytes compress much better, whether per chunk or with the whole file
+    encoding.update({'chunksizes': chunksizes, 'shuffle': True})
+    if complevel:
+        encoding.update({'zlib': True, 'complevel': complevel})
+    return encoding
+
+def write_chunked_result(source, file_path, complevel=RESULT_COMPRESSION_LEVEL):
+    """
+    Writes a NetCDF dataset, given as bytes or as a path, to `file_path` in the chunked format.
+    Variables along T are copied one block of days at a time, so that the full array is never
+    held in memory. The file is written next to its destination and moved in place once complete.
+    With a `complevel` of 0 the chunks are left uncompressed, for the whole file to be compressed.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with _stage('db.write_chunked'), xr.open_dataset(source, engine='h5netcdf', cache=False) as ds:
+            blockwise = _create_chunked_result(ds, tmp_path, complevel)
+            with h5netcdf.File(tmp_path, 'a') as f:
+                for name in blockwise:
+                    _copy_days(f[name], ds[name], 0, ds.sizes['T'])
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _create_chunked_result(ds, file_path, complevel=RESULT_COMPRESSION_LEVEL):
+    """
+    Writes the variables of `ds` that aren't along T to a new file in the chunked format, and
+    creates the (empty) variables along T, for them to be filled in blocks of days.
+    Returns the names of the variables along T.
+    """
+    blockwise = [name for name, var in ds.data_vars.items() if 'T' in var.dims]
+    rest = ds.drop_vars(blockwise)
+    encoding = {name: _chunked_encoding(var, complevel) for name, var in rest.data_vars.items() if var.ndim > 0}
+    rest.to_netcdf(file_path, engine='h5netcdf', encoding=encoding)
+
+    with h5netcdf.File(file_path, 'a') as f:
+        for name in blockwise:
+            var = ds[name]
+            for dim, size in var.sizes.items():
+                if dim not in f.dimensions:
+                    f.dimensions[dim] = size
+
+            encoding = _chunked_encoding(var, complevel)
+            fill_value = np.nan if var.dtype.kind == 'f' else None
+            compression = dict(compression='gzip', compression_opts=complevel) if complevel else {}
+            out = f.create_variable(
+                name, var.dims, dtype=var.dtype, fillvalue=fill_value, chunks=encoding['chunksizes'], shuffle=True, **compression,
+            )
+            out.attrs.update({k: v for k, v in var.attrs.items() if k != '_FillValue'})
+    return blockwise
+
+def _block_digest(values):
+    return hashlib.blake2b(np.ascontiguousarray(values).tobytes(), digest_size=16).digest()
+
+def _copy_days(out, var, start, stop, digests=None):
+    """
+    Copies days `start` to `stop` of `var` into the file variable `out`, one block of days at a time.
+    The digest of each block copied is recorded in `digests`, if given, by the first day of the block.
+    """
+    axis = var.get_axis_num('T')
+    for block_start in range(start, stop, RESULT_CHUNKS['T']):
+        block = slice(block_start, min(block_start + RESULT_CHUNKS['T'], stop))
+        index = tuple(block if i == axis else slice(None) for i in range(var.ndim))
+        values = var.isel(T=block).values
+        out[index] = values
+        if digests is not None:
+            digests[block_start] = _block_digest(values)
+
+def partial_result_path(job_id):
+    return os.path.join(SIM_OUTPUT_DIR, 'partial', f"{job_id}.nc")
+
+def partial_curves_path(job_id):
+    return os.path.join(SIM_OUTPUT_DIR, 'partial', f"{job_id}.json")
+
+class PartialResult:
+    """
+    The result of a running job, copied into the chunked format while the engine is still
+    writing its output, as the days appear in it. The output is opened without file locking,
+    so that following it never gets in the way of the engine's writes, and days with any
+    missing compartment values are taken as not (fully) written yet.
+
+    Whole blocks of days are copied as soon as they are complete, so that the final ingest
+    only copies the last block and moves the file in place. A day without missing values isn't
+    necessarily final though, so the final update checks the blocks copied before against the
+    finished output by their digests, and copies the ones that changed again. After each update,
+    the totals of each compartment over the days computed so far are written to a small JSON
+    file for clients to follow the run.
+    """
+
+    def __init__(self, job_id, source_path):
+        self.job_id = job_id
+        self.source_path = source_path
+        self.file_path = partial_result_path(job_id)
+        self.curves_path = partial_curves_path(job_id)
+        # days seen in the engine's output, and days copied into the chunked file
+        self.days_computed = 0
+        self.days_copied = 0
+        self._blockwise = None
+        # digests of the blocks copied, by variable and first day
+        self._digests = {}
+        self._totals = []
+
+    def update(self, final=False):
+        """
+        Copies the days the engine has written since the last update. Until `final`,
+        an output file that can't be read yet (e.g. being written) is tried again later.
+        Returns the number of days computed so far.
+        """
+        if not final and not os.path.exists(self.source_path):
+            return self.days_computed
+        try:
+            with h5py.File(self.source_path, 'r', locking=False) as f, \
+                    xr.open_dataset(f, engine='h5netcdf', cache=False) as ds:
+                self._update(ds, final)
+        except (OSError, ValueError, KeyError):
+            if final:
+                raise
+        return self.days_computed
+
+    def _update(self, ds, final):
+        if self._blockwise is None:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self._blockwise = _create_chunked_result(ds, self.file_path)
+            self._digests = {name: {} for name in self._blockwise}
+
+        data = ds['data'].transpose('T', ..., 'epi_states')
+        n_days = ds.sizes['T']
+        while self.days_computed < n_days:
+            block = data.isel(T=slice(self.days_computed, self.days_computed + RESULT_CHUNKS['T'])).values
+            flat = block.reshape(len(block), -1, block.shape[-1])
+            if final:
+                n_new = len(block)
+            else:
+                missing = np.any(np.isnan(flat), axis=(1, 2))
+                n_new = int(np.argmax(missing)) if missing.any() else len(block)
+            self._totals.extend(np.nansum(flat[:n_new], axis=1).tolist())
+            self.days_computed += n_new
+            if n_new < len(block):
+                break
+
+        # only whole blocks until the end, so that every chunk is written once
+        copy_until = n_days if final else self.days_computed - self.days_computed % RESULT_CHUNKS['T']
+        if final or copy_until > self.days_copied:
+            with h5netcdf.File(self.file_path, 'a') as f:
+                if final:
+                    self._recopy_changed_blocks(f, ds)
+                for name in self._blockwise:
+                    _copy_days(f[name], ds[name], self.days_copied, copy_until, self._digests[name])
+            self.days_copied = copy_until
+
+        curves = {
+            "days": self.days_computed,
+            "total_days": n_days,
+            "times": [str(t)[:10] for t in ds['T'].values[:self.days_computed]],
+            "totals": {
+                str(state): [day[i] for day in self._totals]
+                for i, state in enumerate(ds['epi_states'].values)
+            },
+        }
+        tmp_path = f"{self.curves_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(curves, f)
+        os.replace(tmp_path, self.curves_path)
+
+    def _recopy_changed_blocks(self, f, ds):
+        """Copies the blocks copied before that differ in the finished output again."""
+        changed = set()
+        for name in self._blockwise:
+            for block_start, digest in self._digests[name].items():
+                block_stop = block_start + RESULT_CHUNKS['T']
+                if _block_digest(ds[name].isel(T=slice(block_start, block_stop)).values) != digest:
+                    _copy_days(f[name], ds[name], block_start, block_stop, self._digests[name])
+                    changed.add(block_start)
+        for block_start in changed:
+            # and the curves follow
+            block = ds['data'].transpose('T', ..., 'epi_states').isel(T=slice(block_start, block_start + RESULT_CHUNKS['T'])).values
+            self._totals[block_start:block_start + len(block)] = np.nansum(block.reshape(len(block), -1, block.shape[-1]), axis=1).tolist()
+
+    def discard(self):
+        discard_partial_result(self.job_id)
+
+def discard_partial_result(job_id):
+    for file_path in (partial_result_path(job_id), partial_curves_path(job_id)):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def rollups_file_path(id):
+    return os.path.join(SIM_OUTPUT_DIR, f"{id}.rollups.nc")
+
+def compute_rollups(ds):
+    """
+    Sums the compartment data of a result into the `ROLLUPS`, one block of days at a time
+    so that the full array is never held in memory.
+    """
+    data = ds['data']
+    # a rollup by a dimension the result doesn't have would just repeat the total
+    rollups = {name: dims for name, dims in ROLLUPS.items() if {'M', 'G', 'V'} - set(dims) <= set(data.dims)}
+    blocks = {name: [] for name in rollups}
+    for start in range(0, data.sizes['T'], RESULT_CHUNKS['T']):
+        block = data.isel(T=slice(start, start + RESULT_CHUNKS['T'])).load()
+        for name, dims in rollups.items():
+            blocks[name].append(block.sum(dim=[d for d in dims if d in block.dims]))
+    return xr.Dataset({name: xr.concat(parts, dim='T') for name, parts in blocks.items()})
+
+def write_result_rollups(result_path, file_path):
+    with _stage('db.rollups'):
+        with xr.open_dataset(result_path, engine='h5netcdf') as ds:
+            rollups = compute_rollups(ds)
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        encoding = {name: _chunked_encoding(var) for name, var in rollups.data_vars.items()}
+        rollups.to_netcdf(tmp_path, engine='h5netcdf', encoding=encoding)
+        os.replace(tmp_path, file_path)
+
+def store_simulation_result(id, output_data, params_hash):
+    file_path = os.path.join(SIM_OUTPUT_DIR, f"{id}.nc")
+    write_chunked_result(output_data, file_path)
+    _register_result(id, file_path, params_hash)
+
+def store_partial_result(id, partial_result, params_hash):
+    """Stores the result of a job that was copied into the chunked format as the engine wrote it."""
+    partial_result.update(final=True)
+    file_path = os.path.join(SIM_OUTPUT_DIR, f"{id}.nc")
+    os.replace(partial_result.file_path, file_path)
+    _register_result(id, file_path, params_hash)
+
+def _register_result(id, file_path, params_hash):
+    write_result_rollups(file_path, rollups_file_path(id))
+    dataset_cache.invalidate(id)
+    dataset_cache.invalidate(f"{id}:rollups")
+
+    # uploads can replace the result stored under an id
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO simulation_results (id, file_path, params_hash) VALUES (?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET file_path = excluded.file_path, params_hash = excluded.params_hash
+        ''', (id, file_path, params_hash))
+        # storing a result counts as using it
+        _touch_result(cursor, id)
+
+_recorded_accesses = {}
+_recorded_accesses_lock = threading.Lock()
+
+def _touch_result(cursor, id):
+    cursor.execute('''
+        INSERT INTO simulation_result_access (id, last_accessed_at) VALUES (?, CURRENT_TIMESTAMP)
+        ON CONFLICT(id) DO UPDATE SET last_accessed_at = excluded.last_accessed_at
+    ''', (id,))
+
+def record_result_access(id):
+    """
+    Records that a result was read, for retention by last access. Each process writes the
+    access of a result at most once every `ACCESS_RECORD_INTERVAL` seconds.
+    """
+    now = time.monotonic()
+    with _recorded_accesses_lock:
+        last = _recorded_accesses.get(id)
+        if last is not None and now - last < ACCESS_RECORD_INTERVAL:
+            return
+        _recorded_accesses[id] = now
+    try:
+        _touch_result(get_connection().cursor(), id)
+    except sqlite3.Error:
+        # the access is only a hint for retention, reads don't fail over it
+        pass
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+class FileTooLargeError(ValueError):
+    pass
+
+def spool_file(file_obj, directory, max_bytes=None):
+    """
+    Copies a file object into a new temporary file in `directory` in chunks, hashing the
+    contents on the way, so that memory use doesn't depend on the size of the file.
+    Returns the path of the temporary file and the sha256 hex digest of its contents.
+    Raises FileTooLargeError once more than `max_bytes` have been read.
+    """
+    os.makedirs(directory, exist_ok=True)
+    hasher = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(directory, f"{uuid.uuid4().hex}.tmp")
+    try:
+        with _stage('db.spool'), open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: file_obj.read(1024 * 1024), b''):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise FileTooLargeError(f"File is larger than the limit of {max_bytes} bytes")
+                hasher.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    _record('bytes', 'spooled', size)
+    return tmp_path, hasher.hexdigest()
+
+def store_blob(file_obj, max_bytes=None):
+    """
+    Stores the contents of a file object in the content-addressed blob store, streaming
+    and hashing it in chunks. Returns the sha256 hex digest that the blob is stored under.
+    Blobs are read-only and stored once, however many runs use them.
+    """
+    tmp_path, digest = spool_file(file_obj, BLOB_DIR, max_bytes)
+    try:
+        file_path = blob_path(digest)
+        if not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, file_path)
+        else:
+            # the garbage collection of blobs spares those stored recently
+            os.utime(file_path)
+        return digest
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def link_blob(digest, file_path):
+    """Makes a blob available at `file_path`, as a hard link where possible."""
+    try:
+        os.link(blob_path(digest), file_path)
+    except OSError:
+        shutil.copyfile(blob_path(digest), file_path)
+
+def store_simulation_params(params_blobs, params_hash):
+    """Records the input files of a set of params, as a mapping of file names to blob digests."""
+    # identical params may have been stored by an earlier run whose result is gone
+    with transaction() as cursor:
+        cursor.execute('INSERT OR IGNORE INTO simulation_params (id) VALUES (?)', (params_hash,))
+        cursor.executemany('INSERT OR IGNORE INTO simulation_param_files (params_hash, filename, blob_hash) VALUES (?, ?, ?)',
+                           [(params_hash, filename, digest) for filename, digest in params_blobs.items()])
+
 def read_simulation(simulation_id):
-    output_data = get_simulation_result(simulation_id)
-    
-    if output_data is None:
+    """
+    Returns the dataset for a simulation, or None if there is no result.
+    Chunked results are opened lazily, so only the chunks that a selection touches are read.
+    Datasets are shared through `dataset_cache`, so callers must not modify them in place.
+    """
+    file_path = result_file_path(simulation_id)
+    try:
+        stat = os.stat(file_path) if file_path else None
+    except FileNotFoundError:
+        stat = None
+    if stat is None:
+        dataset_cache.invalidate(simulation_id)
+        return None
+
+    record_result_access(simulation_id)
+    signature = (file_path, stat.st_mtime_ns, stat.st_size)
+    return dataset_cache.get_or_load(
+        simulation_id, signature,
+        lambda: _open_simulation(file_path),
+        _resident_nbytes,
+    )
+
+def read_simulation_rollups(simulation_id):
+    """
+    Returns the dataset of precomputed rollups of a simulation (see `ROLLUPS`), or None if
+    there is no result. Rollups of results stored before they existed are computed on first use.
+    """
+    result_path = result_file_path(simulation_id)
+    if result_path is None:
+        return None
+
+    file_path = rollups_file_path(simulation_id)
+    if not os.path.exists(file_path) or os.path.getmtime(file_path) < os.path.getmtime(result_path):
+        write_result_rollups(_local_netcdf_path(result_path), file_path)
+
+    record_result_access(simulation_id)
+    stat = os.stat(file_path)
+    signature = (file_path, stat.st_mtime_ns, stat.st_size)
+    return dataset_cache.get_or_load(
+        f"{simulation_id}:rollups", signature,
+        lambda: _open_simulation(file_path),
+        _resident_nbytes,
+    )
+
+def get_rollup(simulation_id, name):
+    """Returns a single rollup as a dataset with a `data` variable, like the full result."""
+    rollups = read_simulation_rollups(simulation_id)
+    if rollups is None or name not in rollups:
+        return None
+    return rollups[name].to_dataset(name='data')
+
+def ensemble_stats_file_path(ensemble_id):
+    return os.path.join(SIM_OUTPUT_DIR, 'ensembles', f"{ensemble_id}.stats.nc")
+
+def store_ensemble_stats(ensemble_id, stats):
+    file_path = ensemble_stats_file_path(ensemble_id)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    encoding = {name: _chunked_encoding(var) for name, var in stats.data_vars.items()}
+    stats.to_netcdf(tmp_path, engine='h5netcdf', encoding=encoding)
+    os.replace(tmp_path, file_path)
+    dataset_cache.invalidate(f"ensemble:{ensemble_id}")
+
+def read_ensemble_stats(ensemble_id):
+    """Returns the stored statistics of an ensemble, or None if they haven't been computed."""
+    file_path = ensemble_stats_file_path(ensemble_id)
+    if not os.path.exists(file_path):
         return None
-    
+
+    stat = os.stat(file_path)
+    signature = (file_path, stat.st_mtime_ns, stat.st_size)
+    return dataset_cache.get_or_load(
+        f"ensemble:{ensemble_id}", signature,
+        lambda: _open_simulation(file_path),
+        _resident_nbytes,
+    )
+
+def spool_path(file_path):
+    """The path that a whole-file compressed result is decompressed to, see `_local_netcdf_path`."""
+    codec = os.path.splitext(file_path)[1]
+    return os.path.join(SIM_OUTPUT_DIR, '.spool', os.path.basename(file_path)[:-len(codec)])
+
+def _local_netcdf_path(file_path):
+    """
+    Returns a path to an uncompressed NetCDF file with the contents of `file_path`.
+    Whole-file compressed results are decompressed once, streaming, into a spool
+    directory next to them, instead of into memory.
+    """
+    codec = os.path.splitext(file_path)[1]
+    if codec not in RESULT_CODECS:
+        return file_path
+
+    local_path = spool_path(file_path)
+    if os.path.exists(local_path) and os.path.getmtime(local_path) >= os.path.getmtime(file_path):
+        return local_path
+
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    tmp_path = f"{local_path}.{uuid.uuid4().hex}.tmp"
+    with _stage('db.decompress'), RESULT_CODECS[codec](file_path) as src, open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    _record('bytes', 'decompressed', os.path.getsize(tmp_path))
+    os.replace(tmp_path, local_path)
+    return local_path
+
+def _memory_map_contiguous(ds, file_path):
+    """
+    Swaps the variables of `ds` that are stored contiguous and uncompressed for read-only
+    memory maps of the file, so reading them costs page cache rather than process memory.
+    Variables that need decoding (fill values, scaling) are left to xarray.
+    """
+    with h5py.File(file_path, 'r') as f:
+        for name, var in ds.data_vars.items():
+            dset = f.get(name)
+            if dset is None or dset.chunks is not None or dset.compression is not None:
+                continue
+            offset = dset.id.get_offset()
+            fill_value = var.encoding.get('_FillValue')
+            if (
+                offset is None
+                or dset.dtype.kind not in 'fiu'
+                or 'scale_factor' in var.encoding
+                or 'add_offset' in var.encoding
+                or (fill_value is not None and not (dset.dtype.kind == 'f' and np.isnan(fill_value)))
+            ):
+                continue
+            data = np.memmap(file_path, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+            ds[name] = xr.Variable(var.dims, data, var.attrs, var.encoding)
+    return ds
+
+def _is_memory_mapped(array):
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+def _resident_nbytes(ds):
+    """Approximates the process memory held by a dataset: lazy and memory-mapped variables don't count."""
+    return sum(
+        var.nbytes for var in ds.variables.values()
+        if var._in_memory and not _is_memory_mapped(var.data)
+    )
+
+def _open_simulation(file_path):
     try:
-        ds = xr.open_dataset(BytesIO(output_data), engine='h5netcdf')
-        ds['T'] = pd.to_datetime(ds['T'].values)
+        local_path = _local_netcdf_path(file_path)
+        with _stage('db.open'):
+            # cache=False: slices read from the file are not kept around by the (shared) dataset
+            ds = xr.open_dataset(local_path, engine='h5netcdf', cache=False)
+            ds = _memory_map_contiguous(ds, local_path)
+            ds['T'] = pd.to_datetime(ds['T'].values)
         return ds
     except Exception as e:
         raise Exception(f"Error reading simulation data: {str(e)}")
 
 def get_existing_simulation_id(params_hash):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT id FROM simulation_results WHERE params_hash = ?', (params_hash,))
-    result = cursor.fetchone()
-    
-    conn.close()
+    result = get_connection().execute('SELECT id FROM simulation_results WHERE params_hash = ?', (params_hash,)).fetchone()
+
+    if result:
+        return result[0]
+    return None
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+JOB_COLUMNS = ('id', 'status', 'params_hash', 'backend_engine', 'work_dir', 'subscribers', 'result_id', 'error',
+               'created_at', 'started_at', 'finished_at')
+
+def create_job(job_id, params_hash, backend_engine, work_dir):
+    """
+    Creates a queued job. Returns False if a job with the same params is already
+    queued or running, in which case no job is created.
+    """
+    try:
+        get_connection().execute('INSERT INTO simulation_jobs (id, params_hash, backend_engine, work_dir) VALUES (?, ?, ?, ?)',
+                                 (job_id, params_hash, backend_engine, work_dir))
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+def attach_to_active_job(params_hash):
+    """
+    Subscribes to the queued or running job for `params_hash`, if there is one.
+    Returns the id of that job, or None.
+    """
+    with transaction() as cursor:
+        cursor.execute("UPDATE simulation_jobs SET subscribers = subscribers + 1 WHERE params_hash = ? AND status IN ('queued', 'running') RETURNING id",
+                       (params_hash,))
+        result = cursor.fetchone()
 
     if result:
         return result[0]
     return None
+
+def detach_from_job(job_id):
+    """
+    Drops one subscriber from a queued or running job that has several.
+    Returns False if the job has a single subscriber left, who owns it.
+    """
+    cursor = get_connection().execute("UPDATE simulation_jobs SET subscribers = subscribers - 1 WHERE id = ? AND subscribers > 1 AND status IN ('queued', 'running')",
+                                      (job_id,))
+    return cursor.rowcount > 0
+
+def update_job_status(job_id, status, result_id=None, error=None, from_statuses=None):
+    """
+    Moves a job to `status`. If `from_statuses` is given, the update only happens when the
+    job is currently in one of those statuses. Returns True if the job row was updated.
+    """
+    assert status in JOB_STATUSES, f"Unknown job status {status}"
+    timestamps = {
+        'running': ", started_at = CURRENT_TIMESTAMP",
+        'done': ", finished_at = CURRENT_TIMESTAMP",
+        'failed': ", finished_at = CURRENT_TIMESTAMP",
+        'cancelled': ", finished_at = CURRENT_TIMESTAMP",
+    }
+    query = f"UPDATE simulation_jobs SET status = ?, result_id = COALESCE(?, result_id), error = ?{timestamps.get(status, '')} WHERE id = ?"
+    args = [status, result_id, error, job_id]
+    if from_statuses:
+        query += f" AND status IN ({', '.join('?' for _ in from_statuses)})"
+        args.extend(from_statuses)
+
+    cursor = get_connection().execute(query, args)
+    return cursor.rowcount > 0
+
+def get_job(job_id):
+    result = get_connection().execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM simulation_jobs WHERE id = ?", (job_id,)).fetchone()
+
+    if result:
+        return dict(zip(JOB_COLUMNS, result))
+    return None
+
+def get_jobs_by_status(*statuses):
+    results = get_connection().execute(
+        f"SELECT {', '.join(JOB_COLUMNS)} FROM simulation_jobs WHERE status IN ({', '.join('?' for _ in statuses)}) ORDER BY created_at",
+        statuses,
+    ).fetchall()
+    return [dict(zip(JOB_COLUMNS, row)) for row in results]
+
+ENSEMBLE_MEMBER_COLUMNS = ('member_index', 'params_hash', 'overrides', 'job_id', 'result_id', 'job_status', 'error')
+
+def create_ensemble(ensemble_id, backend_engine, sweep, members):
+    """Creates an ensemble and its members, given as a list of (params_hash, overrides) pairs."""
+    with transaction() as cursor:
+        cursor.execute('INSERT INTO ensembles (id, backend_engine, sweep) VALUES (?, ?, ?)',
+                       (ensemble_id, backend_engine, json.dumps(sweep)))
+        cursor.executemany('INSERT INTO ensemble_members (ensemble_id, member_index, params_hash, overrides) VALUES (?, ?, ?, ?)',
+                           [(ensemble_id, i, params_hash, json.dumps(overrides)) for i, (params_hash, overrides) in enumerate(members)])
+
+def set_ensemble_member_job(ensemble_id, member_index, job_id):
+    get_connection().execute('UPDATE ensemble_members SET job_id = ? WHERE ensemble_id = ? AND member_index = ?',
+                             (job_id, ensemble_id, member_index))
+
+def get_ensemble(ensemble_id):
+    """
+    Returns an ensemble with its members, or None. Members get the result of their params
+    if there is one, whichever run produced it, and otherwise the status of their job.
+    """
+    conn = get_connection()
+    ensemble = conn.execute('SELECT id, backend_engine, sweep, created_at FROM ensembles WHERE id = ?', (ensemble_id,)).fetchone()
+    if ensemble is None:
+        return None
+
+    rows = conn.execute('''
+        SELECT m.member_index, m.params_hash, m.overrides, m.job_id,
+               COALESCE(j.result_id, (SELECT r.id FROM simulation_results r WHERE r.params_hash = m.params_hash LIMIT 1)),
+               j.status, j.error
+        FROM ensemble_members m
+        LEFT JOIN simulation_jobs j ON j.id = m.job_id
+        WHERE m.ensemble_id = ?
+        ORDER BY m.member_index
+    ''', (ensemble_id,)).fetchall()
+
+    members = []
+    for row in rows:
+        member = dict(zip(ENSEMBLE_MEMBER_COLUMNS, row))
+        member['overrides'] = json.loads(member['overrides'])
+        member['status'] = 'done' if member['result_id'] else (member.pop('job_status') or 'pending')
+        member.pop('job_status', None)
+        members.append(member)
+
+    return {
+        "id": ensemble[0],
+        "backend_engine": ensemble[1],
+        "sweep": json.loads(ensemble[2]),
+        "created_at": ensemble[3],
+        "members": members,
+    }
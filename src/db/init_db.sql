@@ -4,6 +4,18 @@ CREATE TABLE IF NOT EXISTS simulation_params (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- The input files of a set of params, stored once each in the content-addressed blob store.
+-- simulation_params.params only holds the tar.gz of the inputs of params stored before that.
+CREATE TABLE IF NOT EXISTS simulation_param_files (
+    params_hash TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    blob_hash TEXT NOT NULL,
+    PRIMARY KEY (params_hash, filename),
+    FOREIGN KEY (params_hash) REFERENCES simulation_params(id)
+);
+
+CREATE INDEX IF NOT EXISTS simulation_param_files_blob_hash ON simulation_param_files(blob_hash);
+
 CREATE TABLE IF NOT EXISTS simulation_results (
     id TEXT PRIMARY KEY,
     file_path TEXT NOT NULL,
@@ -13,8 +25,58 @@ CREATE TABLE IF NOT EXISTS simulation_results (
     FOREIGN KEY (params_hash) REFERENCES simulation_params(id)
 );
 
+CREATE INDEX IF NOT EXISTS simulation_results_params_hash ON simulation_results(params_hash);
+
+-- When each result was last read or stored, for retention by last access.
+-- Kept apart from simulation_results, so that recording a read doesn't bump updated_at.
+CREATE TABLE IF NOT EXISTS simulation_result_access (
+    id TEXT PRIMARY KEY,
+    last_accessed_at TIMESTAMP NOT NULL
+);
+
 CREATE TRIGGER IF NOT EXISTS update_simulation_results_timestamp
 AFTER UPDATE ON simulation_results
 BEGIN
     UPDATE simulation_results SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
-END;
\ No newline at end of file
+END;
+
+CREATE TABLE IF NOT EXISTS simulation_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'queued',
+    params_hash TEXT NOT NULL,
+    backend_engine TEXT NOT NULL,
+    work_dir TEXT NOT NULL,
+    subscribers INTEGER NOT NULL DEFAULT 1,
+    result_id TEXT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- at most one queued or running job per set of params
+CREATE UNIQUE INDEX IF NOT EXISTS simulation_jobs_active_params_hash
+ON simulation_jobs(params_hash) WHERE status IN ('queued', 'running');
+
+CREATE INDEX IF NOT EXISTS simulation_jobs_status ON simulation_jobs(status, created_at);
+
+-- An ensemble is a sweep over the params of a base config, run as one member job per point
+CREATE TABLE IF NOT EXISTS ensembles (
+    id TEXT PRIMARY KEY,
+    backend_engine TEXT NOT NULL,
+    sweep TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ensemble_members (
+    ensemble_id TEXT NOT NULL,
+    member_index INTEGER NOT NULL,
+    params_hash TEXT NOT NULL,
+    overrides TEXT NOT NULL,
+    job_id TEXT,
+    PRIMARY KEY (ensemble_id, member_index),
+    FOREIGN KEY (ensemble_id) REFERENCES ensembles(id),
+    FOREIGN KEY (params_hash) REFERENCES simulation_params(id)
+);
+
+CREATE INDEX IF NOT EXISTS ensemble_members_params_hash ON ensemble_members(params_hash);
@@ -0,0 +1,46 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+from db import SIM_OUTPUT_DIR, dataset_cache, get_connection, write_chunked_result
+
+def migrate_result(simulation_id, keep_legacy=False):
+    """Converts a legacy gzipped result to the chunked format and points its database row at the new file."""
+    legacy_path = os.path.join(SIM_OUTPUT_DIR, f"{simulation_id}.nc.gz")
+    file_path = os.path.join(SIM_OUTPUT_DIR, f"{simulation_id}.nc")
+
+    # Decompress to disk first: HDF5 seeks around the file, which gzip streams are bad at
+    with tempfile.NamedTemporaryFile(dir=SIM_OUTPUT_DIR, suffix='.nc') as tmp:
+        with gzip.open(legacy_path, 'rb') as f:
+            shutil.copyfileobj(f, tmp)
+        tmp.flush()
+        write_chunked_result(tmp.name, file_path)
+    dataset_cache.invalidate(simulation_id)
+
+    get_connection().execute('UPDATE simulation_results SET file_path = ? WHERE id = ?', (file_path, simulation_id))
+
+    if not keep_legacy:
+        os.remove(legacy_path)
+
+def legacy_simulation_ids():
+    return sorted(
+        filename[:-len('.nc.gz')]
+        for filename in os.listdir(SIM_OUTPUT_DIR)
+        if filename.endswith('.nc.gz')
+    )
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    keep_legacy = '--keep-legacy' in args
+    simulation_ids = [arg for arg in args if not arg.startswith('--')] or legacy_simulation_ids()
+
+    if not simulation_ids:
+        print("No legacy results to migrate")
+
+    for simulation_id in simulation_ids:
+        try:
+            migrate_result(simulation_id, keep_legacy=keep_legacy)
+            print(f"Migrated {simulation_id}")
+        except Exception as e:
+            print(f"Error migrating {simulation_id}: {str(e)}")
@@ -0,0 +1,75 @@
+"""
+Decimation of long time series before they are sent to the browser.
+
+Both methods return the indices of the points to keep, so the same selection can be
+applied to any columns that go along with the series.
+"""
+import numpy as np
+
+DOWNSAMPLING_METHODS = ('lttb', 'minmax')
+
+
+def _as_float(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(float)
+    return x.astype(float)
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets: keeps the first and last points and, from each of
+    `n_out - 2` buckets in between, the point that forms the largest triangle with the
+    point kept from the previous bucket and the average of the next bucket.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = _as_float(x)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start = edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.nanargmax(area)) if not np.all(np.isnan(area)) else start
+        indices[i + 1] = a
+    return indices
+
+
+def min_max(y, n_out):
+    """Keeps the minimum and the maximum of each of `n_out // 2` equally sized buckets."""
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(0, n, n_out // 2 + 1).astype(int)
+    indices = set()
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            bucket = y[start:end]
+            indices.add(start + int(np.nanargmin(bucket)) if not np.all(np.isnan(bucket)) else start)
+            indices.add(start + int(np.nanargmax(bucket)) if not np.all(np.isnan(bucket)) else end - 1)
+    return np.array(sorted(indices))
+
+
+def downsample_indices(x, y, n_out, method='lttb'):
+    if method == 'lttb':
+        return lttb(x, y, n_out)
+    if method == 'minmax':
+        return min_max(y, n_out)
+    raise ValueError(f"Unknown downsampling method {method}, expected one of {DOWNSAMPLING_METHODS}")
+
@@ -0,0 +1,219 @@
+"""
+Expansion of parameter sweeps into the member configs of an ensemble.
+
+A sweep names config parameters by their path, with dots between keys and list
+indices, e.g. "epidemic_params.scale_β", "NPI.κ₀s" or "NPI.δs.0", and is one of:
+
+    {"method": "grid", "parameters": {path: [value, ...], ...}}
+        every combination of the values
+    {"method": "lhs", "parameters": {path: [low, high], ...}, "samples": n, "seed": 0}
+        a Latin hypercube sample of n points of numeric parameters
+    {"method": "list", "members": [{path: value, ...}, ...]}
+        the given points
+"""
+import copy
+import itertools
+import json
+import os
+
+import numpy as np
+import xarray as xr
+
+from db.db import get_ensemble, get_rollup, read_ensemble_stats, store_ensemble_stats
+
+SWEEP_METHODS = ('grid', 'lhs', 'list')
+
+# The quantities that ensemble statistics are computed for, as the compartments they sum
+ENSEMBLE_QUANTITIES = {
+    'hospitalizations': ['PH', 'HR', 'HD'],
+    'infected': ['I'],
+    'deaths': ['D'],
+}
+ENSEMBLE_QUANTILES = (0.05, 0.5, 0.95)
+ENSEMBLE_STATISTICS = ['mean', 'std'] + [f"q{round(q * 100):02d}" for q in ENSEMBLE_QUANTILES]
+# The member values of a block of days held in memory at once, in bytes
+ENSEMBLE_BLOCK_BYTES = int(os.environ.get('EPISIM_ENSEMBLE_BLOCK_BYTES', 256 * 1024 ** 2))
+
+
+def _split_path(path):
+    return [int(key) if key.isdigit() else key for key in path.split('.')]
+
+
+def get_path(config, path):
+    value = config
+    for key in _split_path(path):
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            raise ValueError(f"Unknown config parameter {path}")
+    return value
+
+
+def set_path(config, path, value):
+    # sweeps only change parameters the config already has, which catches typos
+    get_path(config, path)
+    keys = _split_path(path)
+    parent = config
+    for key in keys[:-1]:
+        parent = parent[key]
+    parent[keys[-1]] = value
+
+
+def latin_hypercube(n_samples, n_dims, seed=None):
+    """A Latin hypercube sample of the unit cube: each dimension has one point in each of `n_samples` strata."""
+    rng = np.random.default_rng(seed)
+    strata = np.array([rng.permutation(n_samples) for _ in range(n_dims)]).T
+    return (strata + rng.random((n_samples, n_dims))) / n_samples
+
+
+def sweep_size(sweep):
+    """The number of members of a sweep, computed from its description so that it can be checked before expanding it."""
+    method = sweep.get('method')
+    if method == 'grid':
+        size = 1
+        for path, values in sweep['parameters'].items():
+            if not isinstance(values, list) or not values:
+                raise ValueError(f"Grid values of {path} must be a non-empty list")
+            size *= len(values)
+        return size
+    if method == 'lhs':
+        return int(sweep['samples'])
+    if method == 'list':
+        if not isinstance(sweep['members'], list):
+            raise ValueError("List members must be a list of points")
+        return len(sweep['members'])
+    raise ValueError(f"Unknown sweep method {method}, expected one of {SWEEP_METHODS}")
+
+
+def sweep_points(base_config, sweep):
+    """Returns the parameter overrides of each member of a sweep, as a list of {path: value}."""
+    method = sweep.get('method')
+    if method == 'grid':
+        parameters = sweep['parameters']
+        for path, values in parameters.items():
+            get_path(base_config, path)
+            if not isinstance(values, list) or not values:
+                raise ValueError(f"Grid values of {path} must be a non-empty list")
+        return [dict(zip(parameters, values)) for values in itertools.product(*parameters.values())]
+
+    if method == 'lhs':
+        parameters = sweep['parameters']
+        for path, bounds in parameters.items():
+            base_value = get_path(base_config, path)
+            if isinstance(base_value, bool) or not isinstance(base_value, (int, float)):
+                raise ValueError(f"Latin hypercube sampling needs a numeric parameter, {path} isn't one")
+            if not isinstance(bounds, list) or len(bounds) != 2:
+                raise ValueError(f"Bounds of {path} must be a [low, high] pair")
+        samples = latin_hypercube(int(sweep['samples']), len(parameters), sweep.get('seed'))
+        points = []
+        for sample in samples:
+            point = {}
+            for (path, (low, high)), x in zip(parameters.items(), sample):
+                value = low + x * (high - low)
+                # integer parameters, like vaccination start days, stay integers
+                point[path] = int(round(value)) if isinstance(get_path(base_config, path), int) else float(value)
+            points.append(point)
+        return points
+
+    if method == 'list':
+        points = sweep['members']
+        for point in points:
+            for path in point:
+                get_path(base_config, path)
+        return points
+
+    raise ValueError(f"Unknown sweep method {method}, expected one of {SWEEP_METHODS}")
+
+
+def expand_sweep(base_config, sweep):
+    """Returns a list of (overrides, config) pairs, one per member of the sweep."""
+    members = []
+    for point in sweep_points(base_config, sweep):
+        config = copy.deepcopy(base_config)
+        for path, value in point.items():
+            set_path(config, path, value)
+        members.append((point, config))
+    return members
+
+
+def welford_update(count, mean, m2, x):
+    """Adds the observation `x` to running element-wise means and sums of squared deviations."""
+    count += 1
+    delta = x - mean
+    mean += delta / count
+    m2 += delta * (x - mean)
+    return count, mean, m2
+
+
+def reduce_ensemble(result_ids):
+    """
+    Computes the `ENSEMBLE_STATISTICS` of the `ENSEMBLE_QUANTITIES` across the results of
+    the members of an ensemble, per region and day and for all regions together.
+
+    The by-region rollups of the members are read one block of days at a time, so memory
+    depends on the block size rather than on the number of members: means and variances are
+    accumulated member by member, and the quantiles of a block are exact since every value
+    of a (day, region) cell is in the same block.
+    """
+    members = [get_rollup(result_id, 'by_region') for result_id in result_ids]
+    first = members[0]
+    for result_id, ds in zip(result_ids, members):
+        if ds is None:
+            raise ValueError(f"Simulation {result_id} not found")
+        if not (np.array_equal(ds.T.values, first.T.values) and np.array_equal(ds.M.values, first.M.values)):
+            raise ValueError(f"Simulation {result_id} doesn't cover the same days and regions as the other members")
+
+    n_members, n_times, n_regions = len(members), first.sizes['T'], first.sizes['M']
+    block_size = max(1, ENSEMBLE_BLOCK_BYTES // (8 * n_members * (n_regions + 1) * len(ENSEMBLE_QUANTITIES)))
+
+    out = {}
+    for quantity in ENSEMBLE_QUANTITIES:
+        out[quantity] = np.empty((len(ENSEMBLE_STATISTICS), n_times, n_regions))
+        out[f"{quantity}_total"] = np.empty((len(ENSEMBLE_STATISTICS), n_times))
+
+    for start in range(0, n_times, block_size):
+        block = slice(start, start + block_size)
+        n_block = len(range(n_times)[block])
+        values = {name: np.empty((n_members, n_block) + array.shape[2:]) for name, array in out.items()}
+        running = {name: (0, np.zeros(v.shape[1:]), np.zeros(v.shape[1:])) for name, v in values.items()}
+
+        for i, ds in enumerate(members):
+            data = ds.data.isel(T=block)
+            for quantity, compartments in ENSEMBLE_QUANTITIES.items():
+                by_region = data.sel(epi_states=compartments).sum(dim='epi_states').transpose('T', 'M').values
+                for name, x in ((quantity, by_region), (f"{quantity}_total", by_region.sum(axis=1))):
+                    values[name][i] = x
+                    running[name] = welford_update(*running[name], x)
+
+        for name, (count, mean, m2) in running.items():
+            out[name][0, block] = mean
+            out[name][1, block] = np.sqrt(m2 / (count - 1)) if count > 1 else 0
+            out[name][2:, block] = np.quantile(values[name], ENSEMBLE_QUANTILES, axis=0)
+
+    coords = {'statistic': ENSEMBLE_STATISTICS, 'T': first.T.values, 'M': first.M.values}
+    variables = {}
+    for quantity in ENSEMBLE_QUANTITIES:
+        variables[quantity] = (('statistic', 'T', 'M'), out[quantity])
+        variables[f"{quantity}_total"] = (('statistic', 'T'), out[f"{quantity}_total"])
+    return xr.Dataset(variables, coords=coords, attrs={'members': json.dumps(sorted(result_ids)), 'n_members': n_members})
+
+
+def ensemble_stats(ensemble_id):
+    """
+    Returns the statistics of an ensemble across the results of its finished members, or None
+    if none has finished. They are computed once and stored, and computed again when the set
+    of member results changes, e.g. as more members finish.
+    """
+    ensemble = get_ensemble(ensemble_id)
+    if ensemble is None:
+        return None
+    # members with identical params share a result, which counts once
+    result_ids = sorted({member['result_id'] for member in ensemble['members'] if member['result_id']})
+    if not result_ids:
+        return None
+
+    stats = read_ensemble_stats(ensemble_id)
+    if stats is None or stats.attrs.get('members') != json.dumps(result_ids):
+        store_ensemble_stats(ensemble_id, reduce_ensemble(result_ids))
+        stats = read_ensemble_stats(ensemble_id)
+    return stats
@@ -1,17 +1,29 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, make_response, send_file, stream_with_context
 import json
 import os
-import tempfile
 from epi_sim import EpiSim
 from dash import Dash, html, dcc, Input, Output
 import dash_bootstrap_components as dbc
 import uuid
+import re
 import gzip
 import hashlib
-
-from db.db import create_database, store_simulation_result, store_simulation_params, get_existing_simulation_id, SIM_OUTPUT_DIR
-
-from simulation_results_dashboard import create_results_layout, register_callbacks
+import shutil
+import time
+from io import BytesIO
+
+from db.db import create_database, store_simulation_result, store_simulation_params, spool_file, store_blob, link_blob, blob_path, FileTooLargeError, get_existing_simulation_id, create_job, attach_to_active_job, get_job, partial_curves_path, result_file_path, record_result_access, create_ensemble, set_ensemble_member_job, get_ensemble, JOB_STATUSES, dataset_cache, SIM_OUTPUT_DIR
+from jobs import JobQueue
+import instrumentation
+import retention
+from inputs import INPUT_PARSERS, validate_inputs, input_summary
+from ensembles import expand_sweep, ensemble_stats, sweep_size, ENSEMBLE_QUANTITIES
+from queries import parse_query, query_result, negotiate_format, pyarrow, QueryTooLargeError, QUERY_FORMATS, QUERY_STREAMS
+
+from simulation_results_dashboard import (
+    create_results_layout, create_ensemble_layout, register_callbacks, read_view, regional_values, regional_series, region_geojson, map_center,
+    MAP_ZOOM, MAP_GEOMETRY_ZOOM, MAP_GEOMETRY_ZOOM_RANGE,
+)
 
 template_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'html'))
 static_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'static'))
@@ -20,6 +32,22 @@ app = Flask(__name__, template_folder=template_dir, static_folder=static_dir)
 app.config['DATA_FOLDER'] = os.path.join(os.path.dirname(__file__), os.pardir, "models/mitma")
 app.config['INSTANCE_FOLDER'] = os.path.join(os.path.dirname(__file__), os.pardir, "runs")
 app.config['SIM_OUTPUT_DIR'] = SIM_OUTPUT_DIR
+app.config['SIMULATION_WORKERS'] = int(os.environ.get('EPISIM_SIMULATION_WORKERS', 2))
+app.config['WORKER_MAX_RUNS'] = int(os.environ.get('EPISIM_WORKER_MAX_RUNS', 20))
+# Seconds between checks for news of a job, in its event stream
+app.config['JOB_EVENTS_INTERVAL'] = float(os.environ.get('EPISIM_JOB_EVENTS_INTERVAL', 1))
+app.config['MAX_ENSEMBLE_MEMBERS'] = int(os.environ.get('EPISIM_MAX_ENSEMBLE_MEMBERS', 1000))
+# Size limits of uploads: the whole request, each input file of a run,
+# and an uploaded result once decompressed
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('EPISIM_MAX_UPLOAD_BYTES', 8 * 1024 ** 3))
+app.config['MAX_INPUT_FILE_BYTES'] = int(os.environ.get('EPISIM_MAX_INPUT_FILE_BYTES', 2 * 1024 ** 3))
+app.config['MAX_RESULT_FILE_BYTES'] = int(os.environ.get('EPISIM_MAX_RESULT_FILE_BYTES', 32 * 1024 ** 3))
+# Seconds between passes of retention over the stored results, 0 to only run it with src/retention.py
+app.config['RETENTION_INTERVAL'] = float(os.environ.get('EPISIM_RETENTION_INTERVAL', 0))
+
+instrumentation.init_app(app)
+
+job_queue = JobQueue(app.config['SIMULATION_WORKERS'], app.config['WORKER_MAX_RUNS'])
 
 dash_app = Dash(
     __name__,
@@ -54,12 +82,37 @@ def home():
     return render_template('index.html', component='Home', bundle='home.bundle.js')
 
 
+@app.route('/dataset_cache_stats')
+def dataset_cache_stats():
+    return jsonify(dataset_cache.stats())
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Metrics in the Prometheus text format: the dataset cache and the engine workers, and with
+    EPISIM_INSTRUMENTATION=1 the requests served and the stages they spent their time in.
+    """
+    cache = dataset_cache.stats()
+    workers = job_queue.stats()
+    families = [
+        ('episim_dataset_cache_entries', 'gauge', "Datasets in the cache", [('', {}, cache['entries'])]),
+        ('episim_dataset_cache_bytes', 'gauge', "Memory held by cached datasets", [('', {}, cache['current_bytes'])]),
+        ('episim_dataset_cache_max_bytes', 'gauge', "Memory budget of the dataset cache", [('', {}, cache['max_bytes'])]),
+        ('episim_dataset_cache_max_entries', 'gauge', "Most datasets the cache keeps", [('', {}, cache['max_entries'])]),
+    ]
+    for name in ('hits', 'misses', 'evictions', 'invalidations'):
+        families.append((f"episim_dataset_cache_{name}_total", 'counter', f"Dataset cache {name}", [('', {}, cache[name])]))
+    families.append(('episim_engine_workers_busy', 'gauge', "Engine workers running a job", [('', {}, workers['busy'])]))
+    families.append(('episim_engine_workers_idle', 'gauge', "Idle engine workers", [('', {}, workers['idle'])]))
+    return Response(instrumentation.render_metrics(families), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/check_file_exists', methods=['POST'])
 def check_file_exists():
     filename = request.json.get('filename')
     file_id = filename.split('.')[0]  # Assuming filename is in the format "uuid.extension"
-    file_path = os.path.join(app.config['SIM_OUTPUT_DIR'], f"{file_id}.nc.gz")
-    exists = os.path.exists(file_path)
+    exists = result_file_path(file_id) is not None
     return jsonify({"exists": exists, "file_id": file_id})
 
 @app.route('/upload_simulation', methods=['POST'])
@@ -69,16 +122,31 @@ def upload_simulation():
     file = request.files['simulation_file']
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
-    if file:
-        if file.filename.endswith('.gz'):
-            contents = gzip.decompress(file.read())
-        else:
-            contents = file.read()
 
-        file_id = request.form.get('file_id', str(uuid.uuid4()))
-        store_simulation_result(file_id, contents)
-        return jsonify({"status": "success", "file_id": file_id}), 200
-    return jsonify({"error": "Unknown error"}), 500
+    file_id = request.form.get('file_id') or str(uuid.uuid4())
+    if not re.fullmatch(r'[\w-]+', file_id):
+        return jsonify({"error": f"Invalid file id {file_id}"}), 400
+
+    # Decompress on the fly while spooling to disk, the upload is never held in memory
+    source = gzip.GzipFile(fileobj=file.stream, mode='rb') if file.filename.endswith('.gz') else file.stream
+    try:
+        tmp_path, digest = spool_file(source, app.config['SIM_OUTPUT_DIR'], app.config['MAX_RESULT_FILE_BYTES'])
+    except FileTooLargeError as e:
+        return jsonify({"error": str(e)}), 413
+    except (OSError, EOFError) as e:
+        return jsonify({"error": f"Could not decompress {file.filename}: {str(e)}"}), 400
+
+    try:
+        # uploaded results have no params, they are identified by their contents
+        store_simulation_result(file_id, tmp_path, f"upload:{digest}")
+    except (OSError, ValueError, KeyError) as e:
+        return jsonify({"error": f"Not a valid simulation result: {str(e)}"}), 400
+    except Exception as e:
+        app.logger.error(f"Error storing uploaded simulation {file_id}: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        os.remove(tmp_path)
+    return jsonify({"status": "success", "file_id": file_id}), 200
 
 
 def write_json_to_data_folder(data, filename):
@@ -87,98 +155,546 @@ def write_json_to_data_folder(data, filename):
         json.dump(data, f, indent=4)
     return file_path
 
+# The input files of a run, by form field, and the names the engine expects them under
+INPUT_FILES = {
+    'mobility_reduction': 'kappa0_from_mitma.csv',
+    'mobility_matrix': 'R_mobility_matrix.csv',
+    'metapop': 'metapopulation_data.csv',
+    'init_conditions': 'initial_conditions.nc',
+}
+
+def store_input_files():
+    """
+    Stores the input files of the request in the blob store, each file once however many
+    runs use it. They are hashed while being copied, in chunks, whatever their size.
+    Returns the digests by the file names the engine expects.
+    """
+    return {
+        filename: store_blob(request.files[field].stream, app.config['MAX_INPUT_FILE_BYTES'])
+        for field, filename in INPUT_FILES.items()
+    }
+
+def store_run_config(config, input_blobs):
+    """Adds `config` to the input files of a run. Returns the files of the run and the hash of its params."""
+    params_blobs = {'config.json': store_blob(BytesIO(json.dumps(config).encode())), **input_blobs}
+    return params_blobs, calculate_params_hash(config, params_blobs)
+
+def submit_run(params_blobs, params_hash, backend_engine):
+    """
+    Queues a run of the params, unless a run of identical params is in flight already,
+    in which case it is shared. Returns the id of the job and whether it is shared, or
+    (None, True) if the identical run has just finished.
+    """
+    # Identical submissions share the run that is already in flight
+    job_id = attach_to_active_job(params_hash)
+    if job_id is not None:
+        return job_id, True
+
+    store_simulation_params(params_blobs, params_hash)
+
+    job_id = str(uuid.uuid4())
+    work_dir = os.path.join(app.config['INSTANCE_FOLDER'], job_id)
+    os.makedirs(work_dir)
+
+    # Link the inputs into the job's work dir,
+    # the worker process picks them up from there
+    for filename, digest in params_blobs.items():
+        link_blob(digest, os.path.join(work_dir, filename))
+
+    if create_job(job_id, params_hash, backend_engine, work_dir):
+        job_queue.submit(job_id)
+        return job_id, False
+
+    # an identical submission created its job while we were writing the inputs
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return attach_to_active_job(params_hash), True
+
 @app.route('/run_simulation', methods=['POST'])
 def server_run_simulation():
+    missing = [field for field in ('config', 'backend_engine') if field not in request.form]
+    missing += [field for field in INPUT_FILES if field not in request.files]
+    if missing:
+        return jsonify({"status": "error", "message": f"Missing fields: {', '.join(missing)}"}), 400
+
     try:
         config = json.loads(request.form['config'])
-        mobility_reduction = request.files.get('mobility_reduction')
-        mobility_matrix = request.files.get('mobility_matrix')
-        metapop = request.files.get('metapop')
-        init_conditions = request.files.get('init_conditions')
         backend_engine = request.form['backend_engine']
 
-        # Calculate hash of the params
-        params_hash = calculate_params_hash(config, mobility_reduction, mobility_matrix, metapop, init_conditions)
+        input_blobs = store_input_files()
+        # Parsed into their binary form once per distinct file, not per run
+        errors = validate_inputs(input_blobs)
+        if errors:
+            return jsonify({"status": "error", "message": "Invalid input files", "errors": errors}), 400
+
+        params_blobs, params_hash = store_run_config(config, input_blobs)
 
         # Check if the hash already exists in the database
         existing_id = get_existing_simulation_id(params_hash)
-        print(f"existing_id: {existing_id}")
         if existing_id:
             return redirect(f"/dash/results/{existing_id}")
 
-        # Create a temporary directory
-        with tempfile.TemporaryDirectory(prefix='EpiSim_') as temp_dir:
-            # Write payload contents to files in the temporary directory
-            config_fp = os.path.join(temp_dir, 'config.json')
-            mobility_reduction_fp = os.path.join(temp_dir, 'kappa0_from_mitma.csv')
-            mobility_matrix_fp = os.path.join(temp_dir, 'R_mobility_matrix.csv')
-            metapop_fp = os.path.join(temp_dir, 'metapopulation_data.csv')
-            init_conditions_fp = os.path.join(temp_dir, 'initial_conditions.nc')
-
-            with open(config_fp, 'w') as f:
-                json.dump(config, f)
-            mobility_reduction.save(mobility_reduction_fp)
-            mobility_matrix.save(mobility_matrix_fp)
-            metapop.save(metapop_fp)
-            init_conditions.save(init_conditions_fp)
-
-            # Store simulation params
-            params_files = {
-                'config.json': open(config_fp, 'rb'),
-                'kappa0_from_mitma.csv': open(mobility_reduction_fp, 'rb'),
-                'R_mobility_matrix.csv': open(mobility_matrix_fp, 'rb'),
-                'metapopulation_data.csv': open(metapop_fp, 'rb'),
-                'initial_conditions.nc': open(init_conditions_fp, 'rb')
-            }
-            
-            # the data and instance folder are the same for now
-            # because we put the output into sqlite anyway
-            model = (
-                EpiSim(config_fp, temp_dir, temp_dir, init_conditions_fp)
-                .setup('compiled')
-                .set_backend_engine(backend_engine)
-            )
-
-            assert os.path.exists(model.model_state_folder), f"model.model_state_folder {model.model_state_folder} does not exist"
-
-            # Run the model
-            id, _ = model.run_model()
-
-            # Read the model output
-            output_file = os.path.join(model.model_state_folder, "output", "compartments_full.nc")
-            assert os.path.exists(output_file), f"Output file {output_file} does not exist"
-            
-            with open(output_file, 'rb') as f:
-                output_data = f.read()
-
-            assert output_data is not None, f"output_data is None"
-
-            # Store params in the database
-            store_simulation_params(params_files, params_hash)
-
-
-            # Store the simulation result
-            store_simulation_result(id, output_data, params_hash)
-
-            return jsonify({
-                "status": "success", 
-                "message": "Simulation completed and stored", 
-                "uuid": id,
-                "params_hash": params_hash,
-                "redirect": f"/dash/results/{id}"
-            }), 200
-
+        job_id, attached = submit_run(params_blobs, params_hash, backend_engine)
+        if job_id is None:
+            # the identical run has finished already
+            existing_id = get_existing_simulation_id(params_hash)
+            if existing_id:
+                return redirect(f"/dash/results/{existing_id}")
+            return jsonify({"status": "error", "message": "An identical simulation has just failed"}), 409
+
+        return jsonify({
+            "status": "queued",
+            "message": "Attached to an identical simulation in progress" if attached else "Simulation queued",
+            "job_id": job_id,
+            "attached": attached,
+            "params_hash": params_hash,
+            "status_url": f"/jobs/{job_id}",
+            "events_url": f"/jobs/{job_id}/events",
+            "live_url": f"/jobs/{job_id}/live"
+        }), 202
+
+    except FileTooLargeError as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
     except Exception as e:
         app.logger.error(f"Error in run_simulation: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
 
-def calculate_params_hash(config, *files):
+@app.route('/ensembles', methods=['POST'])
+def run_ensemble():
+    """
+    Runs a sweep over the params of a base config, given as the `sweep` field (see
+    ensembles.py) next to the fields of /run_simulation. Members whose params already
+    have a result, or a run in flight, reuse it. The members run on the job queue's
+    workers, as many at a time as there are workers.
+    """
+    missing = [field for field in ('config', 'backend_engine', 'sweep') if field not in request.form]
+    missing += [field for field in INPUT_FILES if field not in request.files]
+    if missing:
+        return jsonify({"status": "error", "message": f"Missing fields: {', '.join(missing)}"}), 400
+
+    try:
+        config = json.loads(request.form['config'])
+        sweep = json.loads(request.form['sweep'])
+        backend_engine = request.form['backend_engine']
+        # checked before expanding, a grid over a few long lists has a lot of members
+        size = sweep_size(sweep)
+        if not 0 < size <= app.config['MAX_ENSEMBLE_MEMBERS']:
+            return jsonify({"status": "error", "message": f"An ensemble has between 1 and {app.config['MAX_ENSEMBLE_MEMBERS']} members, this one has {size}"}), 400
+        members = expand_sweep(config, sweep)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return jsonify({"status": "error", "message": f"Invalid sweep: {str(e)}"}), 400
+
+    try:
+        input_blobs = store_input_files()
+        errors = validate_inputs(input_blobs)
+        if errors:
+            return jsonify({"status": "error", "message": "Invalid input files", "errors": errors}), 400
+
+        runs = [store_run_config(member_config, input_blobs) for _, member_config in members]
+        ensemble_id = str(uuid.uuid4())
+        create_ensemble(ensemble_id, backend_engine, sweep, [(params_hash, overrides) for (overrides, _), (_, params_hash) in zip(members, runs)])
+
+        for i, (params_blobs, params_hash) in enumerate(runs):
+            if get_existing_simulation_id(params_hash):
+                continue
+            job_id, _ = submit_run(params_blobs, params_hash, backend_engine)
+            set_ensemble_member_job(ensemble_id, i, job_id)
+
+        return jsonify({
+            "status": "queued",
+            "ensemble_id": ensemble_id,
+            "members": len(members),
+            "status_url": f"/ensembles/{ensemble_id}"
+        }), 202
+
+    except FileTooLargeError as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
+    except Exception as e:
+        app.logger.error(f"Error in run_ensemble: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/ensembles/<ensemble_id>')
+def ensemble_status(ensemble_id):
+    ensemble = get_ensemble(ensemble_id)
+    if ensemble is None:
+        return jsonify({"status": "error", "message": f"Ensemble {ensemble_id} not found"}), 404
+
+    counts = {status: 0 for status in ('pending',) + JOB_STATUSES}
+    for member in ensemble['members']:
+        counts[member['status']] += 1
+    finished = counts['done'] + counts['failed'] + counts['cancelled']
+    ensemble['progress'] = {
+        "total": len(ensemble['members']),
+        "finished": finished,
+        "fraction": finished / len(ensemble['members']) if ensemble['members'] else 1.0,
+        **counts,
+    }
+    ensemble['status'] = 'done' if finished == len(ensemble['members']) else 'running'
+    ensemble['dashboard_url'] = f"/dash/ensembles/{ensemble_id}"
+    ensemble['stats_url'] = f"/api/ensembles/{ensemble_id}/stats"
+    return jsonify(ensemble), 200
+
+@app.route('/api/ensembles/<ensemble_id>/stats')
+def ensemble_statistics(ensemble_id):
+    """
+    The mean, standard deviation and 5/50/95% quantiles of a quantity across the finished
+    members of an ensemble, per day, for a region or, without one, for all regions together.
+    """
+    quantity = request.args.get('quantity', 'hospitalizations')
+    region = request.args.get('region')
+    if quantity not in ENSEMBLE_QUANTITIES:
+        return jsonify({"status": "error", "message": f"Unknown quantity {quantity}, expected one of {list(ENSEMBLE_QUANTITIES)}"}), 400
+    if get_ensemble(ensemble_id) is None:
+        return jsonify({"status": "error", "message": f"Ensemble {ensemble_id} not found"}), 404
+
+    stats = ensemble_stats(ensemble_id)
+    if stats is None:
+        return jsonify({"status": "error", "message": f"No member of ensemble {ensemble_id} has finished yet"}), 409
+    if region is not None and region not in stats.M.values:
+        return jsonify({"status": "error", "message": f"Unknown region {region}"}), 400
+
+    values = stats[quantity].sel(M=region) if region is not None else stats[f"{quantity}_total"]
+    return jsonify({
+        "quantity": quantity,
+        "region": region,
+        "members": int(stats.attrs['n_members']),
+        "times": [str(t)[:10] for t in stats.T.values],
+        "statistics": {str(name): values.sel(statistic=name).values.tolist() for name in stats.statistic.values},
+    }), 200
+
+@app.route('/ensembles/<ensemble_id>/cancel', methods=['POST'])
+def cancel_ensemble(ensemble_id):
+    ensemble = get_ensemble(ensemble_id)
+    if ensemble is None:
+        return jsonify({"status": "error", "message": f"Ensemble {ensemble_id} not found"}), 404
+    # each member withdraws its own submission, runs shared with others carry on
+    outcomes = {}
+    for member in ensemble['members']:
+        if member['status'] in ('queued', 'running'):
+            outcomes[member['member_index']] = job_queue.cancel(member['job_id'])
+    return jsonify({"status": "cancelled", "ensemble_id": ensemble_id, "members": outcomes}), 200
+
+@app.route('/api/inputs/<field>', methods=['POST'])
+def upload_input(field):
+    """
+    Stores one input file of a run ahead of submitting it, and returns its digest
+    together with a preview and the problems found in it.
+    """
+    filename = INPUT_FILES.get(field)
+    if filename not in INPUT_PARSERS:
+        return jsonify({"status": "error", "message": f"No preview for input {field}"}), 404
+    if 'file' not in request.files:
+        return jsonify({"status": "error", "message": "No file part"}), 400
+    try:
+        digest = store_blob(request.files['file'].stream, app.config['MAX_INPUT_FILE_BYTES'])
+    except FileTooLargeError as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
+
+    errors = validate_inputs({filename: digest})
+    return jsonify({
+        "digest": digest,
+        "errors": errors,
+        "summary": None if errors else input_summary(digest, filename),
+    }), 200
+
+@app.route('/api/inputs/<field>/<digest>')
+def input_preview(field, digest):
+    filename = INPUT_FILES.get(field)
+    if filename not in INPUT_PARSERS:
+        return jsonify({"status": "error", "message": f"No preview for input {field}"}), 404
+    if not re.fullmatch(r'[0-9a-f]{64}', digest) or not os.path.exists(blob_path(digest)):
+        return jsonify({"status": "error", "message": f"Input file {digest} not found"}), 404
+    try:
+        return jsonify(input_summary(digest, filename)), 200
+    except (KeyError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"Could not parse the input file: {str(e)}"}), 400
+
+def job_summary(job):
+    del job['work_dir']
+    if job['status'] == 'done':
+        job['redirect'] = f"/dash/results/{job['result_id']}"
+    return job
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Job {job_id} not found"}), 404
+    return jsonify(job_summary(job)), 200
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Server-Sent Events of a job: a `status` event on every change of its status, and while it
+    runs, a `progress` event with the totals of each compartment over the days computed so far
+    whenever more days are. The stream ends once the job has finished.
+    """
+    if get_job(job_id) is None:
+        return jsonify({"status": "error", "message": f"Job {job_id} not found"}), 404
+
+    def events():
+        last_status = last_progress = None
+        last_sent = time.monotonic()
+        while True:
+            job = job_summary(get_job(job_id))
+
+            curves_path = partial_curves_path(job_id)
+            try:
+                progress = os.stat(curves_path).st_mtime_ns
+                if progress != last_progress:
+                    with open(curves_path) as f:
+                        yield f"event: progress\ndata: {f.read()}\n\n"
+                    last_progress, last_sent = progress, time.monotonic()
+            except FileNotFoundError:
+                # not started yet, or just finished
+                pass
+
+            if job['status'] != last_status:
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
+                last_status, last_sent = job['status'], time.monotonic()
+            if job['status'] not in ('queued', 'running'):
+                return
+
+            if time.monotonic() - last_sent > 15:
+                # keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(app.config['JOB_EVENTS_INTERVAL'])
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/jobs/<job_id>/live')
+def job_live(job_id):
+    if get_job(job_id) is None:
+        return jsonify({"status": "error", "message": f"Job {job_id} not found"}), 404
+    return render_template('job_progress.html', job_id=job_id, events_url=url_for('job_events', job_id=job_id))
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if get_job(job_id) is None:
+        return jsonify({"status": "error", "message": f"Job {job_id} not found"}), 404
+    outcome = job_queue.cancel(job_id)
+    if outcome is None:
+        return jsonify({"status": "error", "message": f"Job {job_id} has already finished"}), 409
+    return jsonify({"status": outcome, "job_id": job_id}), 200
+
+@app.route('/map/<simulation_id>')
+def results_map(simulation_id):
+    compartment = request.args.get('compartment', 'I')
+    return render_template(
+        'choropleth.html',
+        center=list(map_center()),
+        zoom=MAP_ZOOM,
+        geometry_url=url_for('regions_geojson', zoom=MAP_GEOMETRY_ZOOM),
+        values_url=url_for('result_region_values', simulation_id=simulation_id, compartment=compartment),
+        meta_url=url_for('result_region_meta', simulation_id=simulation_id),
+        series_url=url_for('result_region_series', simulation_id=simulation_id, compartment=compartment),
+        compartment=compartment,
+    )
+
+@app.route('/geo/regions.geojson')
+def regions_geojson():
+    zoom = request.args.get('zoom', MAP_GEOMETRY_ZOOM, type=int)
+    zoom = min(max(zoom, MAP_GEOMETRY_ZOOM_RANGE[0]), MAP_GEOMETRY_ZOOM_RANGE[1])
+    body, gzipped_body, etag = region_geojson(zoom)
+
+    # The geometry never changes while the server runs, so clients can cache it
+    if 'gzip' in request.accept_encodings:
+        response = make_response(gzipped_body)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = make_response(body)
+    response.content_type = 'application/geo+json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
+@app.route('/api/results/<simulation_id>/regions')
+def result_region_values(simulation_id):
+    compartment = request.args.get('compartment', 'I')
+    t = request.args.get('t', -1, type=int)
+
+    ds = read_view(simulation_id, kept_dims={'M'})
+    if ds is None:
+        return jsonify({"status": "error", "message": f"Simulation {simulation_id} not found"}), 404
+    if compartment not in ds.epi_states.values:
+        return jsonify({"status": "error", "message": f"Unknown compartment {compartment}"}), 400
+    if not -len(ds.T) <= t < len(ds.T):
+        return jsonify({"status": "error", "message": f"Time index {t} out of range"}), 400
+
+    with instrumentation.stage('regions.reduce'):
+        values = regional_values(ds, compartment, t)
+    return jsonify({
+        "compartment": compartment,
+        "t": t % len(ds.T),
+        "time": str(ds.T.values[t])[:10],
+        "min": float(min(values.min(), 0)),
+        "max": float(values.max()),
+        "values": {str(region): float(value) for region, value in values.items()},
+    })
+
+@app.route('/api/results/<simulation_id>/regions/meta')
+def result_region_meta(simulation_id):
+    ds = read_view(simulation_id, kept_dims={'M'})
+    if ds is None:
+        return jsonify({"status": "error", "message": f"Simulation {simulation_id} not found"}), 404
+    return jsonify({
+        "regions": [str(region) for region in ds.M.values],
+        "times": [str(t)[:10] for t in ds.T.values],
+        "compartments": [str(c) for c in ds.epi_states.values],
+    })
+
+@app.route('/api/results/<simulation_id>/query')
+def query_results(simulation_id):
+    """
+    A slice of a result, summed over some dimensions, e.g.
+    ?epi_states=I,R&M=08019&start=2020-03-10&end=2020-04-10&sum=G,V&format=csv
+    Streamed as JSON (the default), CSV or Arrow, by `format` or the Accept header.
+    """
+    try:
+        answer_format = negotiate_format(request.args.get('format'), request.accept_mimetypes)
+        selections, start, end, sum_dims = parse_query(request.args)
+        data = query_result(simulation_id, selections, start, end, sum_dims)
+    except QueryTooLargeError as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if data is None:
+        return jsonify({"status": "error", "message": f"Simulation {simulation_id} not found"}), 404
+    if answer_format == 'arrow' and pyarrow is None:
+        return jsonify({"status": "error", "message": "Arrow answers need pyarrow, which isn't installed"}), 406
+
+    response = Response(QUERY_STREAMS[answer_format](data, sum_dims), mimetype=QUERY_FORMATS[answer_format])
+    if answer_format != 'json':
+        extension = 'arrows' if answer_format == 'arrow' else answer_format
+        response.headers['Content-Disposition'] = f'attachment; filename="{simulation_id}.{extension}"'
+    return response
+
+# Whole-file compressed results, by extension: the Content-Encoding they can be sent
+# with, if browsers have one for them, and their type as a file
+DOWNLOAD_ENCODINGS = {
+    '.gz': ('gzip', 'application/gzip'),
+    '.zst': ('zstd', 'application/zstd'),
+    '.xz': (None, 'application/x-xz'),
+}
+
+@app.route('/api/results/<simulation_id>/download')
+def download_result(simulation_id):
+    """
+    The stored result file, served straight from disk with support for Range requests, so
+    downloads can be resumed, and for conditional requests by ETag and Last-Modified.
+    Whole-file compressed results (legacy and cold ones) are passed through as they are: with
+    a Content-Encoding to clients that accept it, as a compressed file to the others, never
+    decompressed on the server.
+    """
+    file_path = result_file_path(simulation_id)
+    if file_path is None or not os.path.exists(file_path):
+        return jsonify({"status": "error", "message": f"Simulation {simulation_id} not found"}), 404
+    record_result_access(simulation_id)
+
+    stat = os.stat(file_path)
+    codec = os.path.splitext(file_path)[1]
+    content_encoding, compressed_mimetype = DOWNLOAD_ENCODINGS.get(codec, (None, None))
+    if content_encoding is not None and content_encoding not in request.accept_encodings:
+        content_encoding = None
+    # each representation of the file gets its own ETag, as Range requests are over the encoded bytes
+    etag = hashlib.sha256(f"{file_path}:{stat.st_mtime_ns}:{stat.st_size}:{content_encoding}".encode()).hexdigest()
+
+    if compressed_mimetype is not None and content_encoding is None:
+        mimetype, download_name = compressed_mimetype, f"{simulation_id}.nc{codec}"
+    else:
+        mimetype, download_name = 'application/x-netcdf', f"{simulation_id}.nc"
+    response = send_file(
+        file_path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+        conditional=True, etag=etag, last_modified=stat.st_mtime,
+    )
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    if compressed_mimetype is not None:
+        response.headers['Vary'] = 'Accept-Encoding'
+    # uploads can replace the result stored under an id, so clients revalidate
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = None
+    return response
+
+def encoded_region_series(simulation_id, compartment, signature):
+    """
+    The series of a compartment as raw and gzipped buffers, and its shape. Kept in `dataset_cache`
+    under the signature of the result file, so they count against its budget and a rewritten
+    result is encoded again.
+    """
+    def encode():
+        ds = read_view(simulation_id, kept_dims={'M'})
+        if ds is None:
+            return None
+        with instrumentation.stage('regions.reduce'):
+            series = regional_series(ds, compartment)
+        body = series.tobytes()
+        with instrumentation.stage('regions.gzip'):
+            gzipped_body = gzip.compress(body, 6)
+        return body, gzipped_body, series.shape
+
+    return dataset_cache.get_or_load(
+        f"{simulation_id}:series:{compartment}", signature, encode,
+        lambda encoded: len(encoded[0]) + len(encoded[1]),
+    )
+
+@app.route('/api/results/<simulation_id>/regions/series')
+def result_region_series(simulation_id):
+    """
+    The values of a compartment per region and day as a raw little-endian float32 buffer
+    of shape (M, T), row-major. Region and day labels are served by the meta endpoint.
+    """
+    compartment = request.args.get('compartment', 'I')
+    not_found = jsonify({"status": "error", "message": f"Simulation {simulation_id} not found"}), 404
+    file_path = result_file_path(simulation_id)
+    if file_path is None:
+        return not_found
+    ds = read_view(simulation_id, kept_dims={'M'})
+    # the result can be gone from disk, e.g. removed by retention
+    if ds is None:
+        return not_found
+    if compartment not in ds.epi_states.values:
+        return jsonify({"status": "error", "message": f"Unknown compartment {compartment}"}), 400
+
+    stat = os.stat(file_path)
+    signature = (file_path, stat.st_mtime_ns, stat.st_size)
+    etag = hashlib.sha256(f"{file_path}:{stat.st_mtime_ns}:{stat.st_size}:{compartment}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    encoded = encoded_region_series(simulation_id, compartment, signature)
+    if encoded is None:
+        return not_found
+    body, gzipped_body, shape = encoded
+    if 'gzip' in request.accept_encodings:
+        response = make_response(gzipped_body)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = make_response(body)
+    response.content_type = 'application/octet-stream'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['X-Array-Dtype'] = '<f4'
+    response.headers['X-Array-Shape'] = ','.join(str(n) for n in shape)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def calculate_params_hash(config, params_blobs):
+    """
+    Hashes the config (independently of key order) together with the digests of the
+    input files, which the blob store has already computed.
+    """
     hasher = hashlib.sha256()
     hasher.update(json.dumps(config, sort_keys=True).encode())
-    for file in files:
-        file.seek(0)
-        hasher.update(file.read())
-        file.seek(0)
+    for filename in INPUT_FILES.values():
+        hasher.update(params_blobs[filename].encode())
     return hasher.hexdigest()
 
 @dash_app.callback(Output('page-content', 'children'),
@@ -187,6 +703,8 @@ def display_page(pathname):
     if pathname.startswith('/dash/results/'):
         simulation_id = pathname.split('/')[-1]
         return create_results_layout(simulation_id)
+    if pathname.startswith('/dash/ensembles/'):
+        return create_ensemble_layout(pathname.split('/')[-1])
     # ... handle other routes ...
 
 # Register the callbacks from simulation_results_dashboard
@@ -194,4 +712,9 @@ register_callbacks(dash_app)
 
 if __name__ == '__main__':
     create_database()
+    # with the reloader on, only the child process that serves requests owns the workers and retention
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        job_queue.start()
+        if app.config['RETENTION_INTERVAL'] > 0:
+            retention.start_retention_thread(app.config['RETENTION_INTERVAL'], retention.RetentionPolicy(), app.logger)
     app.run(debug=True, port=5000)
\ No newline at end of file
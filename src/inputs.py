@@ -0,0 +1,155 @@
+"""
+Binary forms of the CSV input files of a run.
+
+Each input file is parsed once, the first time its blob is used, into a `.npz` file
+stored next to the blob and so keyed by the same content hash. Validation and previews
+load the arrays from there instead of parsing the CSV text again.
+"""
+import functools
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from db.db import blob_path
+
+# The tolerance on the rows of the mobility matrix summing to 1
+ROW_SUM_TOLERANCE = 1e-4
+
+
+def parse_mobility_matrix(file_path):
+    """
+    Parses the COO list of (source_idx, target_idx, ratio) of the mobility matrix, with
+    1-based region indices, into the arrays of a CSR matrix with 0-based indices.
+    """
+    coo = pd.read_csv(file_path, dtype={'source_idx': np.int32, 'target_idx': np.int32, 'ratio': np.float64})
+    source = coo['source_idx'].values - 1
+    target = coo['target_idx'].values - 1
+    n = int(max(source.max(), target.max())) + 1 if len(coo) else 0
+
+    order = np.lexsort((target, source))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source, minlength=n), out=indptr[1:])
+    return {
+        'indptr': indptr,
+        'indices': target[order].astype(np.int32),
+        'data': coo['ratio'].values[order],
+        'shape': np.array([n, n], dtype=np.int64),
+    }
+
+
+def parse_metapopulation(file_path):
+    df = pd.read_csv(file_path, dtype={'id': str})
+    arrays = {'id': df['id'].to_numpy(dtype=str)}
+    for column in ('area', 'Y', 'M', 'O', 'Total'):
+        arrays[column] = df[column].values
+    return arrays
+
+
+def parse_mobility_reduction(file_path):
+    df = pd.read_csv(file_path, dtype={'date': str})
+    return {
+        'date': pd.to_datetime(df['date']).to_numpy().astype('datetime64[D]'),
+        'reduction': df['reduction'].values.astype(np.float64),
+        'time': df['time'].values.astype(np.int64),
+    }
+
+
+# The parsers of the input files, by the name the engine expects them under
+INPUT_PARSERS = {
+    'R_mobility_matrix.csv': parse_mobility_matrix,
+    'metapopulation_data.csv': parse_metapopulation,
+    'kappa0_from_mitma.csv': parse_mobility_reduction,
+}
+
+
+def binary_input_path(digest):
+    return f"{blob_path(digest)}.npz"
+
+
+@functools.lru_cache(maxsize=16)
+def load_input(digest, filename):
+    """
+    Returns the arrays of an input file stored in the blob store under `digest`,
+    converting it to its binary form on first use.
+    """
+    file_path = binary_input_path(digest)
+    if not os.path.exists(file_path):
+        arrays = INPUT_PARSERS[filename](blob_path(digest))
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp.npz"
+        np.savez(tmp_path, allow_pickle=False, **arrays)
+        os.replace(tmp_path, file_path)
+
+    with np.load(file_path) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    for array in arrays.values():
+        # shared by every caller through the cache
+        array.flags.writeable = False
+    return arrays
+
+
+def validate_inputs(params_blobs):
+    """
+    Checks the input files of a run, and against each other, converting them to
+    their binary form if they haven't been already. Returns a list of the problems found, empty if there are none.
+    """
+    errors = []
+    mobility = metapop = reduction = None
+    try:
+        if 'R_mobility_matrix.csv' in params_blobs:
+            mobility = load_input(params_blobs['R_mobility_matrix.csv'], 'R_mobility_matrix.csv')
+        if 'metapopulation_data.csv' in params_blobs:
+            metapop = load_input(params_blobs['metapopulation_data.csv'], 'metapopulation_data.csv')
+        if 'kappa0_from_mitma.csv' in params_blobs:
+            reduction = load_input(params_blobs['kappa0_from_mitma.csv'], 'kappa0_from_mitma.csv')
+    except (KeyError, ValueError) as e:
+        return [f"Could not parse the input files: {str(e)}"]
+
+    if mobility is not None:
+        data = mobility['data']
+        if np.any((data < 0) | (data > 1)):
+            errors.append("Mobility matrix ratios must be between 0 and 1")
+        out_degree = np.diff(mobility['indptr'])
+        rows = np.repeat(np.arange(len(out_degree)), out_degree)
+        row_sums = np.bincount(rows, weights=data, minlength=len(out_degree))
+        if np.any(np.abs(row_sums[out_degree > 0] - 1) > ROW_SUM_TOLERANCE):
+            errors.append("Mobility matrix rows must sum to 1")
+
+    if metapop is not None:
+        if np.any(metapop['Y'] + metapop['M'] + metapop['O'] != metapop['Total']):
+            errors.append("Metapopulation totals must equal the sum of the Y, M and O populations")
+        if mobility is not None and mobility['shape'][0] > len(metapop['id']):
+            errors.append(
+                f"Mobility matrix refers to {mobility['shape'][0]} regions, "
+                f"but the metapopulation has {len(metapop['id'])}"
+            )
+
+    if reduction is not None and np.any((reduction['reduction'] < 0) | (reduction['reduction'] > 1)):
+        errors.append("Mobility reductions must be between 0 and 1")
+    return errors
+
+
+def input_summary(digest, filename):
+    """A small preview of an input file, for the setup page."""
+    arrays = load_input(digest, filename)
+    if filename == 'R_mobility_matrix.csv':
+        out_degree = np.diff(arrays['indptr'])
+        return {
+            "regions": int(arrays['shape'][0]),
+            "flows": int(len(arrays['data'])),
+            "max_destinations": int(out_degree.max()) if len(out_degree) else 0,
+            "mean_destinations": float(out_degree.mean()) if len(out_degree) else 0.0,
+        }
+    if filename == 'metapopulation_data.csv':
+        return {
+            "regions": int(len(arrays['id'])),
+            "population": {group: int(arrays[group].sum()) for group in ('Y', 'M', 'O', 'Total')},
+            "area": float(arrays['area'].sum()),
+        }
+    return {
+        "start_date": str(arrays['date'][0]) if len(arrays['date']) else None,
+        "end_date": str(arrays['date'][-1]) if len(arrays['date']) else None,
+        "dates": [str(d) for d in arrays['date']],
+        "reduction": arrays['reduction'].tolist(),
+    }
@@ -0,0 +1,303 @@
+"""
+Opt-in instrumentation of requests, enabled with EPISIM_INSTRUMENTATION=1.
+
+Requests are traced through the stages they go through (opening and decompressing results,
+reducing them, building figures, encoding responses), the bytes they read and decompress
+and their dataset cache hits. Each response carries its trace in a `Server-Timing` header,
+which browsers show next to the request in their developer tools, and an `X-Request-Id`.
+The totals across requests are exported by /metrics in the Prometheus text format.
+
+With EPISIM_PROFILE_SLOW_REQUESTS=<seconds> as well, the stacks of each request's thread are
+sampled while it runs, and those of requests slower than that are written to
+EPISIM_PROFILE_DIR in the folded format of flamegraph.pl, which speedscope also reads.
+"""
+import collections
+import functools
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+from db.db import add_instrumentation_listener
+
+ENABLED = os.environ.get('EPISIM_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+PROFILE_SLOW_REQUEST_SECONDS = float(os.environ.get('EPISIM_PROFILE_SLOW_REQUESTS', 0))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('EPISIM_PROFILE_SAMPLE_INTERVAL', 0.005))
+PROFILE_DIR = os.environ.get('EPISIM_PROFILE_DIR', os.path.join(os.path.dirname(__file__), os.pardir, 'profiles'))
+
+REQUEST_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Trace:
+    """What one request spent: seconds per stage, and bytes and events per name."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.seconds = collections.defaultdict(float)
+        self.values = collections.defaultdict(int)
+        self.read_start = _thread_bytes_read()
+
+    def server_timing(self, total):
+        metrics = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.seconds.items()]
+        metrics += [f'{name};desc="{value}"' for name, value in self.values.items()]
+        metrics.append(f"total;dur={total * 1000:.1f}")
+        return ', '.join(metrics)
+
+
+class Metrics:
+    """The totals of all requests and stages since the process started."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_seconds = collections.defaultdict(lambda: [0.0, 0])
+        self.values = collections.defaultdict(lambda: collections.defaultdict(int))
+        self.requests = collections.defaultdict(int)
+        self.request_seconds = collections.defaultdict(lambda: [0] * len(REQUEST_SECONDS_BUCKETS) + [0.0, 0])
+
+    def record(self, kind, name, value):
+        with self._lock:
+            if kind == 'seconds':
+                totals = self.stage_seconds[name]
+                totals[0] += value
+                totals[1] += 1
+            else:
+                self.values[kind][name] += value
+
+    def observe_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            histogram = self.request_seconds[endpoint]
+            for i, bound in enumerate(REQUEST_SECONDS_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def families(self):
+        """The metrics as (name, type, help, [(suffix, labels, value), ...]), see `render_metrics`."""
+        with self._lock:
+            families = [
+                ('episim_requests_total', 'counter', "Requests served",
+                 [('', {'endpoint': e, 'method': m, 'status': s}, n) for (e, m, s), n in self.requests.items()]),
+                ('episim_stage_seconds', 'summary', "Time spent in each stage of serving requests",
+                 [('_sum', {'stage': name}, total) for name, (total, _) in self.stage_seconds.items()]
+                 + [('_count', {'stage': name}, count) for name, (_, count) in self.stage_seconds.items()]),
+                ('episim_bytes_total', 'counter', "Bytes read, decompressed and spooled",
+                 [('', {'kind': name}, value) for name, value in self.values['bytes'].items()]),
+                ('episim_events_total', 'counter', "Events such as dataset cache hits",
+                 [('', {'event': name}, value) for name, value in self.values['count'].items()]),
+            ]
+            histogram = []
+            for endpoint, values in self.request_seconds.items():
+                for bound, count in zip(REQUEST_SECONDS_BUCKETS, values):
+                    histogram.append(('_bucket', {'endpoint': endpoint, 'le': repr(float(bound))}, count))
+                histogram.append(('_bucket', {'endpoint': endpoint, 'le': '+Inf'}, values[-1]))
+                histogram.append(('_sum', {'endpoint': endpoint}, values[-2]))
+                histogram.append(('_count', {'endpoint': endpoint}, values[-1]))
+            families.append(('episim_request_duration_seconds', 'histogram', "Time to respond to requests", histogram))
+        return families
+
+
+metrics = Metrics()
+
+
+def _thread_bytes_read():
+    """The bytes read by the current thread so far, including from the page cache. Linux only."""
+    try:
+        with open('/proc/thread-self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_trace():
+    if has_request_context():
+        return g.get('episim_trace')
+    return None
+
+
+def record(kind, name, value):
+    """Adds to the totals, and to the trace of the current request if there is one."""
+    if not ENABLED:
+        return
+    metrics.record(kind, name, value)
+    trace = current_trace()
+    if trace is not None:
+        if kind == 'seconds':
+            trace.seconds[name] += value
+        else:
+            trace.values[f"bytes.{name}" if kind == 'bytes' else name] += value
+
+
+@contextmanager
+def stage(name):
+    """Times the code in the block as the stage `name`, if instrumentation is enabled."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record('seconds', name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator that times a function as the stage `name`, e.g. the body of a Dash callback."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StackSampler:
+    """
+    Samples the stacks of the threads it watches every `interval` seconds from a single
+    background thread, counting them in the folded format: frames from the root down,
+    separated by semicolons.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, thread_id):
+        stacks = collections.Counter()
+        with self._lock:
+            self._watched[thread_id] = stacks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        return stacks
+
+    def unwatch(self, thread_id):
+        with self._lock:
+            self._watched.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = dict(self._watched)
+            if not watched:
+                continue
+            frames = sys._current_frames()
+            samples = {}
+            for thread_id in watched:
+                frame = frames.get(thread_id)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if names:
+                    samples[thread_id] = ';'.join(reversed(names))
+            del frames
+            # counted under the lock, so that the stacks of a thread are complete once it's unwatched
+            with self._lock:
+                for thread_id, stack in samples.items():
+                    if thread_id in self._watched:
+                        self._watched[thread_id][stack] += 1
+
+
+sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+
+
+def write_profile(trace, endpoint, stacks):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    endpoint = re.sub(r'[^\w.-]', '_', endpoint.strip('/'))
+    file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{trace.id}.folded"
+    file_path = os.path.join(PROFILE_DIR, file_name)
+    with open(file_path, 'w') as f:
+        for stack, count in stacks.items():
+            f.write(f"{stack} {count}\n")
+    return file_path
+
+
+def _endpoint():
+    # Dash serves all its callbacks from one endpoint, so they are told apart by their stages
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def init_app(app):
+    """Traces the requests of a Flask app, if instrumentation is enabled."""
+    if not ENABLED:
+        return
+    add_instrumentation_listener(record)
+
+    @app.before_request
+    def start_trace():
+        g.episim_trace = Trace()
+        if PROFILE_SLOW_REQUEST_SECONDS > 0:
+            g.episim_stacks = sampler.watch(threading.get_ident())
+
+    @app.after_request
+    def end_trace(response):
+        trace = g.pop('episim_trace', None)
+        if trace is None:
+            return response
+        total = time.perf_counter() - trace.start
+        if trace.read_start is not None:
+            bytes_read = _thread_bytes_read() - trace.read_start
+            trace.values['bytes.read'] += bytes_read
+            metrics.record('bytes', 'read', bytes_read)
+
+        endpoint = _endpoint()
+        metrics.observe_request(endpoint, request.method, response.status_code, total)
+        response.headers['Server-Timing'] = trace.server_timing(total)
+        response.headers['X-Request-Id'] = trace.id
+
+        stacks = g.pop('episim_stacks', None)
+        if stacks is not None:
+            sampler.unwatch(threading.get_ident())
+            if total >= PROFILE_SLOW_REQUEST_SECONDS and stacks:
+                file_path = write_profile(trace, endpoint, stacks)
+                app.logger.warning(
+                    f"Slow request {trace.id} to {request.path} took {total:.2f}s "
+                    f"({trace.server_timing(total)}), profile written to {file_path}"
+                )
+        return response
+
+    @app.teardown_request
+    def stop_sampling(exc):
+        # after_request doesn't run for requests that raised
+        if g.pop('episim_stacks', None) is not None:
+            sampler.unwatch(threading.get_ident())
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+def render_metrics(families=()):
+    """
+    The metrics in the Prometheus text format, followed by `families` of metrics of state kept
+    elsewhere. Families are (name, type, help, [(suffix, labels, value), ...]), where the suffix
+    is appended to the name, e.g. '_sum' and '_count' for summaries.
+    """
+    lines = []
+    for name, kind, help_text, samples in metrics.families() + list(families):
+        if not samples:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
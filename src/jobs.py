@@ -0,0 +1,451 @@
+"""
+Background execution of simulation runs.
+
+Submissions are persisted as rows of the `simulation_jobs` table and executed by a
+bounded pool of long-lived engine worker processes, so that request threads never
+wait on the engine and runs don't pay for starting a process and importing its package.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from db.db import (
+    PartialResult,
+    detach_from_job,
+    discard_partial_result,
+    get_job,
+    get_jobs_by_status,
+    storage_paths,
+    store_partial_result,
+    update_job_status,
+    use_storage_paths,
+)
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks that idle workers still respond, and how long they have to
+HEALTH_CHECK_INTERVAL = 30
+HEALTH_CHECK_TIMEOUT = 10
+# Loading the engine for the first time can take minutes
+WORKER_STARTUP_TIMEOUT = int(os.environ.get('EPISIM_WORKER_STARTUP_TIMEOUT', 900))
+# Runs still going after this many seconds are taken as hung: their worker is stopped and
+# the job failed. 0 for no limit
+RUN_TIMEOUT = float(os.environ.get('EPISIM_RUN_TIMEOUT', 12 * 3600))
+# Seconds between looks at the engine's output for newly computed days while it runs
+PARTIAL_RESULT_INTERVAL = float(os.environ.get('EPISIM_PARTIAL_RESULT_INTERVAL', 5))
+
+
+def run_simulation_job(job_id, work_dir, backend_engine, params_hash):
+    """
+    Runs the engine on the inputs in `work_dir` and stores the result in the database.
+    Called in an engine worker process.
+    """
+    from epi_sim import EpiSim
+
+    partial_result = None
+    try:
+        config_fp = os.path.join(work_dir, 'config.json')
+        init_conditions_fp = os.path.join(work_dir, 'initial_conditions.nc')
+
+        # the data and instance folder are the same for now
+        # because we put the output into sqlite anyway
+        model = (
+            EpiSim(config_fp, work_dir, work_dir, init_conditions_fp)
+            .setup('compiled')
+            .set_backend_engine(backend_engine)
+        )
+
+        assert os.path.exists(model.model_state_folder), f"model.model_state_folder {model.model_state_folder} does not exist"
+
+        # Follow the output as the engine writes it, so clients can watch the run
+        # and most of the result is already stored by the time it finishes
+        output_file = os.path.join(model.model_state_folder, "output", "compartments_full.nc")
+        partial_result = PartialResult(job_id, output_file)
+        stop_following = threading.Event()
+
+        def follow_output():
+            while not stop_following.wait(PARTIAL_RESULT_INTERVAL):
+                try:
+                    partial_result.update()
+                except Exception as e:
+                    logger.warning(f"Error following the output of simulation job {job_id}: {str(e)}")
+
+        follower = threading.Thread(target=follow_output, name=f"follow-{job_id}", daemon=True)
+        follower.start()
+        try:
+            # Run the model
+            id, _ = model.run_model()
+        finally:
+            stop_following.set()
+            follower.join()
+
+        assert os.path.exists(output_file), f"Output file {output_file} does not exist"
+
+        # copies the days not copied yet, and moves the file in place
+        store_partial_result(id, partial_result, params_hash)
+        update_job_status(job_id, 'done', result_id=id, from_statuses=('running',))
+    except Exception as e:
+        logger.error(f"Error in simulation job {job_id}: {str(e)}", exc_info=True)
+        update_job_status(job_id, 'failed', error=str(e), from_statuses=('running',))
+    finally:
+        if partial_result is not None:
+            partial_result.discard()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def engine_worker(conn, storage):
+    """
+    Entry point of a long-lived engine worker process: imports the engine's package once,
+    then runs the jobs it is sent over `conn` one at a time until it is told to stop.
+    The engine itself is set up for each run, as it is bound to the run's config.
+    Results are stored where the web process that started the worker keeps them, `storage`.
+    """
+    # the engine runs in processes of its own: in a session of the worker's, they can be
+    # stopped together with it (see EngineWorker.kill)
+    os.setsid()
+    use_storage_paths(storage)
+    # imported here so that the web process doesn't pay for loading the engine
+    import epi_sim  # noqa: F401
+
+    conn.send(('ready', None))
+    while True:
+        try:
+            message, payload = conn.recv()
+        except EOFError:
+            break
+        if message == 'ping':
+            conn.send(('pong', None))
+        elif message == 'run':
+            run_simulation_job(*payload)
+            conn.send(('done', payload[0]))
+        elif message == 'stop':
+            break
+
+
+_spawn_lock = threading.Lock()
+
+@contextmanager
+def _spawning_without_main():
+    """
+    Spawned processes import the parent's main module again before running their target,
+    which for the server would mean loading Flask and Dash and running its top-level code
+    (e.g. starting background threads) in every worker. Workers only need this module, so
+    the main module is hidden from multiprocessing while a worker is started.
+    """
+    main = sys.modules['__main__']
+    with _spawn_lock:
+        spec, file = getattr(main, '__spec__', None), main.__dict__.pop('__file__', None)
+        main.__spec__ = None
+        try:
+            yield
+        finally:
+            main.__spec__ = spec
+            if file is not None:
+                main.__file__ = file
+
+
+class EngineWorker:
+    """The web process side of an engine worker process and its pipe."""
+
+    def __init__(self, mp_context):
+        self.runs = 0
+        self._ready = False
+        self._conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(
+            target=engine_worker,
+            args=(child_conn, storage_paths()),
+            name="engine-worker",
+            daemon=True,
+        )
+        with _spawning_without_main():
+            self.process.start()
+        child_conn.close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def _receive(self, timeout=None):
+        """Waits for the next message of the worker. Returns None if it died or timed out first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = HEALTH_CHECK_INTERVAL if deadline is None else min(HEALTH_CHECK_INTERVAL, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+            try:
+                if self._conn.poll(wait):
+                    return self._conn.recv()
+            except (EOFError, OSError):
+                return None
+            if not self.process.is_alive():
+                return None
+
+    def _wait_ready(self):
+        if not self._ready:
+            self._ready = self._receive(WORKER_STARTUP_TIMEOUT) == ('ready', None)
+        return self._ready
+
+    def is_ready(self):
+        """Whether the worker has imported the engine, without waiting for it."""
+        if not self._ready:
+            try:
+                if self._conn.poll(0):
+                    self._ready = self._conn.recv() == ('ready', None)
+            except (EOFError, OSError):
+                pass
+        return self._ready
+
+    def ping(self, timeout=HEALTH_CHECK_TIMEOUT):
+        """Whether a ready worker responds within `timeout` seconds."""
+        if not self._ready:
+            return False
+        try:
+            self._conn.send(('ping', None))
+        except OSError:
+            return False
+        return self._receive(timeout) == ('pong', None)
+
+    def run(self, job_id, work_dir, backend_engine, params_hash):
+        """
+        Runs a job in the worker and waits for it, for up to `RUN_TIMEOUT` seconds. Returns None
+        once it is done, or why it isn't: the worker died on the way, never got ready or timed
+        out, in which case it is stopped for good.
+        """
+        timed_out = False
+        if self._wait_ready():
+            deadline = time.monotonic() + RUN_TIMEOUT if RUN_TIMEOUT else None
+            try:
+                self._conn.send(('run', (job_id, work_dir, backend_engine, params_hash)))
+                self.runs += 1
+                if self._receive(RUN_TIMEOUT or None) == ('done', job_id):
+                    return None
+            except OSError:
+                pass
+            timed_out = deadline is not None and time.monotonic() >= deadline
+        if not timed_out:
+            # its pipe can close before it has exited, let it finish for its exit code
+            self.process.join(HEALTH_CHECK_TIMEOUT)
+        self.terminate()
+        if timed_out:
+            return f"Run timed out after {RUN_TIMEOUT:g} seconds"
+        return f"Engine worker exited with code {self.process.exitcode}"
+
+    def stop(self):
+        try:
+            self._conn.send(('stop', None))
+        except OSError:
+            pass
+        self.process.join(5)
+        self.terminate()
+
+    def kill(self):
+        """Stops the worker and whatever processes the engine started, without waiting for them."""
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            # they are all gone already, or the worker hasn't started its session yet
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def terminate(self):
+        self.kill()
+        self.process.join()
+        self._conn.close()
+
+
+class JobQueue:
+    """
+    Runs queued simulation jobs in at most `max_workers` concurrent engine worker processes.
+
+    Workers are started with the queue and kept running between jobs, whichever backend
+    engine the jobs run. Idle workers are health-checked periodically, and replaced after
+    `max_runs_per_worker` runs to bound their memory growth.
+
+    The queue itself lives in memory, the job states live in the database: on start,
+    jobs still queued by a previous server process are picked up again and jobs that
+    were running are marked as failed.
+    """
+
+    def __init__(self, max_workers, max_runs_per_worker=20):
+        self.max_workers = max_workers
+        self.max_runs_per_worker = max_runs_per_worker
+        self._queue = queue.Queue()
+        # workers of jobs by job id (None while a job's worker is being acquired), and idle workers.
+        # Together with the worker out for a health check, they never outnumber max_workers.
+        self._workers = {}
+        self._idle = []
+        self._checking = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._started = False
+        # spawn, not fork: the web process is multi-threaded
+        self._mp_context = multiprocessing.get_context('spawn')
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        for job in get_jobs_by_status('running'):
+            update_job_status(job['id'], 'failed', error="Interrupted by a server restart", from_statuses=('running',))
+            discard_partial_result(job['id'])
+            shutil.rmtree(job['work_dir'], ignore_errors=True)
+        for job in get_jobs_by_status('queued'):
+            self._queue.put(job['id'])
+
+        with self._lock:
+            while len(self._idle) + len(self._workers) < self.max_workers:
+                self._idle.append(EngineWorker(self._mp_context))
+
+        for i in range(self.max_workers):
+            threading.Thread(target=self._dispatch, name=f"simulation-dispatcher-{i}", daemon=True).start()
+        threading.Thread(target=self._check_health, name="simulation-health-check", daemon=True).start()
+
+    def submit(self, job_id):
+        self.start()
+        self._queue.put(job_id)
+
+    def cancel(self, job_id):
+        """
+        Withdraws one submission of a queued or running job. The job itself is only
+        cancelled once no other identical submission is attached to it.
+        Returns 'detached' or 'cancelled', or None if the job had already finished.
+        """
+        if detach_from_job(job_id):
+            return 'detached'
+
+        if update_job_status(job_id, 'cancelled', from_statuses=('queued',)):
+            # the dispatcher skips it once it comes out of the queue
+            return 'cancelled'
+
+        with self._lock:
+            worker = self._workers.get(job_id)
+        if worker is not None and update_job_status(job_id, 'cancelled', from_statuses=('running',)):
+            # the run can't be interrupted otherwise, the worker is replaced
+            worker.kill()
+            return 'cancelled'
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "busy": sum(w is not None for w in self._workers.values()),
+                "idle": len(self._idle),
+            }
+
+    def _workers_in_use(self):
+        return len(self._idle) + len(self._workers) + self._checking
+
+    def _acquire(self):
+        """
+        Takes an idle worker, or starts one. The slot of the job that asks for it is
+        reserved already, so it only waits while a worker is out for a health check.
+        """
+        dead = []
+        with self._available:
+            while True:
+                if self._idle:
+                    worker = self._idle.pop()
+                    if worker.is_alive():
+                        break
+                    dead.append(worker)
+                elif self._workers_in_use() <= self.max_workers:
+                    worker = EngineWorker(self._mp_context)
+                    break
+                else:
+                    self._available.wait()
+        for dead_worker in dead:
+            dead_worker.terminate()
+        return worker
+
+    def _release(self, worker):
+        """
+        Puts a worker back into the pool. Workers that died or are due for replacement
+        are stopped, and a fresh one is started in their place to keep the pool full.
+        """
+        reusable = worker.is_alive() and worker.runs < self.max_runs_per_worker
+        if not reusable:
+            worker.stop()
+        with self._available:
+            if self._workers_in_use() < self.max_workers:
+                self._idle.append(worker if reusable else EngineWorker(self._mp_context))
+                self._available.notify()
+                return
+        if reusable:
+            worker.stop()
+
+    def _check_health(self):
+        while True:
+            time.sleep(HEALTH_CHECK_INTERVAL)
+            with self._lock:
+                idle = list(self._idle)
+            # one at a time, so that the others stay available to jobs
+            for worker in idle:
+                with self._lock:
+                    # workers taken by a job since, or still starting, are left alone
+                    if worker not in self._idle or (worker.is_alive() and not worker.is_ready()):
+                        continue
+                    self._idle.remove(worker)
+                    self._checking += 1
+                try:
+                    healthy = worker.is_alive() and worker.ping()
+                finally:
+                    with self._available:
+                        self._checking -= 1
+                        self._available.notify()
+                if not healthy:
+                    logger.warning(f"Engine worker {worker.process.pid} is unresponsive, replacing it")
+                    worker.terminate()
+                self._release(worker)
+
+    def _dispatch(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                logger.error(f"Error dispatching simulation job {job_id}: {str(e)}", exc_info=True)
+                update_job_status(job_id, 'failed', error=str(e), from_statuses=('queued', 'running'))
+
+    def _run(self, job_id):
+        job = get_job(job_id)
+        if job is None or job['status'] != 'queued':
+            if job is not None and job['status'] == 'cancelled':
+                shutil.rmtree(job['work_dir'], ignore_errors=True)
+            return
+
+        with self._lock:
+            if job_id in self._workers:
+                # a job submitted while the queue was starting up can be queued twice
+                return
+            self._workers[job_id] = None
+
+        worker = None
+        try:
+            worker = self._acquire()
+            with self._lock:
+                self._workers[job_id] = worker
+            if not update_job_status(job_id, 'running', from_statuses=('queued',)):
+                # cancelled while waiting in the queue
+                shutil.rmtree(job['work_dir'], ignore_errors=True)
+                return
+            error = worker.run(job_id, job['work_dir'], job['backend_engine'], job['params_hash'])
+        finally:
+            with self._lock:
+                del self._workers[job_id]
+            if worker is not None:
+                self._release(worker)
+
+        if error is not None:
+            update_job_status(job_id, 'failed', error=error, from_statuses=('running',))
+            # the worker didn't get to clean up after itself
+            discard_partial_result(job_id)
+        shutil.rmtree(job['work_dir'], ignore_errors=True)
@@ -19,7 +19,9 @@ import { GeneralParams, EpidemicParams, VaccinationParams, NPIParams, ParameterU
 import DownloadResults from './DownloadResults';
 import { MapData } from './types/mapTypes';
 import { Config, ConfigSectionType, EngineOption, BackendEngine } from './types/paramsTypes';
-import { SimulationResult } from './types/simulationResultsTypes';
+import { SimulationResult, SimulationJob, SimulationProgress } from './types/simulationResultsTypes';
+
+const JOB_POLL_INTERVAL_MS = 2000;
 
 declare global {
   interface Window {
@@ -178,12 +180,12 @@ const App = () => {
 
   const [isLoading, setIsLoading] = useState(false);
   const [result, setResult] = useState<SimulationResult | null>(null);
-  const [hasResults, setHasResults] = useState(false);
+  const [finishedJob, setFinishedJob] = useState<SimulationJob | null>(null);
 
   const handleSubmit = async () => {
     setIsLoading(true);
     setResult(null);
-    setHasResults(false);
+    setFinishedJob(null);
     try {
       const formData = new FormData();
       formData.append('config', JSON.stringify(params));
@@ -205,10 +207,12 @@ const App = () => {
       } else if (response.ok) {
         const data = await response.json();
         setResult(data);
-        setHasResults(true);
-        if (data.redirect) {
-          // If there's a redirect URL in the response, navigate to it
-          window.location.href = data.redirect;
+        const job = data.events_url ? await followJob(data.events_url) : await waitForJob(data.status_url);
+        if (job.status === 'done' && job.result_id) {
+          setResult({ status: 'success', message: 'Simulation done' } as SimulationResult);
+          setFinishedJob(job);
+        } else {
+          setResult({ status: 'error', message: job.error || `Simulation ${job.status}` } as SimulationResult);
         }
       } else {
         throw new Error('Failed to run simulation');
@@ -221,6 +225,45 @@ const App = () => {
     }
   };
 
+  const waitForJob = async (statusUrl: string): Promise<SimulationJob> => {
+    while (true) {
+      const response = await fetch(statusUrl);
+      if (!response.ok) {
+        throw new Error('Failed to fetch simulation status');
+      }
+      const job: SimulationJob = await response.json();
+      if (job.status !== 'queued' && job.status !== 'running') {
+        return job;
+      }
+      setResult({ status: 'success', message: `Simulation ${job.status}...` } as SimulationResult);
+      await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+  };
+
+  // Follows the job's event stream, which also reports how far the engine has got
+  const followJob = (eventsUrl: string): Promise<SimulationJob> => {
+    return new Promise((resolve, reject) => {
+      const events = new EventSource(eventsUrl);
+      events.addEventListener('progress', (event: MessageEvent) => {
+        const progress: SimulationProgress = JSON.parse(event.data);
+        setResult({ status: 'success', message: `Simulation running, ${progress.days} of ${progress.total_days} days computed...` } as SimulationResult);
+      });
+      events.addEventListener('status', (event: MessageEvent) => {
+        const job: SimulationJob = JSON.parse(event.data);
+        if (job.status !== 'queued' && job.status !== 'running') {
+          events.close();
+          resolve(job);
+        } else {
+          setResult({ status: 'success', message: `Simulation ${job.status}...` } as SimulationResult);
+        }
+      });
+      events.onerror = () => {
+        events.close();
+        reject(new Error('Lost connection to the simulation status'));
+      };
+    });
+  };
+
   const handleDownloadConfig = () => {
     const configJson = JSON.stringify(params, null, 2);
     const blob = new Blob([configJson], { type: 'application/json' });
@@ -273,10 +316,10 @@ const App = () => {
                 {result.message}
               </Typography>
             )}
-            {hasResults && result && (
+            {finishedJob?.result_id && (
               <>
-                <DownloadResults data={result.output} />
-                <Link href={`/dash/results/${result.uuid}`} underline="none">
+                <DownloadResults simulationId={finishedJob.result_id} />
+                <Link href={finishedJob.redirect ?? `/dash/results/${finishedJob.result_id}`} underline="none">
                   <Button variant="contained" color="secondary">
                     Go to Analysis Page
                   </Button>
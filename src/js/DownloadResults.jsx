@@ -1,27 +1,17 @@
 import React from 'react';
 import Button from '@mui/material/Button';
-import { Buffer } from 'buffer';
 
 
-const DownloadResults = ({ data }) => {
-  const handleDownload = () => {
-    const decodedData = Buffer.from(data, 'base64');
-    const blob = new Blob([decodedData], { type: 'application/x-netcdf' });
-    const url = URL.createObjectURL(blob);
-    const a = document.createElement('a');
-    a.href = url;
-    a.download = 'simulation_results.nc';
-    document.body.appendChild(a);
-    a.click();
-    document.body.removeChild(a);
-    URL.revokeObjectURL(url);
-  };
+// The browser downloads the stored file straight from the server, resuming it if interrupted
+const DownloadResults = ({ simulationId }) => (
+  <Button
+    variant="contained"
+    color="secondary"
+    href={`/api/results/${encodeURIComponent(simulationId)}/download`}
+    download={`${simulationId}.nc`}
+  >
+    Download Results
+  </Button>
+);
 
-  return (
-    <Button variant="contained" color="secondary" onClick={handleDownload}>
-      Download Results
-    </Button>
-  );
-};
-
-export default DownloadResults;
\ No newline at end of file
+export default DownloadResults;
@@ -9,9 +9,30 @@ export interface ResultTimeSeries {
 export interface SimulationResult {
     status: string;
     message: string;
-    // binary encoded output file
-    output: string;
-    uuid: string;
     // TODO: add other fields
     // timeSeries: ResultTimeSeries;
 }
+
+export type SimulationJobStatus = 'queued' | 'running' | 'done' | 'failed' | 'cancelled';
+
+export interface SimulationJob {
+    id: string;
+    status: SimulationJobStatus;
+    params_hash: string;
+    backend_engine: string;
+    result_id: string | null;
+    error: string | null;
+    created_at: string;
+    started_at: string | null;
+    finished_at: string | null;
+    // set once the job is done
+    redirect?: string;
+}
+
+// The totals of each compartment over the days of a running job computed so far
+export interface SimulationProgress {
+    days: number;
+    total_days: number;
+    times: string[];
+    totals: Record<string, number[]>;
+}
@@ -0,0 +1,197 @@
+"""
+Slices and sums of stored results, for clients that only need some of their numbers.
+
+A query selects labels of any of the `QUERY_DIMS` and a range of days, and sums over some
+of M, G and V. It is answered from the smallest stored view that still has the dimensions
+it keeps, and read one block of days at a time, so only the chunks it touches are read and
+memory doesn't depend on the size of the answer. Answers are streamed as JSON, CSV or, when
+pyarrow is installed, an Arrow IPC stream.
+"""
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+from simulation_results_dashboard import read_view
+
+QUERY_DIMS = ('epi_states', 'M', 'G', 'V')
+SUMMABLE_DIMS = ('M', 'G', 'V')
+QUERY_FORMATS = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+# The values of a query answered at most, before it has to sum over more dimensions
+MAX_QUERY_VALUES = int(os.environ.get('EPISIM_MAX_QUERY_VALUES', 100_000_000))
+# The values read and encoded at once
+QUERY_BLOCK_VALUES = 1_000_000
+
+
+class QueryTooLargeError(ValueError):
+    pass
+
+
+def parse_query(args):
+    """
+    Parses the query string of a query: comma separated labels of each of the `QUERY_DIMS`,
+    `start` and `end` dates (inclusive), and the dimensions to `sum` over.
+    Returns (selections, start, end, sum_dims). Raises ValueError.
+    """
+    selections = {}
+    for dim in QUERY_DIMS:
+        labels = [label for value in args.getlist(dim) for label in value.split(',') if label]
+        if labels:
+            selections[dim] = labels
+
+    sum_dims = [dim for value in args.getlist('sum') for dim in value.split(',') if dim]
+    unknown = set(sum_dims) - set(SUMMABLE_DIMS)
+    if unknown:
+        raise ValueError(f"Can't sum over {', '.join(sorted(unknown))}, only over {', '.join(SUMMABLE_DIMS)}")
+
+    try:
+        start = pd.Timestamp(args['start']) if args.get('start') else None
+        end = pd.Timestamp(args['end']) if args.get('end') else None
+    except ValueError:
+        raise ValueError("start and end must be dates, e.g. 2020-03-10")
+    return selections, start, end, list(dict.fromkeys(sum_dims))
+
+
+def query_result(simulation_id, selections, start=None, end=None, sum_dims=()):
+    """
+    Returns the lazily selected data of a query, with the `sum_dims` still to be summed
+    over, or None if there is no result. Raises ValueError for labels the result doesn't
+    have and QueryTooLargeError for answers of more than `MAX_QUERY_VALUES` values.
+    """
+    # dimensions that are selected before being summed over have to be kept by the view
+    kept_dims = (set(SUMMABLE_DIMS) - set(sum_dims)) | (set(selections) & set(SUMMABLE_DIMS))
+    ds = read_view(simulation_id, kept_dims=kept_dims)
+    if ds is None:
+        return None
+    data = ds.data
+
+    for dim, labels in selections.items():
+        missing = [label for label in labels if label not in data.indexes[dim]]
+        if missing:
+            raise ValueError(f"Unknown {dim}: {', '.join(missing[:10])}")
+    data = data.sel(**selections, T=slice(start, end))
+
+    sizes = {dim: size for dim, size in data.sizes.items() if dim not in sum_dims}
+    n_values = int(np.prod(list(sizes.values())))
+    if n_values > MAX_QUERY_VALUES:
+        raise QueryTooLargeError(
+            f"The query would return {n_values} values, more than the limit of {MAX_QUERY_VALUES}; "
+            "select fewer labels or sum over more dimensions"
+        )
+    return data
+
+
+def _kept_dims(data, sum_dims):
+    return ['T'] + [dim for dim in data.dims if dim != 'T' and dim not in sum_dims]
+
+
+def _blocks(data, sum_dims):
+    """The answer one block of days at a time, as arrays of shape (days, *other kept dims)."""
+    sum_dims = [dim for dim in sum_dims if dim in data.dims]
+    kept = _kept_dims(data, sum_dims)
+    values_per_day = max(1, int(np.prod([data.sizes[dim] for dim in data.dims if dim != 'T'])))
+    block_size = max(1, QUERY_BLOCK_VALUES // values_per_day)
+    for start in range(0, data.sizes['T'], block_size):
+        block = data.isel(T=slice(start, start + block_size))
+        if sum_dims:
+            block = block.sum(dim=sum_dims)
+        yield block.transpose(*kept)
+
+
+def _dates(times):
+    return [str(t)[:10] for t in np.asarray(times, dtype='datetime64[D]')]
+
+
+def stream_json(data, sum_dims):
+    """
+    A JSON document with the kept dimensions, their labels and the values as nested lists,
+    by day first. Missing values are null.
+    """
+    kept = _kept_dims(data, sum_dims)
+    header = {
+        'dims': kept,
+        'coords': {dim: _dates(data['T'].values) if dim == 'T' else [str(v) for v in data[dim].values] for dim in kept},
+        'shape': [data.sizes[dim] for dim in kept],
+    }
+    yield json.dumps(header)[:-1] + ', "values": ['
+    first = True
+    for block in _blocks(data, sum_dims):
+        if block.sizes['T'] == 0:
+            continue
+        # NaN isn't valid JSON
+        rows = json.dumps(block.values.tolist(), separators=(',', ':')).replace('NaN', 'null')
+        yield ('' if first else ',') + rows[1:-1]
+        first = False
+    yield ']}'
+
+
+def _block_frame(block):
+    frame = block.to_dataframe(name='value').reset_index()
+    frame['T'] = _dates(frame['T'].values)
+    return frame[list(block.dims) + ['value']]
+
+
+def stream_csv(data, sum_dims):
+    """A CSV in long format: a column per kept dimension and a value column."""
+    header = True
+    for block in _blocks(data, sum_dims):
+        yield _block_frame(block).to_csv(index=False, header=header)
+        header = False
+    if header:
+        yield ','.join(_kept_dims(data, sum_dims) + ['value']) + '\n'
+
+
+def stream_arrow(data, sum_dims):
+    """An Arrow IPC stream in long format, a record batch per block of days."""
+    kept = _kept_dims(data, sum_dims)
+    schema = pyarrow.schema(
+        [('T', pyarrow.date32())]
+        + [(dim, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())) for dim in kept[1:]]
+        + [('value', pyarrow.float64())]
+    )
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for block in _blocks(data, sum_dims):
+            shape = block.shape
+            columns = [pyarrow.array(np.repeat(block['T'].values.astype('datetime64[D]'), np.prod(shape[1:], dtype=int)))]
+            for axis, dim in enumerate(kept[1:], start=1):
+                # the labels of each value, as indices into the labels of the dimension
+                along_axis = [1] * len(shape)
+                along_axis[axis] = shape[axis]
+                indices = np.broadcast_to(np.arange(shape[axis], dtype=np.int32).reshape(along_axis), shape).ravel()
+                columns.append(pyarrow.DictionaryArray.from_arrays(indices, [str(v) for v in block[dim].values]))
+            columns.append(pyarrow.array(block.values.ravel()))
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+def negotiate_format(requested, accept_mimetypes):
+    """The format of the answer: as requested, else by the Accept header, else JSON."""
+    if requested:
+        if requested not in QUERY_FORMATS:
+            raise ValueError(f"Unknown format {requested}, expected one of {', '.join(QUERY_FORMATS)}")
+        return requested
+    best = accept_mimetypes.best_match(list(QUERY_FORMATS.values()), default=QUERY_FORMATS['json'])
+    return next(name for name, mimetype in QUERY_FORMATS.items() if mimetype == best)
+
+
+QUERY_STREAMS = {
+    'json': stream_json,
+    'csv': stream_csv,
+    'arrow': stream_arrow,
+}
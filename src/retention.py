@@ -0,0 +1,538 @@
+"""
+Retention of stored results, so that the output folder and the database stay bounded
+however many runs are made.
+
+A pass of retention, in order:
+
+1. deletes the results created longer than `max_age_days` ago, and those not used for
+   `max_idle_days`, except the results of ensemble members, which their ensemble's
+   statistics are computed from,
+2. recompresses the results not used for `cold_after_days` into the cold tier: their chunks
+   are rewritten uncompressed and the whole file compressed with xz (or zstd, if the
+   zstandard package is installed), which takes a fraction of the space of the per-chunk
+   compressed hot format. Cold results stay readable, they are decompressed into the spool
+   folder when read, and those that get used again are moved back to the hot tier,
+3. collects the garbage of the output folder: rows of results whose file is gone, rollups
+   of results that are gone, spooled copies of results no longer in use, partial results
+   of jobs that are no longer running, statistics of ensembles that are gone and files
+   left over by interrupted writes,
+4. deletes the least recently used results, again except those of ensemble members, until
+   the output folder fits in `max_bytes`,
+5. drops the params that no result, running job or ensemble refers to anymore, and the
+   input blobs (and their parsed copies) that no params refer to.
+
+Results are used when they are stored or read (see `db.record_result_access`). Results
+used, params stored and blobs written within `GC_GRACE_SECONDS` are left alone, so that
+retention never gets in the way of a run being submitted.
+
+    python src/retention.py --dry-run
+    python src/retention.py --max-idle-days 180 --cold-after-days 30 --max-bytes 200G
+
+A dry run prints what a pass would do without changing anything. Since it can't know how
+much recompressing results will save, it may overstate what the byte budget would delete.
+"""
+import argparse
+import datetime
+import lzma
+import os
+import shutil
+import threading
+import time
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import db.db as db
+
+MAX_AGE_DAYS = float(os.environ.get('EPISIM_RETENTION_MAX_AGE_DAYS', 0))
+MAX_IDLE_DAYS = float(os.environ.get('EPISIM_RETENTION_MAX_IDLE_DAYS', 0))
+COLD_AFTER_DAYS = float(os.environ.get('EPISIM_RETENTION_COLD_AFTER_DAYS', 30))
+MAX_BYTES = os.environ.get('EPISIM_RETENTION_MAX_BYTES', '0')
+COLD_CODEC = os.environ.get('EPISIM_RETENTION_COLD_CODEC', 'zstd' if zstandard is not None else 'xz')
+
+# Anything stored or used more recently than this is never deleted
+GC_GRACE_SECONDS = 3600
+# Spooled copies of cold results are kept while their result is in use
+SPOOL_KEEP_SECONDS = 24 * 3600
+
+# Codecs of cold results, by name: the extension they add and how to open a file for writing
+COLD_CODECS = {
+    'xz': ('.xz', lambda file_path: lzma.open(file_path, 'wb', preset=6)),
+    'zstd': ('.zst', lambda file_path: zstandard.open(file_path, 'wb', cctx=zstandard.ZstdCompressor(level=19, threads=-1))),
+}
+
+BYTE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def _without_suffix(value, suffix):
+    # str.removesuffix needs python 3.9
+    return value[:-len(suffix)] if value.endswith(suffix) else value
+
+
+def parse_bytes(value):
+    """Parses a number of bytes, with an optional K, M, G or T suffix (powers of 1024)."""
+    value = _without_suffix(_without_suffix(str(value).strip().upper(), 'B'), 'I')
+    unit = value[-1:] if value[-1:] in BYTE_UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * BYTE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Not a number of bytes: {value}")
+
+
+def format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024:
+            return f"{n:.1f} {unit}" if unit != 'B' else f"{n} B"
+        n /= 1024
+    return f"{n:.1f} TiB"
+
+
+class RetentionPolicy:
+    """The limits that stored results are kept to. Limits of 0 are no limits."""
+
+    def __init__(self, max_age_days=MAX_AGE_DAYS, max_idle_days=MAX_IDLE_DAYS, cold_after_days=COLD_AFTER_DAYS,
+                 max_bytes=MAX_BYTES, cold_codec=COLD_CODEC):
+        if cold_codec not in COLD_CODECS:
+            raise ValueError(f"Unknown codec {cold_codec}, expected one of {', '.join(COLD_CODECS)}")
+        if cold_codec == 'zstd' and zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard package")
+        self.max_age_days = max_age_days
+        self.max_idle_days = max_idle_days
+        self.cold_after_days = cold_after_days
+        self.max_bytes = parse_bytes(max_bytes)
+        self.cold_codec = cold_codec
+
+
+def _timestamp(moment):
+    # as SQLite's CURRENT_TIMESTAMP, in UTC
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+
+
+def _size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def _age_seconds(file_path, now):
+    try:
+        return now.timestamp() - os.path.getmtime(file_path)
+    except OSError:
+        return 0
+
+
+def _is_cold(file_path):
+    return os.path.splitext(file_path)[1] in db.RESULT_CODECS
+
+
+def _result_files(simulation_id):
+    """All the files of a stored result: of any tier, its rollups and its spooled copy."""
+    base = os.path.join(db.SIM_OUTPUT_DIR, f"{simulation_id}.nc")
+    files = [base] + [f"{base}{codec}" for codec in db.RESULT_CODECS]
+    # the spooled copy is the same whatever the codec
+    files += [db.rollups_file_path(simulation_id), db.spool_path(f"{base}.gz")]
+    return [file_path for file_path in files if os.path.exists(file_path)]
+
+
+def _directory_bytes(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        total += sum(_size(os.path.join(root, name)) for name in files)
+    return total
+
+
+def stored_results():
+    """The stored results, least recently used first, with when they were created and last used."""
+    rows = db.get_connection().execute('''
+        SELECT r.id, r.created_at, COALESCE(a.last_accessed_at, r.created_at) AS last_used
+        FROM simulation_results r
+        LEFT JOIN simulation_result_access a ON a.id = r.id
+        ORDER BY last_used, r.id
+    ''').fetchall()
+    return [
+        {
+            'id': simulation_id,
+            'created_at': _parse_timestamp(created_at),
+            'last_used': _parse_timestamp(last_used),
+            'file_path': db.result_file_path(simulation_id),
+        }
+        for simulation_id, created_at, last_used in rows
+    ]
+
+
+def ensemble_results():
+    """The ids of the results that ensemble members refer to, by their params or their job."""
+    rows = db.get_connection().execute('''
+        SELECT r.id FROM simulation_results r JOIN ensemble_members m ON m.params_hash = r.params_hash
+        UNION
+        SELECT j.result_id FROM simulation_jobs j JOIN ensemble_members m ON m.job_id = j.id WHERE j.result_id IS NOT NULL
+    ''').fetchall()
+    return {row[0] for row in rows}
+
+
+def _action(action, target, nbytes, reason, **options):
+    return {'action': action, 'target': target, 'bytes': nbytes, 'reason': reason, 'options': options}
+
+
+def _result_bytes(simulation_id):
+    return sum(_size(file_path) for file_path in _result_files(simulation_id))
+
+
+def plan_expiry(policy, now, state):
+    kept = ensemble_results()
+    actions = []
+    for result in stored_results():
+        if result['file_path'] is None or result['id'] in kept:
+            continue
+        age = (now - result['created_at']).days
+        idle = (now - result['last_used']).days
+        if policy.max_age_days and now - result['created_at'] > datetime.timedelta(days=policy.max_age_days):
+            reason = f"created {age} days ago"
+        elif policy.max_idle_days and now - result['last_used'] > datetime.timedelta(days=policy.max_idle_days):
+            reason = f"not used for {idle} days"
+        else:
+            continue
+        actions.append(_action('delete_result', result['id'], _result_bytes(result['id']), reason))
+    return actions
+
+
+def plan_tiering(policy, now, state):
+    if not policy.cold_after_days:
+        return []
+    cold_after = datetime.timedelta(days=policy.cold_after_days)
+    actions = []
+    for result in stored_results():
+        if result['file_path'] is None or result['id'] in state['deleted']:
+            continue
+        idle = now - result['last_used']
+        if not _is_cold(result['file_path']) and idle > cold_after:
+            actions.append(_action('compress_result', result['id'], None, f"not used for {idle.days} days",
+                                   codec=policy.cold_codec))
+        elif _is_cold(result['file_path']) and idle <= cold_after:
+            actions.append(_action('promote_result', result['id'], None, f"used {idle.days} days ago"))
+    return actions
+
+
+def plan_output_garbage(policy, now, state):
+    conn = db.get_connection()
+    actions = []
+    last_used = {}
+    for result in stored_results():
+        last_used[result['id']] = result['last_used']
+        if result['file_path'] is None and result['id'] not in state['touched']:
+            actions.append(_action('delete_result', result['id'], 0, "its file is gone"))
+
+    def stale(file_path, keep_seconds=GC_GRACE_SECONDS):
+        return _age_seconds(file_path, now) > keep_seconds
+
+    def garbage(file_path, reason):
+        actions.append(_action('delete_file', file_path, _size(file_path), reason))
+
+    output_dir = db.SIM_OUTPUT_DIR
+    for name in sorted(os.listdir(output_dir)) if os.path.isdir(output_dir) else []:
+        file_path = os.path.join(output_dir, name)
+        if not os.path.isfile(file_path):
+            continue
+        if '.tmp' in name:
+            if stale(file_path):
+                garbage(file_path, "left over by an interrupted write")
+        elif name.endswith('.rollups.nc'):
+            simulation_id = name[:-len('.rollups.nc')]
+            if simulation_id not in state['touched'] and db.result_file_path(simulation_id) is None:
+                garbage(file_path, "its result is gone")
+
+    spool_dir = os.path.join(output_dir, '.spool')
+    for name in sorted(os.listdir(spool_dir)) if os.path.isdir(spool_dir) else []:
+        file_path = os.path.join(spool_dir, name)
+        simulation_id = name.split('.')[0]
+        if '.tmp' in name:
+            if stale(file_path):
+                garbage(file_path, "left over by an interrupted write")
+            continue
+        if simulation_id in state['touched']:
+            continue
+        result_path = db.result_file_path(simulation_id)
+        if result_path is None or not _is_cold(result_path):
+            garbage(file_path, "its result is gone or no longer compressed")
+        elif simulation_id in last_used:
+            if (now - last_used[simulation_id]).total_seconds() > SPOOL_KEEP_SECONDS:
+                garbage(file_path, "its result is no longer in use")
+        elif stale(file_path, SPOOL_KEEP_SECONDS):
+            garbage(file_path, "its result is no longer in use")
+
+    active_jobs = {row[0] for row in conn.execute("SELECT id FROM simulation_jobs WHERE status IN ('queued', 'running')")}
+    partial_dir = os.path.join(output_dir, 'partial')
+    for name in sorted(os.listdir(partial_dir)) if os.path.isdir(partial_dir) else []:
+        file_path = os.path.join(partial_dir, name)
+        if name.split('.')[0] not in active_jobs and stale(file_path):
+            garbage(file_path, "its job is no longer running")
+
+    ensembles = {row[0] for row in conn.execute('SELECT id FROM ensembles')}
+    ensembles_dir = os.path.join(output_dir, 'ensembles')
+    for name in sorted(os.listdir(ensembles_dir)) if os.path.isdir(ensembles_dir) else []:
+        file_path = os.path.join(ensembles_dir, name)
+        if '.tmp' in name:
+            if stale(file_path):
+                garbage(file_path, "left over by an interrupted write")
+        elif _without_suffix(name, '.stats.nc') not in ensembles:
+            garbage(file_path, "its ensemble is gone")
+    return actions
+
+
+def plan_budget(policy, now, state):
+    if not policy.max_bytes:
+        return []
+    # a dry run hasn't deleted anything yet
+    total = _directory_bytes(db.SIM_OUTPUT_DIR) - state['pending_bytes']
+    kept = ensemble_results()
+    actions = []
+    for result in stored_results():
+        if total <= policy.max_bytes:
+            break
+        if result['file_path'] is None or result['id'] in state['deleted'] or result['id'] in kept:
+            continue
+        if (now - result['last_used']).total_seconds() < GC_GRACE_SECONDS:
+            continue
+        nbytes = _result_bytes(result['id'])
+        actions.append(_action('delete_result', result['id'], nbytes, f"over the budget of {format_bytes(policy.max_bytes)}"))
+        total -= nbytes
+    return actions
+
+
+def plan_params_garbage(policy, now, state):
+    conn = db.get_connection()
+    referenced = {
+        params_hash for simulation_id, params_hash in conn.execute('SELECT id, params_hash FROM simulation_results')
+        if simulation_id not in state['deleted']
+    }
+    referenced |= {row[0] for row in conn.execute("SELECT params_hash FROM simulation_jobs WHERE status IN ('queued', 'running')")}
+    referenced |= {row[0] for row in conn.execute('SELECT params_hash FROM ensemble_members')}
+
+    actions = []
+    dropped = set()
+    for (params_hash,) in conn.execute('SELECT id FROM simulation_params WHERE created_at < ? ORDER BY id',
+                                       (_timestamp(now - datetime.timedelta(seconds=GC_GRACE_SECONDS)),)):
+        if params_hash not in referenced:
+            dropped.add(params_hash)
+            actions.append(_action('drop_params', params_hash, 0, "no result, running job or ensemble uses them"))
+
+    used_blobs = {
+        blob_hash for params_hash, blob_hash in conn.execute('SELECT params_hash, blob_hash FROM simulation_param_files')
+        if params_hash not in dropped
+    }
+    blob_dir = db.BLOB_DIR
+    for prefix in sorted(os.listdir(blob_dir)) if os.path.isdir(blob_dir) else []:
+        prefix_dir = os.path.join(blob_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            if '.tmp' in prefix and _age_seconds(prefix_dir, now) > GC_GRACE_SECONDS:
+                actions.append(_action('delete_file', prefix_dir, _size(prefix_dir), "left over by an interrupted write"))
+            continue
+        for name in sorted(os.listdir(prefix_dir)):
+            file_path = os.path.join(prefix_dir, name)
+            if _age_seconds(file_path, now) <= GC_GRACE_SECONDS:
+                continue
+            digest = name.split('.')[0]
+            if '.tmp' in name:
+                actions.append(_action('delete_file', file_path, _size(file_path), "left over by an interrupted write"))
+            elif name == digest and digest not in used_blobs:
+                nbytes = _size(file_path) + _size(f"{file_path}.npz")
+                actions.append(_action('delete_blob', digest, nbytes, "no params use it"))
+            elif name != digest and not os.path.exists(os.path.join(prefix_dir, digest)):
+                actions.append(_action('delete_file', file_path, _size(file_path), "its blob is gone"))
+    return actions
+
+
+def delete_result(simulation_id):
+    """Deletes a stored result: its files first, so that an interrupted delete leaves a row to collect."""
+    freed = 0
+    for file_path in _result_files(simulation_id):
+        freed += delete_file(file_path)
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM simulation_results WHERE id = ?', (simulation_id,))
+        cursor.execute('DELETE FROM simulation_result_access WHERE id = ?', (simulation_id,))
+    db.dataset_cache.invalidate(simulation_id)
+    db.dataset_cache.invalidate(f"{simulation_id}:rollups")
+    return freed
+
+
+def delete_file(file_path):
+    nbytes = _size(file_path)
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        return 0
+    return nbytes
+
+
+def delete_blob(digest):
+    file_path = db.blob_path(digest)
+    # the parsed copy of an input file, see inputs.py
+    return delete_file(file_path) + delete_file(f"{file_path}.npz")
+
+
+def drop_params(params_hash):
+    with db.transaction() as cursor:
+        # unless they got used again since the pass was planned
+        cursor.execute('''
+            DELETE FROM simulation_params WHERE id = ?
+            AND NOT EXISTS (SELECT 1 FROM simulation_results WHERE params_hash = ?)
+            AND NOT EXISTS (SELECT 1 FROM simulation_jobs WHERE params_hash = ? AND status IN ('queued', 'running'))
+            AND NOT EXISTS (SELECT 1 FROM ensemble_members WHERE params_hash = ?)
+        ''', (params_hash,) * 4)
+        if cursor.rowcount:
+            cursor.execute('DELETE FROM simulation_param_files WHERE params_hash = ?', (params_hash,))
+    return 0
+
+
+def _replace_result(simulation_id, tmp_path, file_path, old_path):
+    """Moves a rewritten result in place of `old_path`. Returns the bytes freed."""
+    # the rollups of a result are up to date as long as they are newer than it
+    stat = os.stat(old_path)
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp_path, file_path)
+    db.get_connection().execute('UPDATE simulation_results SET file_path = ? WHERE id = ?', (file_path, simulation_id))
+    freed = stat.st_size - _size(file_path)
+    os.remove(old_path)
+    delete_file(db.spool_path(old_path if _is_cold(old_path) else file_path))
+    db.dataset_cache.invalidate(simulation_id)
+    return freed
+
+
+def compress_result(simulation_id, codec):
+    """Moves a result to the cold tier, compressed whole with `codec`. Returns the bytes freed."""
+    file_path = db.result_file_path(simulation_id)
+    if file_path is None or _is_cold(file_path):
+        return 0
+    extension, open_compressed = COLD_CODECS[codec]
+    cold_path = f"{file_path}{extension}"
+    plain_path = f"{cold_path}.{uuid.uuid4().hex}.plain.tmp"
+    tmp_path = f"{cold_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        # per-chunk compressed data hardly compresses any further, so the chunks are written plain
+        db.write_chunked_result(file_path, plain_path, complevel=0)
+        with open(plain_path, 'rb') as src, open_compressed(tmp_path) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        return _replace_result(simulation_id, tmp_path, cold_path, file_path)
+    finally:
+        for path in (plain_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def promote_result(simulation_id):
+    """Moves a cold result back to the hot tier, in the chunked format. Returns the bytes freed."""
+    file_path = db.result_file_path(simulation_id)
+    if file_path is None or not _is_cold(file_path):
+        return 0
+    hot_path = os.path.join(db.SIM_OUTPUT_DIR, f"{simulation_id}.nc")
+    tmp_path = f"{hot_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        db.write_chunked_result(db._local_netcdf_path(file_path), tmp_path)
+        return _replace_result(simulation_id, tmp_path, hot_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+ACTIONS = {
+    'delete_result': delete_result,
+    'delete_file': delete_file,
+    'delete_blob': delete_blob,
+    'drop_params': drop_params,
+    'compress_result': compress_result,
+    'promote_result': promote_result,
+}
+
+PHASES = (plan_expiry, plan_tiering, plan_output_garbage, plan_budget, plan_params_garbage)
+
+
+def describe(action):
+    nbytes = format_bytes(action['bytes']) if action['bytes'] is not None else '?'
+    return f"{action['action']:<16} {action['target']:<40} {nbytes:>10}  {action['reason']}"
+
+
+def run_retention(policy, dry_run=False, log=print):
+    """
+    Runs a pass of retention, or plans one with `dry_run`. Returns the actions, with the
+    bytes each freed (or would free, where that's known in advance).
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # what earlier phases did or would do, for later phases not to count it twice
+    state = {'touched': set(), 'deleted': set(), 'pending_bytes': 0}
+    done = []
+    for plan in PHASES:
+        for action in plan(policy, now, state):
+            state['touched'].add(action['target'])
+            if action['action'] == 'delete_result':
+                state['deleted'].add(action['target'])
+            if dry_run:
+                state['pending_bytes'] += action['bytes'] or 0
+            else:
+                try:
+                    action['bytes'] = ACTIONS[action['action']](action['target'], **action['options'])
+                except Exception as e:
+                    log(f"Error: {action['action']} {action['target']} failed: {str(e)}")
+                    continue
+            log(describe(action))
+            done.append(action)
+    return done
+
+
+def start_retention_thread(interval, policy, logger):
+    """Runs a pass of retention every `interval` seconds, in a background thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                actions = run_retention(policy, log=logger.info)
+                if actions:
+                    logger.info(f"Retention freed {format_bytes(sum(a['bytes'] or 0 for a in actions))}")
+            except Exception:
+                logger.exception("Retention pass failed")
+
+    threading.Thread(target=run, name="retention", daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help="only print what a pass would do")
+    parser.add_argument('--max-age-days', type=float, default=MAX_AGE_DAYS,
+                        help="delete results created longer ago than this (default: %(default)s, 0 for no limit)")
+    parser.add_argument('--max-idle-days', type=float, default=MAX_IDLE_DAYS,
+                        help="delete results not used for longer than this (default: %(default)s, 0 for no limit)")
+    parser.add_argument('--cold-after-days', type=float, default=COLD_AFTER_DAYS,
+                        help="recompress results not used for longer than this (default: %(default)s, 0 never)")
+    parser.add_argument('--max-bytes', default=MAX_BYTES,
+                        help="size budget of the output folder, e.g. 200G (default: %(default)s, 0 for no limit)")
+    parser.add_argument('--codec', choices=sorted(COLD_CODECS), default=COLD_CODEC, help="codec of cold results")
+    args = parser.parse_args()
+
+    try:
+        policy = RetentionPolicy(args.max_age_days, args.max_idle_days, args.cold_after_days, args.max_bytes, args.codec)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # databases of older versions don't track the last access of results yet
+    db.create_database()
+    if args.dry_run:
+        print("Dry run, nothing is changed")
+    actions = run_retention(policy, dry_run=args.dry_run)
+    freed = sum(action['bytes'] or 0 for action in actions)
+    if not actions:
+        print("Nothing to do")
+    elif args.dry_run:
+        print(f"{len(actions)} actions would free at least {format_bytes(freed)}")
+    else:
+        print(f"{len(actions)} actions freed {format_bytes(freed)}")
+
+
+if __name__ == '__main__':
+    main()
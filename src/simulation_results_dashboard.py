@@ -3,22 +3,140 @@ import dash_bootstrap_components as dbc
 import pandas as pd
 import xarray as xr
 import numpy as np
-import io
-import base64
-from db.db import read_simulation
-import folium
-from branca.colormap import linear
+import functools
+import gzip
+import hashlib
+import json
+import os
+from db.db import read_simulation, get_rollup, result_file_path
+from downsampling import downsample_indices
+from ensembles import ensemble_stats, ENSEMBLE_QUANTITIES
+from instrumentation import stage, timed
 import plotly.express as px
 import plotly.graph_objects as go
 import geopandas as gpd
 
+REGIONS_GEOJSON_PATH = 'models/mitma/fl_municipios_catalonia.geojson'
+REFERENCE_DATA_PATH = 'models/mitma/casos_hosp_def_edad_provres.nc'
+MAP_ZOOM = 7.5
+# The zoom level the map geometry is simplified for, and the range clients may ask for
+MAP_GEOMETRY_ZOOM = 8
+MAP_GEOMETRY_ZOOM_RANGE = (0, 18)
+
+# Time series longer than the graph is wide are decimated on the server before plotting.
+# Set EPISIM_DOWNSAMPLING to 'minmax' for min/max bucketing, or to 'none' to send every point.
+DOWNSAMPLING = os.environ.get('EPISIM_DOWNSAMPLING', 'lttb')
+DEFAULT_GRAPH_WIDTH = 1000
+
+# The precomputed rollup that keeps exactly the given dimensions out of M, G and V
+ROLLUP_BY_KEPT_DIMS = {
+    frozenset(): 'total',
+    frozenset({'M'}): 'by_region',
+    frozenset({'G'}): 'by_age',
+    frozenset({'V'}): 'by_vaccination',
+}
+
+def read_view(simulation_id, kept_dims=()):
+    """
+    Returns the smallest stored dataset that still has the `kept_dims` out of M, G and V:
+    a precomputed rollup if there is one, else the full result.
+    """
+    rollup = ROLLUP_BY_KEPT_DIMS.get(frozenset(kept_dims))
+    if rollup is not None:
+        ds = get_rollup(simulation_id, rollup)
+        if ds is not None:
+            return ds
+    return read_simulation(simulation_id)
+
+@functools.lru_cache(maxsize=None)
+def load_regions():
+    """The municipalities of Catalonia in WGS84. Read and reprojected once per process."""
+    with open(REGIONS_GEOJSON_PATH) as f:
+        return gpd.read_file(f).to_crs(epsg=4326)
+
+@functools.lru_cache(maxsize=None)
+def region_features(zoom):
+    """
+    GeoJSON features (id, name and geometry) of the municipalities, with the geometry
+    simplified to about a pixel at the given zoom level. Computed once per zoom level.
+    """
+    regions = load_regions()
+    tolerance = 360 / (256 * 2 ** zoom)
+    simplified = gpd.GeoDataFrame(
+        regions[['id', 'name']],
+        geometry=regions.geometry.simplify(tolerance, preserve_topology=True),
+        crs=regions.crs,
+    )
+    return simplified.__geo_interface__['features']
+
+@functools.lru_cache(maxsize=None)
+def region_geojson(zoom):
+    """
+    The `region_features` at a zoom level as a serialized FeatureCollection, for serving
+    to map clients. Returns the JSON bytes, their gzip encoding and an ETag.
+    """
+    body = json.dumps(
+        {'type': 'FeatureCollection', 'features': region_features(zoom)},
+        separators=(',', ':'),
+    ).encode()
+    return body, gzip.compress(body), hashlib.sha256(body).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def map_center():
+    min_lon, min_lat, max_lon, max_lat = load_regions().total_bounds
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+@functools.lru_cache(maxsize=None)
+def load_reference_data():
+    """Reference hospitalisation data. Loaded once per process and shared, so don't modify it."""
+    ds = xr.open_dataarray(REFERENCE_DATA_PATH).load()
+    ds['T'] = pd.to_datetime(ds['T'].values)
+    return ds
+
+def simulation_metadata(simulation_id):
+    """
+    The coordinate labels of a simulation and the marks of its time slider, or None if there is
+    no result. Computed once per version of the result file and shared by all the page's callbacks.
+    """
+    file_path = result_file_path(simulation_id)
+    if file_path is None:
+        return None
+    stat = os.stat(file_path)
+    return _simulation_metadata(simulation_id, (file_path, stat.st_mtime_ns, stat.st_size))
+
+@functools.lru_cache(maxsize=128)
+@timed('dash.metadata')
+def _simulation_metadata(simulation_id, signature):
+    ds = read_simulation(simulation_id)
+    times = [pd.Timestamp(t).strftime('%Y-%m-%d') for t in ds.T.values]
+    mark_indices = np.linspace(0, len(times) - 1, 5, dtype=int)
+    return {
+        'epi_states': [str(c) for c in ds.epi_states.values],
+        'M': [str(m) for m in ds.M.values],
+        'G': [str(g) for g in ds.G.values],
+        'V': [str(v) for v in ds.V.values],
+        'times': times,
+        'time_marks': {int(i): times[i] for i in mark_indices},
+    }
+
 def create_results_layout(simulation_id):
     return dbc.Container([
         html.H1(f"Results for Simulation {simulation_id}", className="mt-4 mb-4"),
+        dbc.Button(
+            "Download Results",
+            href=f"/api/results/{simulation_id}/download",
+            download=f"{simulation_id}.nc",
+            external_link=True,
+            color="secondary",
+            className="mb-4",
+        ),
+        # the coordinate labels, loaded once per page instead of by every callback
+        dcc.Store(id='results-metadata', data=simulation_metadata(simulation_id)),
         dbc.Row([
             dbc.Col([
                 html.H3("Interactive Plot"),
                 dcc.Graph(id='results-graph'),
+                dcc.Store(id='results-graph-width'),
                 dcc.Dropdown(id='compartment-selector', multi=True, value=['I', 'R']),
                 dcc.Dropdown(id='region-selector', multi=True),
                 dcc.RangeSlider(id='time-range-slider', min=0, max=100, step=1, value=[], marks=None),
@@ -42,7 +160,117 @@ def create_results_layout(simulation_id):
         ], className="mt-4"),
     ], fluid=True)
 
+def create_ensemble_layout(ensemble_id):
+    return dbc.Container([
+        html.H1(f"Results for Ensemble {ensemble_id}", className="mt-4 mb-4"),
+        dbc.Row([
+            dbc.Col([
+                dcc.Dropdown(
+                    id='ensemble-quantity-selector',
+                    options=[{'label': q.capitalize(), 'value': q} for q in ENSEMBLE_QUANTITIES],
+                    value='hospitalizations',
+                    clearable=False,
+                ),
+            ], md=6),
+            dbc.Col([
+                dcc.Dropdown(id='ensemble-region-selector', placeholder="All regions"),
+            ], md=6),
+        ]),
+        dcc.Graph(id='ensemble-graph'),
+    ], fluid=True)
+
+def ensemble_bands_figure(stats, quantity, region=None):
+    """The median of a quantity across the members of an ensemble, within its 5-95% band, and the mean."""
+    if region:
+        values = stats[quantity].sel(M=region)
+        title = f"{quantity.capitalize()} in {region} across the ensemble"
+    else:
+        values = stats[f"{quantity}_total"]
+        title = f"{quantity.capitalize()} across the ensemble"
+    times = stats.T.values
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=times, y=values.sel(statistic='q95').values, mode='lines',
+                             line=dict(width=0), showlegend=False, hoverinfo='skip'))
+    fig.add_trace(go.Scatter(x=times, y=values.sel(statistic='q05').values, mode='lines',
+                             line=dict(width=0), fill='tonexty', fillcolor='rgba(31, 119, 180, 0.25)',
+                             name='5-95%'))
+    fig.add_trace(go.Scatter(x=times, y=values.sel(statistic='q50').values, mode='lines',
+                             line=dict(color='rgb(31, 119, 180)'), name='Median'))
+    fig.add_trace(go.Scatter(x=times, y=values.sel(statistic='mean').values, mode='lines',
+                             line=dict(color='rgb(31, 119, 180)', dash='dot'), name='Mean'))
+    fig.update_layout(title=f"{title} ({stats.attrs['n_members']} members)", xaxis_title='Time', yaxis_title='Count')
+    return fig
+
+# The colors and dash styles plotly express gives to the compartments and vaccination levels
+COMPARTMENT_COLORS = px.colors.qualitative.Plotly
+VACCINATION_DASHES = ['solid', 'dot', 'dash', 'longdash', 'dashdot', 'longdashdot']
+
+def compartments_figure(summed, n_out=None):
+    """
+    A line per compartment, and per vaccination level if `summed` still has a V dimension,
+    built straight from the arrays of `summed` so that they are sent as typed arrays.
+    Matches what px.line(color='epi_states', line_dash='V') makes of the same values.
+    Each line is downsampled to about `n_out` points, unless `n_out` is None.
+    """
+    has_v = 'V' in summed.dims
+    values = summed.transpose('epi_states', 'V', 'T') if has_v else summed.transpose('epi_states', 'T').expand_dims('V', axis=1)
+    values = np.asarray(values.values, dtype=np.float64)
+    times = summed['T'].values
+    states = [str(s) for s in summed.epi_states.values]
+    levels = [str(v) for v in summed.V.values] if has_v else [None]
+
+    fig = go.Figure()
+    for i, state in enumerate(states):
+        for j, level in enumerate(levels):
+            y = values[i, j]
+            keep = downsample_indices(times, y, n_out, DOWNSAMPLING) if n_out is not None else slice(None)
+            if has_v:
+                name = f"{state}, {level}"
+                hovertemplate = f"Compartments={state}<br>Vaccination={level}<br>Time=%{{x}}<br>Population=%{{y}}<extra></extra>"
+            else:
+                name = state
+                hovertemplate = f"Compartments={state}<br>Time=%{{x}}<br>Population=%{{y}}<extra></extra>"
+            fig.add_trace(go.Scatter(
+                x=times[keep], y=y[keep], mode='lines', name=name, legendgroup=name,
+                line=dict(color=COMPARTMENT_COLORS[i % len(COMPARTMENT_COLORS)], dash=VACCINATION_DASHES[j % len(VACCINATION_DASHES)] if has_v else 'solid'),
+                hovertemplate=hovertemplate, showlegend=True,
+            ))
+    fig.update_layout(
+        title='Compartment Values Over Time',
+        xaxis_title='Time',
+        yaxis_title='Population',
+        legend_title_text='Compartments, Vaccination' if has_v else 'Compartments',
+        legend_tracegroupgap=0,
+    )
+    return fig
+
 def register_callbacks(dash_app):
+    @dash_app.callback(
+        Output('ensemble-region-selector', 'options'),
+        Input('url', 'pathname')
+    )
+    def update_ensemble_regions(pathname):
+        if not pathname.startswith('/dash/ensembles/'):
+            return []
+        stats = ensemble_stats(pathname.split('/')[-1])
+        if stats is None:
+            return []
+        return [{'label': r, 'value': r} for r in stats.M.values]
+
+    @dash_app.callback(
+        Output('ensemble-graph', 'figure'),
+        [Input('ensemble-quantity-selector', 'value'),
+         Input('ensemble-region-selector', 'value')],
+        State('url', 'pathname')
+    )
+    @timed('dash.update_ensemble_graph')
+    def update_ensemble_graph(quantity, region, pathname):
+        stats = ensemble_stats(pathname.split('/')[-1])
+        if stats is None:
+            return go.Figure()
+        return ensemble_bands_figure(stats, quantity, region)
+
     @dash_app.callback(
         [Output('compartment-selector', 'options'),
          Output('region-selector', 'options'),
@@ -52,38 +280,38 @@ def register_callbacks(dash_app):
          Output('time-range-slider', 'value'),
          Output('age-selector', 'options'),
          Output('vaccination-selector', 'options')],
+        Input('results-metadata', 'data')
+    )
+    def update_dropdowns(metadata):
+        if not metadata:
+            return [], [], 0, 100, {}, [0, 100], [], []
+
+        def options(labels):
+            return [{'label': label, 'value': label} for label in labels]
+
+        time_min, time_max = 0, len(metadata['times']) - 1
+        return (
+            options(metadata['epi_states']),
+            options(metadata['M']),
+            time_min,
+            time_max,
+            metadata['time_marks'],
+            [time_min, time_max],
+            options(metadata['G']),
+            options(metadata['V']),
+        )
+
+    # The pixel width of the graph, which bounds the number of points worth sending per trace
+    dash_app.clientside_callback(
+        """
+        function(pathname) {
+            const graph = document.getElementById('results-graph');
+            return graph ? graph.offsetWidth : null;
+        }
+        """,
+        Output('results-graph-width', 'data'),
         Input('url', 'pathname')
     )
-    def update_dropdowns(pathname):
-        if pathname.startswith('/dash/results/'):
-            simulation_id = pathname.split('/')[-1]
-            ds = read_simulation(simulation_id)
-            
-            if ds is None:
-                return [], [], 0, 100, {}, [0, 100], [], []
-            
-            compartments = [{'label': c, 'value': c} for c in ds.epi_states.values]
-            regions = [{'label': r, 'value': r} for r in ds.M.values]
-            
-            time_min, time_max = 0, len(ds.T) - 1
-            num_marks = 5
-            mark_indices = np.linspace(time_min, time_max, num_marks, dtype=int)
-            time_marks = {int(i): pd.Timestamp(ds.T.values[i]).strftime('%Y-%m-%d') for i in mark_indices}
-            
-            ages = [{'label': a, 'value': a} for a in ds.G.values]
-            vaccinations = [{'label': v, 'value': v} for v in ds.V.values]
-            
-            return (
-                compartments,
-                regions,
-                time_min,
-                time_max,
-                time_marks,
-                [time_min, time_max],
-                ages,
-                vaccinations
-            )
-        return [], [], 0, 100, {}, [0, 100], [], []
 
     @dash_app.callback(
         Output('results-graph', 'figure'),
@@ -91,15 +319,16 @@ def register_callbacks(dash_app):
          Input('region-selector', 'value'),
          Input('time-range-slider', 'value'),
          Input('age-selector', 'value'),
-         Input('vaccination-selector', 'value')],
-        State('url', 'pathname')
+         Input('vaccination-selector', 'value'),
+         Input('results-graph-width', 'data')],
+        [State('url', 'pathname'),
+         State('results-metadata', 'data')]
     )
-    def update_graph(selected_compartments, selected_regions, time_range, selected_ages, selected_vaccinations, pathname):
-        simulation_id = pathname.split('/')[-1]
-        ds = read_simulation(simulation_id)
-
-        if ds is None:
+    @timed('dash.update_graph')
+    def update_graph(selected_compartments, selected_regions, time_range, selected_ages, selected_vaccinations, graph_width, pathname, metadata):
+        if not metadata:
             return px.line()
+        simulation_id = pathname.split('/')[-1]
         
         filters = {}
         if selected_compartments:
@@ -110,55 +339,52 @@ def register_callbacks(dash_app):
             filters['G'] = selected_ages
         if selected_vaccinations:
             filters['V'] = selected_vaccinations
+
+        # everything but the filtered dimensions gets summed, which the rollups already did
+        ds = read_view(simulation_id, kept_dims=set(filters) - {'epi_states'})
+
+        if ds is None:
+            return px.line()
         
+        # only the selected slice is read from the file
         if time_range:
-            start_time, end_time = ds.T.values[time_range[0]], ds.T.values[time_range[1]]
-            filtered_ds = ds.sel(T=slice(start_time, end_time))
+            filtered_ds = ds.isel(T=slice(time_range[0], time_range[1] + 1))
         else:
             filtered_ds = ds
 
         filtered_ds = filtered_ds.sel(**filters)
         
-        summed_ds = filtered_ds.sum(dim=[dim for dim in ['M', 'G', 'V'] if dim in filtered_ds.dims])
-        
-        df = summed_ds.to_dataframe().reset_index()
-        
-        if 'V' in df.columns:
-            fig = px.line(df, x='T', y='data', color='epi_states', line_dash='V',
-                          title='Compartment Values Over Time',
-                          labels={'T': 'Time', 'data': 'Population', 'epi_states': 'Compartments', 'V': 'Vaccination'})
-        else:
-            fig = px.line(df, x='T', y='data', color='epi_states',
-                          title='Compartment Values Over Time',
-                          labels={'T': 'Time', 'data': 'Population', 'epi_states': 'Compartments'})
-
-        
-        return fig
+        with stage('dash.update_graph.reduce'):
+            summed = filtered_ds.data.sum(dim=[dim for dim in ['M', 'G', 'V'] if dim in filtered_ds.dims]).load()
 
-    def fetch_reference_data(simulation_id):
-        ds = xr.open_dataarray('models/mitma/casos_hosp_def_edad_provres.nc')
-        ds['T'] = pd.to_datetime(ds['T'].values)
-        return ds
+        # Narrowing the time range brings the series under the width again, at full resolution
+        n_out = None if DOWNSAMPLING == 'none' else graph_width or DEFAULT_GRAPH_WIDTH
+        with stage('dash.update_graph.figure'):
+            return compartments_figure(summed, n_out)
 
     @dash_app.callback(
         [Output('hospitalization-graph', 'figure'),  # Updated output ID
          Output('age-distribution-graph', 'figure'),
          Output('regional-comparison-graph', 'src')],
-        [Input('url', 'pathname')]
+        Input('results-metadata', 'data'),
+        State('url', 'pathname')
     )
-    def update_static_graphs(pathname):
+    @timed('dash.update_static_graphs')
+    def update_static_graphs(metadata, pathname):
+        if not metadata:
+            return px.line(), px.bar(), ''
         simulation_id = pathname.split('/')[-1]
-        sim_output = read_simulation(simulation_id)
+        sim_total = read_view(simulation_id)
 
-        if sim_output is None:
+        if sim_total is None:
             return px.line(), px.bar(), ''  # Return empty figures and iframe src
 
         # Fetch hospitalization data
-        reference = fetch_reference_data(simulation_id)
+        reference = load_reference_data()
 
         # Infected vs Hospitalizations Over Time
-        sum_dims = [d for d in ['M', 'G', 'V', 'epi_states'] if d in sim_output.dims]
-        sim_hosp = sim_output.sel(epi_states=['PH', 'HR', 'HD']).sum(dim=sum_dims).data
+        sum_dims = [d for d in ['M', 'G', 'V', 'epi_states'] if d in sim_total.dims]
+        sim_hosp = sim_total.sel(epi_states=['PH', 'HR', 'HD']).sum(dim=sum_dims).data
         sim_hosp.name = 'Simulated Hospitalizations'
         reference_hosp = reference.sel(epi_states='H').sum(dim=['M', 'G'])
         reference_hosp.name = 'Reference Hospitalizations'
@@ -195,76 +421,54 @@ def register_callbacks(dash_app):
         )
 
         # Age Distribution
-        sum_dims = [d for d in ['M', 'V'] if d in sim_output.dims]
-        age_distribution = sim_output.sel(epi_states='I', T=sim_output.T[-1]).sum(dim=sum_dims).to_dataframe().reset_index()
+        sim_by_age = read_view(simulation_id, kept_dims={'G'})
+        sum_dims = [d for d in ['M', 'V'] if d in sim_by_age.dims]
+        age_distribution = sim_by_age.sel(epi_states='I', T=sim_by_age.T[-1]).sum(dim=sum_dims).to_dataframe().reset_index()
         age_dist_fig = px.bar(x=age_distribution['G'], y=age_distribution['data'], title='Age Distribution of Cases')
         age_dist_fig.update_layout(xaxis_title='Age Group', yaxis_title='Number of Cases')
         
-        with open('models/mitma/fl_municipios_catalonia.geojson') as f:
-            gdf = gpd.read_file(f).to_crs(epsg=4326)
-        
-        map_src = choropleth_map(gdf, sim_output)
+        map_src = choropleth_map_src(simulation_id)
 
         return inf_hosp_fig, age_dist_fig, map_src  # Return updated figures
 
 
-def choropleth_map(gdf, simulation_results):
+def regional_values(simulation_results, compartment='I', t=-1):
     """
-    Creates a choropleth map of the infected compartment from simulation results at the final time step.
-    Returns a base64 encoded string of the leaflet map, which can be used in an iframe.
+    Returns the values of a compartment per region (a Series indexed by M) at time index `t`,
+    summed over age groups and vaccination status.
     """
-    sum_dims = ['G', 'V'] if 'V' in simulation_results.dims else ['G']
-    inf_mapdata = (
+    sum_dims = [d for d in ['G', 'V'] if d in simulation_results.dims]
+    return (
         simulation_results
-        .sel(epi_states='I', T=simulation_results.T[-1])
+        .sel(epi_states=compartment)
+        .isel(T=t)
         .sum(dim=sum_dims)
-        .where(simulation_results.M.isin(gdf.id))
+        .data
+        .to_series()
+        .fillna(0)
     )
-    inf_mapdata = inf_mapdata.to_dataframe().reset_index()
-
-    # Merge inf_mapdata with gdf based on 'id' and 'M'
-    merged_data = gdf.merge(inf_mapdata[['M', 'data']], left_on='id', right_on='M', how='left')
-    # fill na with 0
-    merged_data['data'] = merged_data['data'].fillna(0)
-
-    total_bounds = gdf.total_bounds
-    lon, lat = ((total_bounds[0] + total_bounds[2]) / 2, (total_bounds[1] + total_bounds[3]) / 2)
-
-    # Create a color map based on the 'data' column
-    colormap = linear.inferno.scale(merged_data['data'].min(), merged_data['data'].max())
-
-    # Create Folium map
-    folium_map = folium.Map(location=[lat, lon], zoom_start=7.5)
-    folium.GeoJson(
-        merged_data,
-        style_function=lambda feature: {
-            'fillColor': colormap(feature['properties']['data']),
-            'color': 'black',
-            'weight': 0.5,
-            'fillOpacity': 0.5,
-        },
-        tooltip=folium.GeoJsonTooltip(
-            fields=['name', 'data'],  # Add fields for tooltip
-            aliases=['Name:', 'Infected Cases:'],
-            localize=True,
-            sticky=False,
-            labels=True,
-            style="""
-                background-color: #F0EFEF;
-                border: 2px solid black;
-                border-radius: 3px;
-                box-shadow: 3px;
-            """,
-        )
-    ).add_to(folium_map)
-
-    # Save the map to a StringIO object
-    map_io = io.BytesIO()
-    folium_map.save(map_io, close_file=False)
-    map_io.seek(0)
-    map_html = map_io.getvalue().decode()
-
-    # Encode the HTML to base64
-    map_base64 = base64.b64encode(map_html.encode()).decode()
-    map_src = f"data:text/html;base64,{map_base64}"
-    return map_src
\ No newline at end of file
+
+def regional_series(simulation_results, compartment='I'):
+    """
+    Returns the values of a compartment per region and day as a C-ordered (M x T)
+    little-endian float32 array, summed over age groups and vaccination status.
+    """
+    sum_dims = [d for d in ['G', 'V'] if d in simulation_results.dims]
+    return np.ascontiguousarray(
+        simulation_results
+        .data
+        .sel(epi_states=compartment)
+        .sum(dim=sum_dims)
+        .fillna(0)
+        .transpose('M', 'T')
+        .values,
+        dtype='<f4',
+    )
+
+def choropleth_map_src(simulation_id, compartment='I'):
+    """
+    Returns the URL of the choropleth map page of a simulation, to be used as an iframe src.
+    The page fetches the (cacheable) region geometry and the per-region values separately,
+    and colors the regions in the browser.
+    """
+    return f"/map/{simulation_id}?compartment={compartment}"
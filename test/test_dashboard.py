@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import simulation_results_dashboard as dashboard
+from test_result_storage import synthetic_output
+
+
+class CallbackRecorder:
+    """Stands in for the Dash app, keeping the bodies of the callbacks registered on it by name."""
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def callback(self, *args, **kwargs):
+        def register(func):
+            self.callbacks[func.__name__] = func
+            return func
+        return register
+
+    def clientside_callback(self, *args, **kwargs):
+        pass
+
+
+class TestResultsDashboard(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = db.storage_paths()
+        db.use_storage_paths({
+            'DATABASE_PATH': os.path.join(self.tmp_dir, 'test.db'),
+            'SIM_OUTPUT_DIR': self.tmp_dir,
+            'BLOB_DIR': os.path.join(self.tmp_dir, 'blobs'),
+        })
+        db.create_database()
+        db.dataset_cache.clear()
+        dashboard._simulation_metadata.cache_clear()
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+
+        recorder = CallbackRecorder()
+        dashboard.register_callbacks(recorder)
+        self.callbacks = recorder.callbacks
+
+    def tearDown(self):
+        db.use_storage_paths(self._paths)
+        db.dataset_cache.clear()
+        dashboard._simulation_metadata.cache_clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def metadata(self):
+        # as the browser gets it back from the dcc.Store
+        return json.loads(json.dumps(dashboard.simulation_metadata('sim')))
+
+    def test_dropdowns_are_filled_from_the_stored_metadata(self):
+        options, regions, time_min, time_max, marks, time_range, ages, vaccinations = \
+            self.callbacks['update_dropdowns'](self.metadata())
+
+        self.assertEqual([option['value'] for option in options], ['S', 'E', 'A', 'I', 'PH', 'PD', 'HR', 'HD', 'R', 'D', 'CH'])
+        self.assertEqual(regions[0], {'label': '8001', 'value': '8001'})
+        self.assertEqual(len(regions), 20)
+        self.assertEqual((time_min, time_max, time_range), (0, 39, [0, 39]))
+        self.assertEqual(marks, {'0': '2020-03-10', '9': '2020-03-19', '19': '2020-03-29', '29': '2020-04-08', '39': '2020-04-18'})
+        self.assertEqual([option['value'] for option in ages], ['Y', 'M', 'O'])
+        self.assertEqual([option['value'] for option in vaccinations], ['NV', 'V'])
+        # before the metadata is loaded, or for a missing result
+        self.assertEqual(self.callbacks['update_dropdowns'](None), ([], [], 0, 100, {}, [0, 100], [], []))
+
+    def test_figures_from_rollups_match_the_full_result(self):
+        full = db.read_simulation('sim')
+        # selections of a single dimension are read from its rollup
+        self.assertEqual(set(dashboard.read_view('sim', {'G'}).data.dims), {'T', 'G', 'epi_states'})
+        selections = [
+            {},
+            {'M': ['8002', '8005']},
+            {'G': ['O']},
+            {'V': ['V']},
+            {'M': ['8001'], 'G': ['Y', 'M']},
+        ]
+        for filters in selections:
+            with self.subTest(filters=filters):
+                compartments = ['I', 'R']
+                figure = self.callbacks['update_graph'](
+                    compartments, filters.get('M'), [5, 30], filters.get('G'), filters.get('V'), 1000,
+                    '/dash/results/sim', self.metadata(),
+                )
+
+                selected = full.isel(T=slice(5, 31)).sel(epi_states=compartments, **filters)
+                summed = selected.data.sum(dim=[dim for dim in ['M', 'G', 'V'] if dim in selected.dims])
+                expected = dashboard.compartments_figure(summed)
+
+                self.assertEqual([trace.name for trace in figure.data], [trace.name for trace in expected.data])
+                for trace, expected_trace in zip(figure.data, expected.data):
+                    np.testing.assert_array_equal(trace.x, expected_trace.x)
+                    np.testing.assert_allclose(trace.y, expected_trace.y, rtol=1e-12)
+                    self.assertEqual(trace.line, expected_trace.line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+
+# The schema of databases created before schema versions, at user_version 0
+BASELINE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS simulation_params (
+    id TEXT PRIMARY KEY,
+    params BLOB,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS simulation_results (
+    id TEXT PRIMARY KEY,
+    file_path TEXT NOT NULL,
+    params_hash TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (params_hash) REFERENCES simulation_params(id)
+);
+
+CREATE TRIGGER IF NOT EXISTS update_simulation_results_timestamp
+AFTER UPDATE ON simulation_results
+BEGIN
+    UPDATE simulation_results SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+END;
+'''
+
+
+class TestDatabaseUpgrade(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = db.storage_paths()
+        db.use_storage_paths({
+            'DATABASE_PATH': os.path.join(self.tmp_dir, 'test.db'),
+            'SIM_OUTPUT_DIR': os.path.join(self.tmp_dir, 'sim_output'),
+            'BLOB_DIR': os.path.join(self.tmp_dir, 'blobs'),
+        })
+        conn = sqlite3.connect(db.DATABASE_PATH)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.execute("INSERT INTO simulation_params (id, params) VALUES ('hash', x'1f8b')")
+        conn.execute("INSERT INTO simulation_results (id, file_path, params_hash, created_at, updated_at) "
+                     "VALUES ('sim', 'sim.nc.gz', 'hash', '2024-01-01 00:00:00', '2024-01-02 00:00:00')")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        db.use_storage_paths(self._paths)
+        shutil.rmtree(self.tmp_dir)
+
+    def snapshot(self):
+        conn = db.get_connection()
+        return {
+            'version': conn.execute('PRAGMA user_version').fetchone()[0],
+            'schema': conn.execute('SELECT type, name, sql FROM sqlite_master ORDER BY name').fetchall(),
+            'params': conn.execute('SELECT * FROM simulation_params').fetchall(),
+            'results': conn.execute('SELECT * FROM simulation_results').fetchall(),
+        }
+
+    def test_baseline_database_is_upgraded_without_losing_rows(self):
+        db.create_database()
+        upgraded = self.snapshot()
+
+        self.assertEqual(upgraded['version'], db.SCHEMA_VERSION)
+        self.assertEqual([row[:2] for row in upgraded['params']], [('hash', b'\x1f\x8b')])
+        self.assertEqual(upgraded['results'], [('sim', 'sim.nc.gz', 'hash', '2024-01-01 00:00:00', '2024-01-02 00:00:00')])
+        names = {name for _, name, _ in upgraded['schema']}
+        for version in db.MIGRATIONS:
+            for statement in db.MIGRATIONS[version]:
+                self.assertIn(statement.split(' IF NOT EXISTS ')[1].split()[0], names)
+        self.assertEqual(db.get_existing_simulation_id('hash'), 'sim')
+        # and the tables added since are there to use
+        self.assertTrue(db.create_job('job', 'hash', 'julia', self.tmp_dir))
+        db.record_result_access('sim')
+
+    def test_upgrading_twice_changes_nothing(self):
+        db.create_database()
+        upgraded = self.snapshot()
+        db.create_database()
+
+        self.assertEqual(self.snapshot(), upgraded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from db.db import DatasetCache
+
+
+class TestDatasetCache(unittest.TestCase):
+
+    def test_hit_and_miss_counters(self):
+        cache = DatasetCache(max_bytes=100)
+        loads = []
+        loader = lambda: loads.append(1) or 'ds'
+
+        self.assertEqual(cache.get_or_load('a', (1, 10), loader, lambda v: 10), 'ds')
+        self.assertEqual(cache.get_or_load('a', (1, 10), loader, lambda v: 10), 'ds')
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_concurrent_loads_of_a_key_decode_once(self):
+        cache = DatasetCache(max_bytes=100)
+        loads = []
+
+        def loader():
+            loads.append(1)
+            time.sleep(0.1)
+            return 'ds'
+
+        threads = [threading.Thread(target=cache.get_or_load, args=('a', 1, loader, lambda v: 10)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache._load_locks, {})
+
+    def test_load_locks_dont_outlive_their_loads(self):
+        cache = DatasetCache(max_bytes=100)
+        for i in range(100):
+            cache.get_or_load(f"sim-{i}", 1, lambda: 'ds', lambda v: 10)
+        # nor do the locks of failed loads
+        with self.assertRaises(ValueError):
+            cache.get_or_load('broken', 1, lambda: int('x'), lambda v: 10)
+
+        self.assertEqual(cache._load_locks, {})
+
+    def test_lru_eviction_respects_byte_budget(self):
+        cache = DatasetCache(max_bytes=100)
+        cache.put('a', 1, 'A', 40)
+        cache.put('b', 1, 'B', 40)
+        cache.get('a', 1)
+        cache.put('c', 1, 'C', 40)
+
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('a', 1), 'A')
+        self.assertEqual(cache.get('c', 1), 'C')
+        self.assertEqual(cache.stats()['current_bytes'], 80)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lru_eviction_respects_entry_limit(self):
+        # e.g. memory-mapped datasets, which count as next to no bytes
+        cache = DatasetCache(max_bytes=100, max_entries=2)
+        cache.put('a', 1, 'A', 0)
+        cache.put('b', 1, 'B', 0)
+        cache.get('a', 1)
+        cache.put('c', 1, 'C', 0)
+
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('a', 1), 'A')
+        self.assertEqual(cache.get('c', 1), 'C')
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_changed_signature_invalidates_entry(self):
+        cache = DatasetCache(max_bytes=100)
+        cache.put('a', (1, 10), 'old', 10)
+
+        self.assertIsNone(cache.get('a', (2, 10)))
+        self.assertEqual(cache.stats()['invalidations'], 1)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_oversized_values_are_not_kept(self):
+        cache = DatasetCache(max_bytes=10)
+        cache.put('a', 1, 'A', 11)
+
+        self.assertIsNone(cache.get('a', 1))
+        self.assertEqual(cache.stats()['current_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
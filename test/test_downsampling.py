@@ -0,0 +1,45 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+from downsampling import lttb, min_max
+
+
+class TestDownsampling(unittest.TestCase):
+
+    def test_short_series_are_kept_whole(self):
+        y = np.arange(10.0)
+        np.testing.assert_array_equal(lttb(np.arange(10), y, 100), np.arange(10))
+        np.testing.assert_array_equal(min_max(y, 100), np.arange(10))
+
+    def test_lttb_keeps_endpoints_and_peaks(self):
+        x = np.arange(1000)
+        y = np.zeros(1000)
+        y[500] = 10.0
+        y[700] = -5.0
+
+        indices = lttb(x, y, 50)
+
+        self.assertEqual(len(indices), 50)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 999)
+        self.assertIn(500, indices)
+        self.assertIn(700, indices)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+
+    def test_min_max_keeps_extremes_of_each_bucket(self):
+        y = np.sin(np.linspace(0, 20, 1000))
+
+        indices = min_max(y, 100)
+
+        self.assertLessEqual(len(indices), 100)
+        self.assertAlmostEqual(y[indices].max(), y.max())
+        self.assertAlmostEqual(y[indices].min(), y.min())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+import gzip
+import json
+import lzma
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import simulation_results_dashboard
+from test_result_storage import synthetic_output
+
+try:
+    import epi_sim_server
+    from epi_sim_server import app
+except ImportError:
+    # the server module needs the engine's python package
+    app = None
+
+
+@unittest.skipIf(app is None, "needs the engine's python package")
+class EndpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = db.storage_paths()
+        db.use_storage_paths({
+            'DATABASE_PATH': os.path.join(self.tmp_dir, 'test.db'),
+            'SIM_OUTPUT_DIR': self.tmp_dir,
+            'BLOB_DIR': os.path.join(self.tmp_dir, 'blobs'),
+        })
+        db.create_database()
+        db.dataset_cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.use_storage_paths(self._paths)
+        db.dataset_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestDownload(EndpointTestCase):
+
+    def test_range_request_gets_part_of_the_file(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        with open(db.result_file_path('sim'), 'rb') as f:
+            contents = f.read()
+
+        response = self.client.get('/api/results/sim/download', headers={'Range': 'bytes=100-199'})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], f"bytes 100-199/{len(contents)}")
+        self.assertEqual(response.data, contents[100:200])
+
+    def test_unchanged_file_is_not_sent_again(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        response = self.client.get('/api/results/sim/download')
+        self.assertEqual(response.status_code, 200)
+
+        revalidated = self.client.get('/api/results/sim/download', headers={'If-None-Match': response.headers['ETag']})
+
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.data, b'')
+
+        # a new result under the same id is a new representation
+        db.store_simulation_result('sim', synthetic_output(seed=1), 'hash')
+        changed = self.client.get('/api/results/sim/download', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(changed.status_code, 200)
+
+    def test_compressed_results_are_passed_through(self):
+        output = synthetic_output()
+        # the server never decodes them, so the zstd file needn't be valid zstd
+        compressed = {'.gz': gzip.compress(output), '.zst': b'zstd compressed result', '.xz': lzma.compress(output)}
+        for codec, encoding, accept_encoding in (('.gz', 'gzip', 'gzip, br'), ('.zst', 'zstd', 'zstd'), ('.xz', None, 'gzip, zstd')):
+            with self.subTest(codec=codec):
+                file_path = os.path.join(self.tmp_dir, f"sim.nc{codec}")
+                with open(file_path, 'wb') as f:
+                    f.write(compressed[codec])
+
+                encoded = self.client.get('/api/results/sim/download', headers={'Accept-Encoding': accept_encoding})
+                plain = self.client.get('/api/results/sim/download', headers={'Accept-Encoding': 'identity'})
+
+                self.assertEqual(encoded.data, compressed[codec])
+                self.assertEqual(encoded.headers.get('Content-Encoding'), encoding)
+                self.assertEqual(encoded.headers['Vary'], 'Accept-Encoding')
+                # clients that can't decode it get the compressed file as it is
+                self.assertEqual(plain.data, compressed[codec])
+                self.assertNotIn('Content-Encoding', plain.headers)
+                self.assertIn(f'filename=sim.nc{codec}', plain.headers['Content-Disposition'])
+                os.remove(file_path)
+
+    def test_missing_result(self):
+        self.assertEqual(self.client.get('/api/results/missing/download').status_code, 404)
+
+
+
+def square(x, y):
+    return {'type': 'Polygon', 'coordinates': [[[x, y], [x + 0.1, y], [x + 0.1, y + 0.1], [x, y + 0.1], [x, y]]]}
+
+
+class TestMapEndpoints(EndpointTestCase):
+
+    def setUp(self):
+        super().setUp()
+        regions_path = os.path.join(self.tmp_dir, 'regions.geojson')
+        with open(regions_path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {'id': '8001', 'name': 'One'}, 'geometry': square(2.0, 41.0)},
+                {'type': 'Feature', 'properties': {'id': '8002', 'name': 'Two'}, 'geometry': square(2.1, 41.0)},
+            ]}, f)
+        self._regions_path = simulation_results_dashboard.REGIONS_GEOJSON_PATH
+        simulation_results_dashboard.REGIONS_GEOJSON_PATH = regions_path
+        self.clear_geometry()
+
+    def tearDown(self):
+        simulation_results_dashboard.REGIONS_GEOJSON_PATH = self._regions_path
+        self.clear_geometry()
+        super().tearDown()
+
+    def clear_geometry(self):
+        for cached in ('load_regions', 'region_features', 'region_geojson', 'map_center'):
+            getattr(simulation_results_dashboard, cached).cache_clear()
+
+    def test_geometry_is_cached_by_clients(self):
+        response = self.client.get('/geo/regions.geojson', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        geometry = json.loads(gzip.decompress(response.data))
+        self.assertEqual([feature['properties']['id'] for feature in geometry['features']], ['8001', '8002'])
+        self.assertIn('max-age=86400', response.headers['Cache-Control'])
+
+        revalidated = self.client.get('/geo/regions.geojson', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_region_values_of_a_day(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        expected = db.read_simulation('sim').data.sel(epi_states='I').isel(T=3).sum(dim=['G', 'V'])
+
+        answer = self.client.get('/api/results/sim/regions?compartment=I&t=3').get_json()
+
+        self.assertEqual((answer['compartment'], answer['t'], answer['time']), ('I', 3, '2020-03-13'))
+        self.assertEqual(len(answer['values']), 20)
+        for region, value in answer['values'].items():
+            self.assertAlmostEqual(value, float(expected.sel(M=region)), places=6)
+        self.assertEqual(self.client.get('/api/results/sim/regions?compartment=X').status_code, 400)
+        self.assertEqual(self.client.get('/api/results/sim/regions?t=40').status_code, 400)
+        self.assertEqual(self.client.get('/api/results/missing/regions').status_code, 404)
+
+    def test_region_series_is_a_binary_array(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        expected = db.read_simulation('sim').data.sel(epi_states='I').sum(dim=['G', 'V']).transpose('M', 'T').values
+
+        plain = self.client.get('/api/results/sim/regions/series?compartment=I')
+        gzipped = self.client.get('/api/results/sim/regions/series?compartment=I', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual((plain.headers['X-Array-Dtype'], plain.headers['X-Array-Shape']), ('<f4', '20,40'))
+        series = np.frombuffer(plain.data, dtype='<f4').reshape(20, 40)
+        np.testing.assert_allclose(series, expected, rtol=1e-6)
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.data), plain.data)
+
+        revalidated = self.client.get('/api/results/sim/regions/series?compartment=I', headers={'If-None-Match': plain.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_region_series_is_encoded_again_for_a_new_result(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        first = self.client.get('/api/results/sim/regions/series')
+        db.store_simulation_result('sim', synthetic_output(seed=1), 'hash')
+        second = self.client.get('/api/results/sim/regions/series')
+
+        self.assertNotEqual(first.data, second.data)
+        # the encoded series count against the budget of the dataset cache
+        self.assertIn('sim:series:I', db.dataset_cache._entries)
+
+    def test_region_series_of_missing_results(self):
+        self.assertEqual(self.client.get('/api/results/missing/regions/series').status_code, 404)
+
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        self.assertEqual(self.client.get('/api/results/sim/regions/series').status_code, 200)
+        self.assertEqual(self.client.get('/api/results/sim/regions/series?compartment=X').status_code, 400)
+        os.remove(db.result_file_path('sim'))
+        self.assertEqual(self.client.get('/api/results/sim/regions/series').status_code, 404)
+
+    def test_region_series_of_a_result_removed_while_answering(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        read_view = epi_sim_server.read_view
+
+        def removing_read_view(simulation_id, kept_dims=()):
+            # e.g. by retention, between finding the file and reading it
+            for file_path in (db.result_file_path(simulation_id), db.rollups_file_path(simulation_id)):
+                if file_path is not None and os.path.exists(file_path):
+                    os.remove(file_path)
+            return read_view(simulation_id, kept_dims)
+
+        epi_sim_server.read_view = removing_read_view
+        try:
+            response = self.client.get('/api/results/sim/regions/series')
+        finally:
+            epi_sim_server.read_view = read_view
+        self.assertEqual(response.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import ensembles
+from ensembles import expand_sweep, latin_hypercube, sweep_size
+from test_result_storage import synthetic_output
+
+BASE_CONFIG = {
+    'epidemic_params': {'scale_β': 0.51},
+    'vaccination': {'start_vacc': 0},
+    'NPI': {'κ₀s': [0.8], 'δs': [0.8]},
+}
+
+
+class TestEnsembles(unittest.TestCase):
+
+    def test_grid_is_every_combination(self):
+        members = expand_sweep(BASE_CONFIG, {
+            'method': 'grid',
+            'parameters': {'epidemic_params.scale_β': [0.4, 0.5, 0.6], 'NPI.κ₀s': [[0.6], [0.8]]},
+        })
+
+        self.assertEqual(len(members), 6)
+        self.assertEqual(
+            {(config['epidemic_params']['scale_β'], config['NPI']['κ₀s'][0]) for _, config in members},
+            {(b, k) for b in (0.4, 0.5, 0.6) for k in (0.6, 0.8)},
+        )
+        # the base config is left alone
+        self.assertEqual(BASE_CONFIG['epidemic_params']['scale_β'], 0.51)
+
+    def test_latin_hypercube_covers_every_stratum(self):
+        sample = latin_hypercube(10, 3, seed=0)
+        for dim in range(3):
+            self.assertEqual(sorted(np.floor(sample[:, dim] * 10).astype(int)), list(range(10)))
+
+    def test_lhs_keeps_integer_parameters_integers(self):
+        members = expand_sweep(BASE_CONFIG, {
+            'method': 'lhs',
+            'parameters': {'vaccination.start_vacc': [0, 60], 'NPI.δs.0': [0.2, 0.9]},
+            'samples': 8,
+            'seed': 1,
+        })
+
+        self.assertEqual(len(members), 8)
+        for overrides, config in members:
+            self.assertIsInstance(config['vaccination']['start_vacc'], int)
+            self.assertTrue(0.2 <= config['NPI']['δs'][0] <= 0.9)
+
+    def test_size_is_known_before_expanding(self):
+        grid = {'method': 'grid', 'parameters': {f'p{i}': list(range(10)) for i in range(9)}}
+        self.assertEqual(sweep_size(grid), 10 ** 9)
+        self.assertEqual(sweep_size({'method': 'lhs', 'parameters': {}, 'samples': 20}), 20)
+        self.assertEqual(sweep_size({'method': 'list', 'members': [{}, {}]}), 2)
+        with self.assertRaises(ValueError):
+            sweep_size({'method': 'grid', 'parameters': {'epidemic_params.scale_β': []}})
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(ValueError):
+            expand_sweep(BASE_CONFIG, {'method': 'list', 'members': [{'NPI.nope': 1}]})
+
+
+class TestEnsembleStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = (db.SIM_OUTPUT_DIR, db.DATABASE_PATH)
+        db.SIM_OUTPUT_DIR = self.tmp_dir
+        db.DATABASE_PATH = os.path.join(self.tmp_dir, 'test.db')
+        db.create_database()
+        db.dataset_cache.clear()
+
+        self.result_ids = [f"member-{i}" for i in range(7)]
+        for seed, result_id in enumerate(self.result_ids):
+            db.store_simulation_result(result_id, synthetic_output(seed=seed), f"hash-{seed}")
+
+    def tearDown(self):
+        db.SIM_OUTPUT_DIR, db.DATABASE_PATH = self._paths
+        db.dataset_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_statistics_match_the_stacked_members(self):
+        block_bytes = ensembles.ENSEMBLE_BLOCK_BYTES
+        # a few days per block
+        ensembles.ENSEMBLE_BLOCK_BYTES = 8 * 7 * 21 * 3 * 5
+        try:
+            stats = ensembles.reduce_ensemble(self.result_ids)
+        finally:
+            ensembles.ENSEMBLE_BLOCK_BYTES = block_bytes
+
+        stacked = np.stack([
+            db.read_simulation(result_id).data.sel(epi_states=['PH', 'HR', 'HD']).sum(dim=['G', 'V', 'epi_states']).transpose('T', 'M').values
+            for result_id in self.result_ids
+        ])
+        hospitalizations = stats['hospitalizations']
+        np.testing.assert_allclose(hospitalizations.sel(statistic='mean').values, stacked.mean(axis=0))
+        np.testing.assert_allclose(hospitalizations.sel(statistic='std').values, stacked.std(axis=0, ddof=1))
+        np.testing.assert_allclose(hospitalizations.sel(statistic='q50').values, np.median(stacked, axis=0))
+        np.testing.assert_allclose(stats['hospitalizations_total'].sel(statistic='q95').values,
+                                   np.quantile(stacked.sum(axis=2), 0.95, axis=0))
+
+    def test_statistics_are_stored_and_follow_the_members(self):
+        ensemble_id = 'ensemble'
+        db.create_ensemble(ensemble_id, 'engine', {'method': 'list'}, [(f"hash-{i}", {}) for i in range(7)])
+
+        stats = ensembles.ensemble_stats(ensemble_id)
+        self.assertEqual(stats.attrs['n_members'], 7)
+        self.assertTrue(os.path.exists(db.ensemble_stats_file_path(ensemble_id)))
+
+        db.create_ensemble('other', 'engine', {'method': 'list'}, [("hash-0", {}), ("hash-missing", {})])
+        self.assertEqual(ensembles.ensemble_stats('other').attrs['n_members'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
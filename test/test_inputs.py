@@ -0,0 +1,80 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from io import BytesIO
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import inputs
+
+MOBILITY_MATRIX = b"""source_idx,target_idx,ratio
+2,3,0.25
+1,1,1.0
+2,2,0.75
+3,1,0.5
+3,3,0.5
+"""
+
+METAPOPULATION = b"""id,area,Y,M,O,Total
+01001,10.0,1,2,3,6
+01002,20.0,4,5,6,15
+01003,30.0,7,8,9,24
+"""
+
+
+class TestInputs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._blob_dir = db.BLOB_DIR
+        db.BLOB_DIR = self.tmp_dir
+        inputs.load_input.cache_clear()
+
+    def tearDown(self):
+        db.BLOB_DIR = self._blob_dir
+        inputs.load_input.cache_clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_mobility_matrix_is_stored_as_csr(self):
+        digest = db.store_blob(BytesIO(MOBILITY_MATRIX))
+        arrays = inputs.load_input(digest, 'R_mobility_matrix.csv')
+
+        dense = np.zeros(tuple(arrays['shape']))
+        for row in range(dense.shape[0]):
+            start, end = arrays['indptr'][row], arrays['indptr'][row + 1]
+            dense[row, arrays['indices'][start:end]] = arrays['data'][start:end]
+
+        np.testing.assert_allclose(dense, [[1.0, 0, 0], [0, 0.75, 0.25], [0.5, 0, 0.5]])
+        self.assertTrue(os.path.exists(inputs.binary_input_path(digest)))
+
+    def test_binary_form_is_reused(self):
+        digest = db.store_blob(BytesIO(METAPOPULATION))
+        inputs.load_input(digest, 'metapopulation_data.csv')
+        inputs.load_input.cache_clear()
+        os.chmod(db.blob_path(digest), 0o644)
+        os.remove(db.blob_path(digest))
+
+        arrays = inputs.load_input(digest, 'metapopulation_data.csv')
+
+        self.assertEqual(list(arrays['id']), ['01001', '01002', '01003'])
+        self.assertEqual(arrays['Total'].sum(), 45)
+
+    def test_validation(self):
+        params_blobs = {
+            'R_mobility_matrix.csv': db.store_blob(BytesIO(MOBILITY_MATRIX)),
+            'metapopulation_data.csv': db.store_blob(BytesIO(METAPOPULATION)),
+        }
+        self.assertEqual(inputs.validate_inputs(params_blobs), [])
+
+        params_blobs['R_mobility_matrix.csv'] = db.store_blob(BytesIO(MOBILITY_MATRIX + b"4,1,0.5\n"))
+        errors = inputs.validate_inputs(params_blobs)
+        self.assertEqual(len(errors), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import instrumentation
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self._settings = (instrumentation.ENABLED, instrumentation.PROFILE_SLOW_REQUEST_SECONDS,
+                          instrumentation.PROFILE_DIR, instrumentation.metrics, list(db._instrumentation_listeners))
+        instrumentation.ENABLED = True
+        instrumentation.metrics = instrumentation.Metrics()
+        self.tmp_dir = tempfile.mkdtemp()
+
+        app = Flask(__name__)
+        instrumentation.init_app(app)
+
+        @app.route('/work/<name>')
+        def work(name):
+            with instrumentation.stage('work.compute'):
+                time.sleep(0.02)
+            db._record('bytes', 'decompressed', 100)
+            db._record('count', 'dataset_cache.hit', 1)
+            return 'done'
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        (instrumentation.ENABLED, instrumentation.PROFILE_SLOW_REQUEST_SECONDS,
+         instrumentation.PROFILE_DIR, instrumentation.metrics, db._instrumentation_listeners[:]) = self._settings
+
+    def test_response_carries_its_trace(self):
+        response = self.client.get('/work/a')
+
+        timing = dict(metric.split(';', 1) for metric in response.headers['Server-Timing'].split(', '))
+        self.assertGreaterEqual(float(timing['work.compute'].split('=')[1]), 20)
+        self.assertEqual(timing['bytes.decompressed'], 'desc="100"')
+        self.assertEqual(timing['dataset_cache.hit'], 'desc="1"')
+        self.assertIn('total', timing)
+        self.assertEqual(len(response.headers['X-Request-Id']), 16)
+
+    def test_metrics_are_totalled_across_requests(self):
+        self.client.get('/work/a')
+        self.client.get('/work/b')
+
+        text = instrumentation.render_metrics([
+            ('episim_things', 'gauge', "Things", [('', {'kind': 'a "quoted" kind'}, 3)]),
+        ])
+        self.assertIn('episim_requests_total{endpoint="/work/<name>",method="GET",status="200"} 2', text)
+        self.assertIn('episim_stage_seconds_count{stage="work.compute"} 2', text)
+        self.assertIn('episim_bytes_total{kind="decompressed"} 200', text)
+        self.assertIn('episim_events_total{event="dataset_cache.hit"} 2', text)
+        self.assertIn('episim_request_duration_seconds_bucket{endpoint="/work/<name>",le="+Inf"} 2', text)
+        self.assertIn('episim_request_duration_seconds_bucket{endpoint="/work/<name>",le="0.005"} 0', text)
+        self.assertIn('# TYPE episim_things gauge\nepisim_things{kind="a \\"quoted\\" kind"} 3', text)
+
+    def test_slow_requests_are_profiled(self):
+        instrumentation.PROFILE_SLOW_REQUEST_SECONDS = 0.01
+        instrumentation.PROFILE_DIR = self.tmp_dir
+
+        response = self.client.get('/work/a')
+
+        file_name, = os.listdir(self.tmp_dir)
+        self.assertIn(response.headers['X-Request-Id'], file_name)
+        with open(os.path.join(self.tmp_dir, file_name)) as f:
+            stacks = [line.rsplit(' ', 1) for line in f.read().splitlines()]
+        self.assertTrue(stacks)
+        self.assertTrue(any('work (test_instrumentation.py' in stack for stack, _ in stacks))
+        self.assertTrue(all(int(count) > 0 for _, count in stacks))
+
+
+if __name__ == '__main__':
+    unittest.main()
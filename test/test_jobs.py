@@ -0,0 +1,332 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import jobs
+
+# Stands in for the engine's package in the worker processes. A run writes a small output
+# after sleeping for the config's "seconds", unless the config tells it to fail or to crash,
+# or to run an engine process of its own that never ends, as the compiled engine does.
+STUB_EPI_SIM = '''
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+class EpiSim:
+    def __init__(self, config_fp, data_folder, instance_folder, initial_conditions):
+        with open(config_fp) as f:
+            self.config = json.load(f)
+        self.uuid = str(uuid.uuid4())
+        self.model_state_folder = os.path.join(instance_folder, self.uuid)
+        os.makedirs(self.model_state_folder)
+
+    def setup(self, executable_type):
+        return self
+
+    def set_backend_engine(self, backend_engine):
+        self.backend_engine = backend_engine
+        return self
+
+    def run_model(self):
+        if 'engine_pid_file' in self.config:
+            engine = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(600)'])
+            with open(self.config['engine_pid_file'], 'w') as f:
+                f.write(str(engine.pid))
+            engine.wait()
+        time.sleep(self.config.get('seconds', 0))
+        if self.config.get('crash'):
+            os._exit(3)
+        if self.config.get('fail'):
+            raise RuntimeError("The engine failed")
+        T, M = 10, 4
+        ds = xr.Dataset(
+            {'data': (('T', 'M', 'G', 'V', 'epi_states'), np.ones((T, M, 3, 2, 2)))},
+            coords={
+                'T': pd.date_range('2020-03-10', periods=T).strftime('%Y-%m-%d').values,
+                'M': [str(8001 + i) for i in range(M)],
+                'G': ['Y', 'M', 'O'],
+                'V': ['NV', 'V'],
+                'epi_states': ['I', 'R'],
+            },
+        )
+        os.makedirs(os.path.join(self.model_state_folder, 'output'))
+        ds.to_netcdf(os.path.join(self.model_state_folder, 'output', 'compartments_full.nc'), engine='h5netcdf')
+        return self.uuid, None
+'''
+
+FINISHED = ('done', 'failed', 'cancelled')
+
+
+def is_running(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # zombies are gone, but for their parent to collect them
+            return f.read().rsplit(') ', 1)[1][0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def stop_queue(job_queue):
+    # a queue runs for the life of the server, this stops it from keeping or starting workers
+    with job_queue._lock:
+        job_queue.max_workers = 0
+        idle, job_queue._idle = job_queue._idle, []
+    for worker in idle:
+        worker.terminate()
+
+
+class TestJobQueue(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub_dir = tempfile.mkdtemp()
+        with open(os.path.join(cls.stub_dir, 'epi_sim.py'), 'w') as f:
+            f.write(STUB_EPI_SIM)
+        # spawned workers start with the same path
+        sys.path.insert(0, cls.stub_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(cls.stub_dir)
+        shutil.rmtree(cls.stub_dir)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = db.storage_paths()
+        db.use_storage_paths({
+            'DATABASE_PATH': os.path.join(self.tmp_dir, 'test.db'),
+            'SIM_OUTPUT_DIR': os.path.join(self.tmp_dir, 'sim_output'),
+            'BLOB_DIR': os.path.join(self.tmp_dir, 'blobs'),
+        })
+        db.create_database()
+        self._health_check_interval, self._run_timeout = jobs.HEALTH_CHECK_INTERVAL, jobs.RUN_TIMEOUT
+        jobs.HEALTH_CHECK_INTERVAL = 0.2
+        self.queues = []
+
+    def tearDown(self):
+        for job_queue in self.queues:
+            # let dispatchers finish with the jobs they have, before the database goes away
+            deadline = time.monotonic() + 30
+            while job_queue._workers and time.monotonic() < deadline:
+                time.sleep(0.05)
+            stop_queue(job_queue)
+        jobs.HEALTH_CHECK_INTERVAL, jobs.RUN_TIMEOUT = self._health_check_interval, self._run_timeout
+        db.use_storage_paths(self._paths)
+        shutil.rmtree(self.tmp_dir)
+
+    def job_queue(self, max_workers=1, start=True):
+        job_queue = jobs.JobQueue(max_workers)
+        self.queues.append(job_queue)
+        if start:
+            # before jobs are created, or they are queued both when it starts and when submitted
+            job_queue.start()
+        return job_queue
+
+    def create_job(self, params_hash=None, **config):
+        job_id = str(uuid.uuid4())
+        work_dir = os.path.join(self.tmp_dir, 'runs', job_id)
+        os.makedirs(work_dir)
+        with open(os.path.join(work_dir, 'config.json'), 'w') as f:
+            json.dump(config, f)
+        self.assertTrue(db.create_job(job_id, params_hash or job_id, 'julia', work_dir))
+        return job_id
+
+    def wait_for(self, job_id, statuses=FINISHED, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = db.get_job(job_id)
+            if job['status'] in statuses:
+                return job
+            time.sleep(0.05)
+        self.fail(f"Job {job_id} didn't get to {statuses}, it is {db.get_job(job_id)['status']}")
+
+    def wait_for_file(self, file_path, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if os.path.exists(file_path):
+                with open(file_path) as f:
+                    contents = f.read()
+                if contents:
+                    return contents
+            time.sleep(0.05)
+        self.fail(f"{file_path} wasn't written")
+
+    def assert_stops(self, pid, timeout=10):
+        deadline = time.monotonic() + timeout
+        while is_running(pid) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(is_running(pid), f"Process {pid} is still running")
+
+    def test_job_runs_and_stores_its_result(self):
+        job_queue = self.job_queue()
+        job_id = self.create_job(params_hash='hash', seconds=1)
+        job_queue.submit(job_id)
+
+        self.assertEqual(self.wait_for(job_id, ('running',) + FINISHED)['status'], 'running')
+        job = self.wait_for(job_id)
+
+        self.assertEqual(job['status'], 'done')
+        self.assertIsNotNone(job['started_at'])
+        self.assertEqual(db.get_existing_simulation_id('hash'), job['result_id'])
+        self.assertEqual(db.read_simulation(job['result_id']).data.shape, (10, 4, 3, 2, 2))
+        self.assertFalse(os.path.exists(job['work_dir']))
+
+    def test_failing_run_fails_its_job_only(self):
+        job_queue = self.job_queue()
+        failing = self.create_job(fail=True)
+        crashing = self.create_job(crash=True)
+        following = self.create_job()
+        for job_id in (failing, crashing, following):
+            job_queue.submit(job_id)
+
+        self.assertEqual(self.wait_for(failing)['error'], "The engine failed")
+        self.assertEqual(self.wait_for(crashing)['error'], "Engine worker exited with code 3")
+        # the worker that crashed was replaced
+        self.assertEqual(self.wait_for(following)['status'], 'done')
+
+    def test_identical_submissions_share_a_job(self):
+        job_queue = self.job_queue()
+        job_id = self.create_job(params_hash='hash', seconds=2)
+        self.assertFalse(db.create_job('other', 'hash', 'julia', self.tmp_dir))
+        self.assertEqual(db.attach_to_active_job('hash'), job_id)
+        self.assertEqual(db.get_job(job_id)['subscribers'], 2)
+        job_queue.submit(job_id)
+
+        # withdrawing one of the submissions leaves the job to the other
+        self.assertEqual(job_queue.cancel(job_id), 'detached')
+        self.assertEqual(db.get_job(job_id)['subscribers'], 1)
+        self.assertEqual(self.wait_for(job_id)['status'], 'done')
+        self.assertIsNone(db.attach_to_active_job('hash'))
+        self.assertIsNone(job_queue.cancel(job_id))
+
+    def test_concurrent_identical_submissions_create_one_job(self):
+        n_submissions = 8
+        start = threading.Barrier(n_submissions)
+        job_ids = []
+
+        def submit():
+            # as the server does: attach to the job in flight, or create it, or attach to
+            # the one another submission created in between
+            start.wait()
+            job_id = db.attach_to_active_job('hash')
+            if job_id is None:
+                job_id = str(uuid.uuid4())
+                if not db.create_job(job_id, 'hash', 'julia', self.tmp_dir):
+                    job_id = db.attach_to_active_job('hash')
+            job_ids.append(job_id)
+
+        threads = [threading.Thread(target=submit) for _ in range(n_submissions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(job_ids)), 1)
+        self.assertEqual(db.get_jobs_by_status('queued'), [db.get_job(job_ids[0])])
+        self.assertEqual(db.get_job(job_ids[0])['subscribers'], n_submissions)
+
+    def test_cancel_queued_and_running_jobs(self):
+        job_queue = self.job_queue()
+        running = self.create_job(seconds=60)
+        queued = self.create_job()
+        job_queue.submit(running)
+        job_queue.submit(queued)
+
+        self.wait_for(running, ('running',))
+        self.assertEqual(job_queue.cancel(queued), 'cancelled')
+        self.assertEqual(job_queue.cancel(running), 'cancelled')
+
+        following = self.create_job()
+        job_queue.submit(following)
+        self.assertEqual(self.wait_for(following)['status'], 'done')
+        for job_id in (running, queued):
+            job = db.get_job(job_id)
+            self.assertEqual(job['status'], 'cancelled')
+            self.assertIsNone(job['result_id'])
+            self.assertFalse(os.path.exists(job['work_dir']))
+
+    @unittest.skipUnless(os.path.isdir('/proc'), "needs /proc to look at processes")
+    def test_cancel_stops_the_processes_of_the_engine(self):
+        job_queue = self.job_queue()
+        pid_file = os.path.join(self.tmp_dir, 'engine.pid')
+        job_id = self.create_job(engine_pid_file=pid_file)
+        job_queue.submit(job_id)
+        engine_pid = int(self.wait_for_file(pid_file))
+
+        self.assertEqual(job_queue.cancel(job_id), 'cancelled')
+        self.assert_stops(engine_pid)
+
+    @unittest.skipUnless(os.path.isdir('/proc'), "needs /proc to look at processes")
+    def test_hung_runs_time_out(self):
+        jobs.RUN_TIMEOUT = 2
+        job_queue = self.job_queue()
+        pid_file = os.path.join(self.tmp_dir, 'engine.pid')
+        hung = self.create_job(engine_pid_file=pid_file)
+        following = self.create_job()
+        job_queue.submit(hung)
+        job_queue.submit(following)
+
+        self.assertEqual(self.wait_for(hung)['error'], "Run timed out after 2 seconds")
+        self.assert_stops(int(self.wait_for_file(pid_file)))
+        # the slot of the hung run is free again
+        self.assertEqual(self.wait_for(following)['status'], 'done')
+
+    def test_jobs_of_a_previous_server_are_recovered_on_start(self):
+        interrupted = self.create_job()
+        db.update_job_status(interrupted, 'running')
+        os.makedirs(os.path.dirname(db.partial_result_path(interrupted)))
+        open(db.partial_result_path(interrupted), 'w').close()
+        queued = self.create_job()
+
+        self.job_queue(start=False).start()
+
+        job = db.get_job(interrupted)
+        self.assertEqual((job['status'], job['error']), ('failed', "Interrupted by a server restart"))
+        self.assertFalse(os.path.exists(db.partial_result_path(interrupted)))
+        self.assertEqual(self.wait_for(queued)['status'], 'done')
+
+    def test_workers_are_bounded(self):
+        children = {process.pid for process in multiprocessing.active_children()}
+        job_queue = self.job_queue(max_workers=2)
+        job_ids = [self.create_job(seconds=0.5) for _ in range(6)]
+        for job_id in job_ids:
+            job_queue.submit(job_id)
+
+        most_workers = most_running = 0
+        deadline = time.monotonic() + 120
+        while not all(db.get_job(job_id)['status'] in FINISHED for job_id in job_ids) and time.monotonic() < deadline:
+            workers = [process for process in multiprocessing.active_children() if process.pid not in children]
+            running = [job_id for job_id in job_ids if db.get_job(job_id)['status'] == 'running']
+            most_workers = max(most_workers, len(workers))
+            most_running = max(most_running, len(running))
+            time.sleep(0.02)
+
+        self.assertEqual([db.get_job(job_id)['status'] for job_id in job_ids], ['done'] * 6)
+        self.assertEqual(most_running, 2)
+        self.assertLessEqual(most_workers, 2)
+        # the workers are released just after their jobs are marked done
+        while job_queue.stats() != {'busy': 0, 'idle': 2} and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(job_queue.stats(), {'busy': 0, 'idle': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
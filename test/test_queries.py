@@ -0,0 +1,94 @@
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from werkzeug.datastructures import MultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import queries
+from test_result_storage import synthetic_output
+
+
+class TestQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = (db.SIM_OUTPUT_DIR, db.DATABASE_PATH)
+        db.SIM_OUTPUT_DIR = self.tmp_dir
+        db.DATABASE_PATH = os.path.join(self.tmp_dir, 'test.db')
+        db.create_database()
+        db.dataset_cache.clear()
+        db.store_simulation_result('sim', synthetic_output(T=50), 'hash')
+        self.full = db.read_simulation('sim').data
+
+    def tearDown(self):
+        db.SIM_OUTPUT_DIR, db.DATABASE_PATH = self._paths
+        db.dataset_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def query(self, **args):
+        selections, start, end, sum_dims = queries.parse_query(MultiDict(args))
+        return queries.query_result('sim', selections, start, end, sum_dims), sum_dims
+
+    def test_json_answer_matches_selection_and_sum(self):
+        data, sum_dims = self.query(epi_states='I,R', M='8001,8003', start='2020-03-15', end='2020-04-10', sum='G,V')
+        answer = json.loads(''.join(queries.stream_json(data, sum_dims)))
+
+        expected = (
+            self.full.sel(epi_states=['I', 'R'], M=['8001', '8003'], T=slice('2020-03-15', '2020-04-10'))
+            .sum(dim=['G', 'V'])
+            .transpose(*answer['dims'])
+        )
+        self.assertEqual(answer['dims'], ['T', 'M', 'epi_states'])
+        self.assertEqual(answer['coords']['T'][0], '2020-03-15')
+        self.assertEqual(answer['shape'], list(expected.shape))
+        np.testing.assert_allclose(answer['values'], expected.values)
+
+    def test_csv_answer_is_streamed_in_blocks_of_days(self):
+        queries.QUERY_BLOCK_VALUES, block_values = 30, queries.QUERY_BLOCK_VALUES
+        try:
+            data, sum_dims = self.query(epi_states='D', sum='M,V')
+            chunks = list(queries.stream_csv(data, sum_dims))
+        finally:
+            queries.QUERY_BLOCK_VALUES = block_values
+
+        answer = pd.read_csv(io.StringIO(''.join(chunks)), dtype={'T': str})
+        expected = self.full.sel(epi_states=['D']).sum(dim=['M', 'V']).transpose('T', 'G', 'epi_states')
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(list(answer.columns), ['T', 'G', 'epi_states', 'value'])
+        np.testing.assert_allclose(answer['value'].values, expected.values.ravel())
+
+    def test_selected_regions_can_be_summed_over(self):
+        data, sum_dims = self.query(epi_states='I', M='8001,8002', sum='M,G,V')
+        answer = json.loads(''.join(queries.stream_json(data, sum_dims)))
+
+        expected = self.full.sel(epi_states='I', M=['8001', '8002']).sum(dim=['M', 'G', 'V'])
+        np.testing.assert_allclose(np.array(answer['values'])[:, 0], expected.values)
+
+    def test_invalid_queries_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.query(M='nowhere')
+        with self.assertRaises(ValueError):
+            self.query(sum='epi_states')
+        with self.assertRaises(ValueError):
+            self.query(start='not a date')
+
+        queries.MAX_QUERY_VALUES, max_values = 1000, queries.MAX_QUERY_VALUES
+        try:
+            with self.assertRaises(queries.QueryTooLargeError):
+                self.query()
+            self.query(sum='M,G,V')
+        finally:
+            queries.MAX_QUERY_VALUES = max_values
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+
+
+def synthetic_output(T=40, M=20, seed=0):
+    epi_states = ['S', 'E', 'A', 'I', 'PH', 'PD', 'HR', 'HD', 'R', 'D', 'CH']
+    data = np.random.default_rng(seed).random((T, M, 3, 2, len(epi_states)))
+    ds = xr.Dataset(
+        {'data': (('T', 'M', 'G', 'V', 'epi_states'), data)},
+        coords={
+            'T': pd.date_range('2020-03-10', periods=T).strftime('%Y-%m-%d').values,
+            'M': [str(8001 + i) for i in range(M)],
+            'G': ['Y', 'M', 'O'],
+            'V': ['NV', 'V'],
+            'epi_states': epi_states,
+        },
+    )
+    return bytes(ds.to_netcdf(engine='h5netcdf'))
+
+
+class TestResultStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = (db.SIM_OUTPUT_DIR, db.BLOB_DIR, db.DATABASE_PATH)
+        db.SIM_OUTPUT_DIR = self.tmp_dir
+        db.BLOB_DIR = os.path.join(self.tmp_dir, 'blobs')
+        db.DATABASE_PATH = os.path.join(self.tmp_dir, 'test.db')
+        db.create_database()
+        db.dataset_cache.clear()
+
+    def tearDown(self):
+        db.SIM_OUTPUT_DIR, db.BLOB_DIR, db.DATABASE_PATH = self._paths
+        db.dataset_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stored_result_is_chunked_and_readable(self):
+        output = synthetic_output()
+        db.store_simulation_result('sim', output, 'hash')
+
+        ds = db.read_simulation('sim')
+        expected = xr.open_dataset(output, engine='h5netcdf')
+
+        self.assertEqual(db.result_file_path('sim'), os.path.join(self.tmp_dir, 'sim.nc'))
+        self.assertEqual(ds.data.encoding['chunksizes'], (32, 20, 3, 2, 11))
+        np.testing.assert_allclose(ds.data.values, expected.data.values)
+        self.assertEqual(db.get_existing_simulation_id('hash'), 'sim')
+
+    def test_legacy_gzipped_result_is_readable(self):
+        output = synthetic_output()
+        with open(os.path.join(self.tmp_dir, 'legacy.nc.gz'), 'wb') as f:
+            f.write(gzip.compress(output))
+
+        ds = db.read_simulation('legacy')
+
+        self.assertEqual(ds.data.shape, (40, 20, 3, 2, 11))
+        self.assertTrue(np.issubdtype(ds['T'].dtype, np.datetime64))
+
+    def test_legacy_result_is_memory_mapped_not_loaded(self):
+        output = synthetic_output()
+        with open(os.path.join(self.tmp_dir, 'legacy.nc.gz'), 'wb') as f:
+            f.write(gzip.compress(output))
+
+        ds = db.read_simulation('legacy')
+        expected = xr.open_dataset(output, engine='h5netcdf')
+
+        self.assertTrue(db._is_memory_mapped(ds.data.data))
+        self.assertLess(db.dataset_cache.stats()['current_bytes'], ds.data.nbytes)
+        np.testing.assert_allclose(ds.data.values, expected.data.values)
+
+    def test_rollups_match_full_reductions(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        ds = db.read_simulation('sim')
+
+        for name, dims in db.ROLLUPS.items():
+            rollup = db.get_rollup('sim', name)
+            expected = ds.data.sum(dim=list(dims)).transpose(*rollup.data.dims)
+            np.testing.assert_allclose(rollup.data.values, expected.values)
+
+    def test_result_stored_from_path_replaces_previous_upload(self):
+        path = os.path.join(self.tmp_dir, 'upload.nc')
+        with open(path, 'wb') as f:
+            f.write(synthetic_output(T=70))
+        db.store_simulation_result('sim', synthetic_output(), 'first')
+        db.store_simulation_result('sim', path, 'second')
+
+        self.assertEqual(db.read_simulation('sim').data.shape, (70, 20, 3, 2, 11))
+        self.assertEqual(db.get_existing_simulation_id('second'), 'sim')
+        self.assertIsNone(db.get_existing_simulation_id('first'))
+
+    def test_spool_file_hashes_and_enforces_limit(self):
+        contents = os.urandom(3 * 1024 * 1024)
+        tmp_path, digest = db.spool_file(BytesIO(contents), self.tmp_dir)
+
+        with open(tmp_path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(digest, hashlib.sha256(contents).hexdigest())
+
+        with self.assertRaises(db.FileTooLargeError):
+            db.spool_file(BytesIO(contents), self.tmp_dir, max_bytes=1024 * 1024)
+        spooled = [name for name in os.listdir(self.tmp_dir) if name.endswith('.tmp')]
+        self.assertEqual(spooled, [os.path.basename(tmp_path)])
+
+    def test_identical_contents_are_stored_as_one_blob(self):
+        contents = os.urandom(1024 * 1024)
+        digest = db.store_blob(BytesIO(contents))
+        file_path = db.blob_path(digest)
+        os.utime(file_path, (0, 0))
+
+        self.assertEqual(db.store_blob(BytesIO(contents)), digest)
+
+        self.assertEqual(digest, hashlib.sha256(contents).hexdigest())
+        self.assertEqual(os.listdir(db.BLOB_DIR), [digest[:2]])
+        self.assertEqual(os.listdir(os.path.dirname(file_path)), [digest])
+        self.assertEqual(stat.S_IMODE(os.stat(file_path).st_mode), 0o444)
+        # storing it again counts as using it, for the garbage collection of blobs
+        self.assertGreater(os.path.getmtime(file_path), 0)
+        self.assertNotEqual(db.store_blob(BytesIO(b'other contents')), digest)
+
+    def test_linked_blob_is_the_stored_file(self):
+        digest = db.store_blob(BytesIO(b'region,population'))
+        file_path = os.path.join(self.tmp_dir, 'metapopulation_data.csv')
+
+        db.link_blob(digest, file_path)
+
+        with open(file_path, 'rb') as f:
+            self.assertEqual(f.read(), b'region,population')
+        self.assertTrue(os.path.samefile(file_path, db.blob_path(digest)))
+
+    def test_partial_result_follows_the_output_and_is_stored(self):
+        output = xr.open_dataset(synthetic_output(T=70), engine='h5netcdf').load()
+        source_path = os.path.join(self.tmp_dir, 'engine_output.nc')
+        partial_output = output.copy(deep=True)
+        partial_output['data'][40:] = np.nan
+        partial_output.to_netcdf(source_path, engine='h5netcdf')
+
+        partial = db.PartialResult('job', source_path)
+        self.assertEqual(partial.update(), 40)
+        self.assertEqual(partial.days_copied, 32)
+        with open(db.partial_curves_path('job')) as f:
+            curves = json.load(f)
+        self.assertEqual(len(curves['times']), 40)
+        np.testing.assert_allclose(curves['totals']['I'], output.data.sel(epi_states='I').isel(T=slice(0, 40)).sum(dim=['M', 'G', 'V']).values)
+
+        output.to_netcdf(source_path, engine='h5netcdf')
+        db.store_partial_result('sim', partial, 'hash')
+        partial.discard()
+
+        np.testing.assert_allclose(db.read_simulation('sim').data.values, output.data.values)
+        self.assertFalse(os.path.exists(db.partial_result_path('job')))
+        self.assertFalse(os.path.exists(db.partial_curves_path('job')))
+
+    def test_partial_result_copies_days_changed_after_copying_again(self):
+        output = xr.open_dataset(synthetic_output(T=70), engine='h5netcdf').load()
+        source_path = os.path.join(self.tmp_dir, 'engine_output.nc')
+        output.to_netcdf(source_path, engine='h5netcdf')
+
+        partial = db.PartialResult('job', source_path)
+        partial.update()
+        self.assertEqual(partial.days_copied, 64)
+        # e.g. the engine wrote a day in several passes, and the first left no NaN behind
+        output['data'][35] += 1
+        output.to_netcdf(source_path, engine='h5netcdf')
+        db.store_partial_result('sim', partial, 'hash')
+        partial.discard()
+
+        np.testing.assert_allclose(db.read_simulation('sim').data.values, output.data.values)
+
+    def test_missing_result(self):
+        self.assertIsNone(db.read_simulation('missing'))
+        self.assertIsNone(db.get_rollup('missing', 'total'))
+
+
+try:
+    from epi_sim_server import calculate_params_hash, INPUT_FILES
+except ImportError:
+    # the server module needs the engine's python package
+    calculate_params_hash = None
+
+
+@unittest.skipIf(calculate_params_hash is None, "needs the engine's python package")
+class TestParamsHash(unittest.TestCase):
+
+    def params_blobs(self):
+        return {filename: hashlib.sha256(filename.encode()).hexdigest() for filename in INPUT_FILES.values()}
+
+    def test_hash_doesnt_depend_on_key_order(self):
+        config = {'simulation': {'start_date': '2020-03-10', 'end_date': '2020-04-10'}, 'epidemic_params': {'scale_β': 0.51}}
+        reordered = {'epidemic_params': {'scale_β': 0.51}, 'simulation': {'end_date': '2020-04-10', 'start_date': '2020-03-10'}}
+
+        self.assertEqual(calculate_params_hash(config, self.params_blobs()), calculate_params_hash(reordered, self.params_blobs()))
+
+    def test_hash_changes_with_the_inputs(self):
+        config = {'epidemic_params': {'scale_β': 0.51}}
+        params_blobs = self.params_blobs()
+        params_hash = calculate_params_hash(config, params_blobs)
+
+        changed = dict(params_blobs, **{next(iter(params_blobs)): hashlib.sha256(b'other').hexdigest()})
+        self.assertNotEqual(calculate_params_hash(config, changed), params_hash)
+        self.assertNotEqual(calculate_params_hash({'epidemic_params': {'scale_β': 0.5}}, params_blobs), params_hash)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import db.db as db
+import retention
+from test_result_storage import synthetic_output
+
+
+def age_result(simulation_id, created_days=0, used_days=0):
+    conn = db.get_connection()
+    conn.execute("UPDATE simulation_results SET created_at = datetime('now', ?) WHERE id = ?", (f"-{created_days} days", simulation_id))
+    conn.execute("UPDATE simulation_result_access SET last_accessed_at = datetime('now', ?) WHERE id = ?", (f"-{used_days} days", simulation_id))
+
+
+def age_file(file_path, seconds=2 * retention.GC_GRACE_SECONDS):
+    mtime = time.time() - seconds
+    os.utime(file_path, (mtime, mtime))
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._paths = (db.SIM_OUTPUT_DIR, db.BLOB_DIR, db.DATABASE_PATH)
+        db.SIM_OUTPUT_DIR = os.path.join(self.tmp_dir, 'sim_output')
+        db.BLOB_DIR = os.path.join(self.tmp_dir, 'blobs')
+        db.DATABASE_PATH = os.path.join(self.tmp_dir, 'test.db')
+        db.create_database()
+        db.dataset_cache.clear()
+        db._recorded_accesses.clear()
+
+    def tearDown(self):
+        db.SIM_OUTPUT_DIR, db.BLOB_DIR, db.DATABASE_PATH = self._paths
+        db.dataset_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_retention(self, dry_run=False, **policy):
+        return retention.run_retention(retention.RetentionPolicy(**policy), dry_run=dry_run, log=lambda line: None)
+
+    def test_cold_results_are_recompressed_and_promoted_when_used(self):
+        db.store_simulation_result('sim', synthetic_output(), 'hash')
+        expected = db.read_simulation('sim').data.values
+        rollups_mtime = os.path.getmtime(db.rollups_file_path('sim'))
+        age_result('sim', created_days=40, used_days=40)
+
+        actions = self.run_retention(cold_after_days=30, cold_codec='xz')
+
+        self.assertEqual([(a['action'], a['target']) for a in actions], [('compress_result', 'sim')])
+        self.assertEqual(db.result_file_path('sim'), os.path.join(db.SIM_OUTPUT_DIR, 'sim.nc.xz'))
+        # as if it was read more than ACCESS_RECORD_INTERVAL after the first time
+        db._recorded_accesses.clear()
+        np.testing.assert_allclose(db.read_simulation('sim').data.values, expected)
+        # the rollups are still up to date
+        db.get_rollup('sim', 'total')
+        self.assertEqual(os.path.getmtime(db.rollups_file_path('sim')), rollups_mtime)
+
+        # reading it counted as using it
+        actions = self.run_retention(cold_after_days=30, cold_codec='xz')
+
+        self.assertEqual([(a['action'], a['target']) for a in actions], [('promote_result', 'sim')])
+        self.assertEqual(db.result_file_path('sim'), os.path.join(db.SIM_OUTPUT_DIR, 'sim.nc'))
+        self.assertEqual(os.listdir(os.path.join(db.SIM_OUTPUT_DIR, '.spool')), [])
+        np.testing.assert_allclose(db.read_simulation('sim').data.values, expected)
+
+    def test_dry_run_changes_nothing(self):
+        db.store_simulation_result('old', synthetic_output(), 'hash')
+        age_result('old', created_days=400, used_days=400)
+
+        actions = self.run_retention(dry_run=True, max_age_days=365)
+
+        self.assertEqual([(a['action'], a['target'], a['reason']) for a in actions], [('delete_result', 'old', "created 400 days ago")])
+        self.assertGreater(actions[0]['bytes'], 0)
+        self.assertIsNotNone(db.result_file_path('old'))
+
+    def test_expired_and_over_budget_results_are_deleted_least_recently_used_first(self):
+        for simulation_id, used_days in (('idle', 100), ('a', 3), ('b', 2), ('c', 1)):
+            db.store_simulation_result(simulation_id, synthetic_output(), simulation_id)
+            age_result(simulation_id, used_days=used_days)
+        result_bytes = retention._result_bytes('a')
+
+        actions = self.run_retention(max_idle_days=90, cold_after_days=0, max_bytes=2 * result_bytes + 1024)
+
+        self.assertEqual([(a['action'], a['target']) for a in actions], [('delete_result', 'idle'), ('delete_result', 'a')])
+        self.assertEqual(sorted(r['id'] for r in retention.stored_results()), ['b', 'c'])
+        self.assertFalse(os.path.exists(db.rollups_file_path('a')))
+
+    def test_results_of_ensemble_members_are_kept(self):
+        for simulation_id in ('member', 'job-member', 'other'):
+            db.store_simulation_result(simulation_id, synthetic_output(), simulation_id)
+            age_result(simulation_id, created_days=400, used_days=400)
+        db.create_ensemble('ensemble', 'julia', {'method': 'list', 'members': []}, [('member', {}), ('job-member-params', {})])
+        # a member whose run stored its result under other params than the member's
+        db.create_job('job', 'job-member-params', 'julia', self.tmp_dir)
+        db.update_job_status('job', 'done', result_id='job-member')
+        db.set_ensemble_member_job('ensemble', 1, 'job')
+
+        actions = self.run_retention(max_age_days=365, cold_after_days=0, max_bytes=1)
+
+        self.assertEqual([(a['action'], a['target']) for a in actions], [('delete_result', 'other')])
+        self.assertEqual(sorted(r['id'] for r in retention.stored_results()), ['job-member', 'member'])
+
+    def test_garbage_is_collected(self):
+        db.store_simulation_result('sim', synthetic_output(), 'used')
+        orphan_rollups = db.rollups_file_path('gone')
+        shutil.copyfile(db.rollups_file_path('sim'), orphan_rollups)
+        leftover = os.path.join(db.SIM_OUTPUT_DIR, 'sim.nc.0123.tmp')
+        open(leftover, 'wb').close()
+        age_file(leftover)
+        os.makedirs(os.path.join(db.SIM_OUTPUT_DIR, 'partial'))
+        partial = db.partial_curves_path('finished-job')
+        open(partial, 'w').close()
+        age_file(partial)
+
+        used = db.store_blob(io.BytesIO(b'used input'))
+        unused = db.store_blob(io.BytesIO(b'unused input'))
+        open(f"{db.blob_path(unused)}.npz", 'wb').close()
+        db.store_simulation_params({'a.csv': used}, 'used')
+        db.store_simulation_params({'a.csv': unused}, 'unused')
+        db.get_connection().execute("UPDATE simulation_params SET created_at = datetime('now', '-2 days')")
+        for digest in (used, unused):
+            age_file(db.blob_path(digest))
+
+        actions = self.run_retention(cold_after_days=0)
+
+        self.assertEqual(sorted((a['action'], a['target']) for a in actions), sorted([
+            ('delete_file', orphan_rollups),
+            ('delete_file', leftover),
+            ('delete_file', partial),
+            ('drop_params', 'unused'),
+            ('delete_blob', unused),
+        ]))
+        conn = db.get_connection()
+        self.assertEqual(conn.execute('SELECT id FROM simulation_params').fetchall(), [('used',)])
+        self.assertEqual(conn.execute('SELECT params_hash FROM simulation_param_files').fetchall(), [('used',)])
+        self.assertTrue(os.path.exists(db.blob_path(used)))
+        self.assertFalse(os.path.exists(db.blob_path(unused)))
+        self.assertFalse(os.path.exists(f"{db.blob_path(unused)}.npz"))
+
+    def test_parse_bytes(self):
+        self.assertEqual(retention.parse_bytes('0'), 0)
+        self.assertEqual(retention.parse_bytes('512'), 512)
+        self.assertEqual(retention.parse_bytes('1.5K'), 1536)
+        self.assertEqual(retention.parse_bytes('200GiB'), 200 * 1024 ** 3)
+        with self.assertRaises(ValueError):
+            retention.parse_bytes('lots')
+
+
+if __name__ == '__main__':
+    unittest.main()